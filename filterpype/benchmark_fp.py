@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+
+"""Throughput benchmarks for comparing alternative code paths.
+
+These aren't run as part of the test suite, and the module is left out of
+the coverage measurement (see setup.cfg). Run the module directly, e.g.
+
+    python -m filterpype.benchmark_fp
+
+or call a single benchmark function from the interpreter. Each benchmark
+prints one line per variant, and returns a dictionary of the timings so
+that results can be compared in a script.
+"""
+
+import cPickle
+import os
+import random
+import time
+
+import filterpype.codec as codec
+import filterpype.data_fltr_base as dfb
+import filterpype.filter_factory as ff
+import filterpype.filter_utils as fut
+import filterpype.pipeline as ppln
+import filterpype.range_split as range_split
+import filterpype.serialise as serialise
+
+
+def make_test_data(size, seed=1234):
+    """Return size bytes of moderately compressible test data: random words
+    from a small vocabulary, so that bzip2 has the same sort of work to do
+    as it would with a text log file.
+    """
+    rand = random.Random(seed)
+    words = ['%s%d' % (word, rand.randint(0, 999)) for word in
+             'alpha bravo charlie delta echo foxtrot golf hotel'.split()]
+    parts = []
+    total = 0
+    while total < size:
+        line = ' '.join(rand.choice(words) for j in xrange(12)) + '\n'
+        parts.append(line)
+        total += len(line)
+    return ''.join(parts)[:size]
+
+def _report(label, data_size, secs):
+    rate = data_size / (1024.0 * 1024.0) / max(secs, 1e-9)
+    print '%-40s %8.3f secs %8.2f MB/s' % (label, secs, rate)
+    return secs
+
+def time_compressor(compressor, data, packet_size=0x10000):
+    """Feed data through the compressor in packet_size pieces, as the
+    filters would, and return (seconds taken, compressed size).
+    """
+    start = time.time()
+    out_size = 0
+    for j in xrange(0, len(data), packet_size):
+        out_size += len(compressor.compress(data[j:j + packet_size]))
+    out_size += len(compressor.flush())
+    return time.time() - start, out_size
+
+def bench_bz2_compress(data_size=32 * 1024 * 1024,
+                       block_size=codec.k_default_block_size,
+                       worker_counts=None):
+    """Compare serial bz2.BZ2Compressor with ParallelBZ2Compressor."""
+    if worker_counts is None:
+        worker_counts = sorted(set([2, 4, max(2, _cpu_count())]))
+    data = make_test_data(data_size)
+    results = {}
+    secs, out_size = time_compressor(codec.make_bz2_compressor(), data)
+    results['serial'] = _report('bz2 serial (%d bytes out)' % out_size,
+                                data_size, secs)
+    for workers in worker_counts:
+        compressor = codec.make_bz2_compressor(workers=workers,
+                                               block_size=block_size)
+        secs, out_size = time_compressor(compressor, data)
+        results['workers_%d' % workers] = _report(
+            'bz2 %d workers (%d bytes out)' % (workers, out_size),
+            data_size, secs)
+    return results
+
+def time_decompressor(decompressor, data, packet_size=0x10000):
+    """Feed compressed data through the decompressor and return (seconds
+    taken, decompressed size).
+    """
+    start = time.time()
+    out_size = 0
+    for j in xrange(0, len(data), packet_size):
+        out_size += len(decompressor.decompress(data[j:j + packet_size]))
+    out_size += len(decompressor.flush())
+    return time.time() - start, out_size
+
+def bench_bz2_decompress(data_size=32 * 1024 * 1024,
+                         block_size=codec.k_default_block_size,
+                         worker_counts=None):
+    """Compare serial and parallel decompression of multi-stream data."""
+    if worker_counts is None:
+        worker_counts = sorted(set([2, 4, max(2, _cpu_count())]))
+    data = make_test_data(data_size)
+    compressor = codec.make_bz2_compressor(workers=max(worker_counts),
+                                           block_size=block_size)
+    compressed = compressor.compress(data) + compressor.flush()
+    results = {}
+    secs = time_decompressor(codec.make_bz2_decompressor(), compressed)[0]
+    results['serial'] = _report('bz2 decompress serial', data_size, secs)
+    for workers in worker_counts:
+        decompressor = codec.make_bz2_decompressor(workers=workers)
+        secs = time_decompressor(decompressor, compressed)[0]
+        results['workers_%d' % workers] = _report(
+            'bz2 decompress %d workers' % workers, data_size, secs)
+    return results
+
+def bench_codecs(data_size=16 * 1024 * 1024, levels=(1, None, 9)):
+    """Compression ratio and compress/decompress speed for each codec
+    registered in the codec module, at the fastest, default and smallest
+    levels.
+    """
+    data = make_test_data(data_size)
+    results = {}
+    print '%-12s %5s %8s %12s %12s' % ('codec', 'level', 'ratio', 
+                                        'comp MB/s', 'decomp MB/s')
+    for each_codec in sorted(set(codec.codecs.itervalues()), 
+                             key=lambda x: x.name):
+        for level in levels:
+            comp_secs, out_size = time_compressor(
+                each_codec.compressor(level), data)
+            compressor = each_codec.compressor(level)
+            compressed = compressor.compress(data) + compressor.flush()
+            decomp_secs = time_decompressor(each_codec.decompressor(),
+                                            compressed)[0]
+            ratio = float(data_size) / max(out_size, 1)
+            mb_size = data_size / (1024.0 * 1024.0)
+            print '%-12s %5s %8.2f %12.2f %12.2f' % (
+                each_codec.name, level or each_codec.default_level, ratio,
+                mb_size / max(comp_secs, 1e-9), 
+                mb_size / max(decomp_secs, 1e-9))
+            results[(each_codec.name, level)] = (ratio, comp_secs, 
+                                                 decomp_secs)
+    return results
+
+def make_long_pipeline(num_filters, branch_every=10):
+    """Return a pipeline of num_filters pass_through filters, with a one
+    filter branch after every branch_every filters, ending in a sink.
+    """
+    route = []
+    for j in xrange(num_filters):
+        route.append('pass_through%d >>>' % j)
+        if branch_every and j % branch_every == branch_every - 1:
+            route.append('    (pass_through_branch%d)' % j)
+    route.append('sink')
+    config = '''
+    [--main--]
+    ftype = long_pipeline
+    description = Benchmark pipeline of %d filters
+
+    [--route--]
+    %s
+    ''' % (num_filters, '\n    '.join(route))
+    return ppln.Pipeline(factory=ff.DemoFilterFactory(), config=config)
+
+def bench_bottle_delivery(sizes=(10, 50, 200), bottles=2000):
+    """Time sending reset bottles from the first filter of a pipeline to the
+    last filter before the sink, passing them along the route as before and
+    delivering them directly.
+    """
+    results = {}
+    for size in sizes:
+        pipeline = make_long_pipeline(size)
+        sender = pipeline.getf('pass_through0')
+        destination = 'pass_through%d' % (size - 1)
+        for direct in (False, True):
+            pipeline.direct_bottle_delivery = direct
+            start = time.time()
+            for j in xrange(bottles):
+                sender.send_on(dfb.MessageBottle(destination, 'reset', 
+                                                 param_name='foo', 
+                                                 new_value=j))
+            secs = time.time() - start
+            label = '%s, %d filters' % (('flooded', 'direct')[direct], size)
+            print '%-40s %8.3f secs %8.1f us/bottle' % (
+                label, secs, secs * 1e6 / bottles)
+            results[(size, direct)] = secs
+    return results
+
+def bench_long_route(sizes=(100, 500, 1000, 2000), packets=200):
+    """Time packets through a long pipeline, by nested send() calls and by
+    the iterative PacketScheduler. Nested calls fail on long routes when
+    they reach Python's recursion limit.
+    """
+    results = {}
+    for size in sizes:
+        for iterative in (False, True):
+            pipeline = make_long_pipeline(size)
+            pipeline.iterative_scheduling = iterative
+            label = '%s, %d filters' % (('nested', 'iterative')[iterative], 
+                                        size)
+            start = time.time()
+            try:
+                for j in xrange(packets):
+                    pipeline.send(dfb.DataPacket('x' * 100))
+                pipeline.shut_down()
+            except RuntimeError:  # Maximum recursion depth exceeded
+                print '%-40s recursion limit reached' % label
+                results[(size, iterative)] = None
+                continue
+            secs = time.time() - start
+            print '%-40s %8.3f secs %8.1f us/packet/filter' % (
+                label, secs, secs * 1e6 / packets / size)
+            results[(size, iterative)] = secs
+    return results
+
+def make_transform_chain(num_filters, fuse):
+    """Return a pipeline of a linear chain of num_filters filters that have
+    transform() methods, ending in a sink.
+    """
+    ftypes = ['tag_packet', 'count_loops', 'reverse_string']
+    route = []
+    sections = []
+    for j in xrange(num_filters):
+        ftype = ftypes[j % len(ftypes)]
+        route.append('%s%d >>>' % (ftype, j))
+        if ftype == 'tag_packet':
+            sections.append('[tag_packet%d]\n    tag_field_name = tag%d\n'
+                            '    tag_field_value = %d\n' % (j, j, j))
+    route.append('sink')
+    config = '''
+    [--main--]
+    ftype = transform_chain
+    description = Benchmark chain of %d filters with transform()
+    fuse = %s
+
+    %s
+    [--route--]
+    %s
+    ''' % (num_filters, fuse, '\n    '.join(sections), '\n    '.join(route))
+    return ppln.Pipeline(factory=ff.DemoFilterFactory(), config=config)
+
+def bench_fused_chain(num_filters=30, packets=20000):
+    """Time packets through a linear chain of filters, with each filter as a
+    coroutine and with the chain fused into one FusedFilters stage.
+    """
+    results = {}
+    for fuse in (False, True):
+        pipeline = make_transform_chain(num_filters, fuse)
+        start = time.time()
+        for j in xrange(packets):
+            pipeline.send(dfb.DataPacket('x' * 100))
+        pipeline.shut_down()
+        secs = time.time() - start
+        label = '%s, %d filters' % (('coroutines', 'fused')[fuse], 
+                                    num_filters)
+        print '%-40s %8.3f secs %8.1f us/packet' % (
+            label, secs, secs * 1e6 / packets)
+        results[fuse] = secs
+    return results
+
+def make_n_way_split(ways, route_by):
+    """Return a pipeline that sends packets to one of ways waste filters by
+    their colour, with a route_by filter or a chain of branch_if filters.
+    """
+    sections = []
+    if route_by:
+        route = 'route_by:colour >>> %s waste%d' % (' '.join(
+            '[%d: waste%d]' % (j, j) for j in xrange(ways - 1)), ways - 1)
+    else:
+        route = ' '.join('branch_if%d >>> (waste%d)' % (j, j) 
+                         for j in xrange(ways - 1)) + ' waste%d' % (ways - 1)
+        for j in xrange(ways - 1):
+            sections.append('[branch_if%d]\n    branch_key = colour\n'
+                            '    compare_value = %d\n' % (j, j))
+    config = '''
+    [--main--]
+    ftype = n_way_split
+    description = Benchmark %d-way split
+
+    %s
+    [--route--]
+    %s
+    ''' % (ways, '\n    '.join(sections), route)
+    return ppln.Pipeline(factory=ff.DemoFilterFactory(), config=config)
+
+def bench_route_by(ways=(2, 6, 20), packets=20000):
+    """Time an N-way split of packets by an attribute value, with a chain
+    of branch_if filters and with one route_by filter.
+    """
+    results = {}
+    for way_count in ways:
+        for route_by in (False, True):
+            pipeline = make_n_way_split(way_count, route_by)
+            start = time.time()
+            for j in xrange(packets):
+                pipeline.send(dfb.DataPacket('x', colour=j % way_count))
+            pipeline.shut_down()
+            secs = time.time() - start
+            label = '%s, %d ways' % (('branch_if chain', 'route_by')[route_by],
+                                     way_count)
+            print '%-40s %8.3f secs %8.1f us/packet' % (
+                label, secs, secs * 1e6 / packets)
+            results[(way_count, route_by)] = secs
+    return results
+
+def make_single_section(route, sections):
+    """Return a pipeline with the route and filter sections given.
+    """
+    config = '''
+    [--main--]
+    ftype = expression_test
+    description = Benchmark expressions
+
+    %s
+    [--route--]
+    %s
+    ''' % ('\n    '.join(sections), route)
+    return ppln.Pipeline(factory=ff.DemoFilterFactory(), config=config)
+
+def bench_expressions(packets=20000):
+    """Time branch_if and calculate with their original keys and with an
+    equivalent expr.
+    """
+    cases = [
+        ('branch_if, branch_key', 'branch_if >>> (waste1) waste2',
+         ['[branch_if]\n    branch_key = altitude\n'
+          '    comparison = greater_than\n    compare_value = 1000\n']),
+        ('branch_if, expr', 'branch_if >>> (waste1) waste2',
+         ['[branch_if]\n    expr = p.altitude > 1000\n']),
+        ('2 x branch_if, branch_key',
+         'branch_if1 >>> (branch_if2 >>> (waste1) waste2) waste3',
+         ['[branch_if1]\n    branch_key = altitude\n'
+          '    comparison = greater_than\n    compare_value = 1000\n',
+          '[branch_if2]\n    branch_key = speed\n'
+          '    comparison = less_than\n    compare_value = 200\n']),
+        ('branch_if, expr with and', 'branch_if >>> (waste1) waste2',
+         ['[branch_if]\n'
+          '    expr = p.altitude > 1000 and p.speed < f.compare_value\n'
+          '    compare_value = 200\n']),
+        ('calculate, lhs/rhs', 'calculate >>> waste',
+         ['[calculate]\n    lhs_value = altitude\n    operator = divide\n'
+          '    rhs_value = speed\n    param_result = ratio\n']),
+        ('calculate, expr', 'calculate >>> waste',
+         ['[calculate]\n    expr = float(p.altitude) / p.speed\n'
+          '    param_result = ratio\n']),
+        ]
+    results = {}
+    for label, route, sections in cases:
+        pipeline = make_single_section(route, sections)
+        start = time.time()
+        for j in xrange(packets):
+            pipeline.send(dfb.DataPacket('x', altitude=j % 2000, 
+                                         speed=j % 300 + 1))
+        pipeline.shut_down()
+        secs = time.time() - start
+        print '%-40s %8.3f secs %8.1f us/packet' % (
+            label, secs, secs * 1e6 / packets)
+        results[label] = secs
+    return results
+
+def bench_packet_cache(cases=((16, 0x100), (100000, 0x100), (16, 0x10000)),
+                       packets=20000):
+    """Time distill_header and reverse_string on packets with a few or many
+    different payloads, with and without cache_size. Each case is
+    (payloads, packet_size). The cache only pays for itself where the
+    filters do more work for a packet than looking it up, e.g. for the
+    larger packets.
+    """
+    results = {}
+    for payloads, packet_size in cases:
+        blocks = [make_test_data(packet_size, seed=j) 
+                  for j in xrange(min(payloads, packets))]
+        for cache_size in (0, 1000):
+            pipeline = make_single_section(
+                'distill_header >>> (waste) reverse_string >>> waste2',
+                ['[distill_header]\n    header_size = 16\n'
+                 '    pure = true\n    cache_size = %d\n' % 
+                 cache_size,
+                 '[reverse_string]\n    pure = true\n    cache_size = %d\n' %
+                 cache_size])
+            start = time.time()
+            for j in xrange(packets):
+                pipeline.send(dfb.DataPacket(blocks[j % len(blocks)]))
+            pipeline.shut_down()
+            secs = time.time() - start
+            label = '%d payloads of %d bytes, cache_size %d' % (
+                len(blocks), packet_size, cache_size)
+            print '%-48s %8.3f secs %8.1f us/packet' % (
+                label, secs, secs * 1e6 / packets)
+            results[(payloads, packet_size, cache_size)] = secs
+    return results
+
+def bench_thread_boundary(data_size=16 * 1024 * 1024):
+    """Time reading, bzip2 compressing and writing a file, all in one thread
+    and with a thread_boundary either side of the compression.
+    """
+    source_name = fut.random_file_name()
+    dest_name = fut.random_file_name('.bz2')
+    source = open(source_name, 'wb')
+    try:
+        source.write(make_test_data(data_size))
+    finally:
+        source.close()
+    route = 'read_batch:0x10000 >>> %sbzip_compress >>> %swrite_file'
+    results = {}
+    try:
+        for boundary in ('', 'thread_boundary%d:4 >>> '):
+            config = '''
+            [--main--]
+            ftype = compress_file
+            description = Benchmark compressing a file
+
+            [write_file]
+            dest_file_name = %s
+
+            [--route--]
+            %s
+            ''' % (dest_name, route % (boundary % 1 if boundary else '',
+                                       boundary % 2 if boundary else ''))
+            pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                     config=config)
+            start = time.time()
+            pipeline.send(dfb.DataPacket(source_name))
+            pipeline.shut_down()
+            secs = time.time() - start
+            label = ('one thread', 'thread boundaries')[bool(boundary)]
+            results[bool(boundary)] = _report(label, data_size, secs)
+    finally:
+        for file_name in (source_name, dest_name):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+    return results
+
+def bench_packet_serialisation(data_sizes=(100, 0x10000), 
+                               packets=20000):
+    """Time encoding and decoding typical data packets with the serialise
+    module and with cPickle, and compare the encoded sizes.
+    """
+    results = {}
+    for data_size in data_sizes:
+        packet = dfb.DataPacket('x' * data_size, seq_num=12345, 
+                                read_percent=42.5, read_bytes=1234567, 
+                                source_file_name='/data/flight_0042.dat',
+                                ends=[True, False])
+        coders = [
+            ('serialise', serialise.encode_packet, serialise.decode_packet),
+            ('cPickle', 
+             lambda p: cPickle.dumps(p, cPickle.HIGHEST_PROTOCOL), 
+             cPickle.loads),
+        ]
+        for name, encode, decode in coders:
+            start = time.time()
+            for j in xrange(packets):
+                encoded = encode(packet)
+            encode_secs = time.time() - start
+            start = time.time()
+            for j in xrange(packets):
+                decode(encoded)
+            decode_secs = time.time() - start
+            print '%-12s %6d bytes data %6d bytes out %8.2f us/encode ' \
+                  '%8.2f us/decode' % (
+                name, data_size, len(encoded), encode_secs * 1e6 / packets,
+                decode_secs * 1e6 / packets)
+            results[(name, data_size)] = (encode_secs, decode_secs)
+    return results
+
+def bench_range_split(data_size=32 * 1024 * 1024, frame_size=0x1000,
+                      worker_counts=None):
+    """Time bzip2 compressing a file of frames that start with a sync word,
+    with one pipeline and with a RangeSplitter running one pipeline for each
+    range in a pool of worker processes.
+    """
+    if worker_counts is None:
+        worker_counts = sorted(set([1, 2, 4, max(2, _cpu_count())]))
+    body = make_test_data(frame_size - 4)
+    source_name = fut.random_file_name()
+    dest_name = fut.random_file_name('.bz2')
+    source = open(source_name, 'wb')
+    try:
+        for j in xrange(data_size // frame_size):
+            source.write('SYNC' + body)
+    finally:
+        source.close()
+    config = '''
+    [--main--]
+    ftype = compress_frames
+    description = Benchmark compressing a file of frames
+
+    [read_batch]
+    batch_size = 0x10000
+
+    [write_file]
+    dest_file_name = %s
+
+    [--route--]
+    read_batch >>> bzip_compress >>> write_file
+    ''' % dest_name
+    results = {}
+    try:
+        start = time.time()
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                 config=config)
+        pipeline.send(dfb.DataPacket(source_name))
+        pipeline.shut_down()
+        results['serial'] = _report('one pipeline', data_size, 
+                                    time.time() - start)
+        for workers in worker_counts:
+            splitter = range_split.RangeSplitter(
+                config, ff.DemoFilterFactory(), source_name, 
+                sync=range_split.align_to_sync_word('SYNC'), workers=workers)
+            start = time.time()
+            splitter.run()
+            results['workers_%d' % workers] = _report(
+                'range split, %d workers' % workers, data_size, 
+                time.time() - start)
+    finally:
+        for file_name in (source_name, dest_name):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+    return results
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def run_all():
+    bench_bz2_compress()
+    bench_bz2_decompress()
+    bench_codecs()
+    bench_bottle_delivery()
+    bench_long_route()
+    bench_fused_chain()
+    bench_route_by()
+    bench_expressions()
+    bench_packet_cache()
+    bench_thread_boundary()
+    bench_packet_serialisation()
+    bench_range_split()
+
+if __name__ == '__main__':  #pragma: nocover
+    run_all()
@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+
+"""Compression helpers used by the compressing filters.
+
+ParallelBZ2Compressor has the same compress()/flush() interface as
+bz2.BZ2Compressor, so it can be swapped in wherever a compressor object is
+used. The input is cut into independent blocks which are compressed
+concurrently by a pool of threads (bz2 releases the GIL while compressing),
+and the results are returned strictly in input order. Each block becomes a
+complete bzip2 stream, so the output is a multi-stream .bz2 file of the kind
+written by pbzip2, which bzip2, pbzip2 and BZipDecompress can all read.
+
+BZ2StreamDecompressor and ParallelBZ2Decompressor read such multi-stream
+data back, serially or with a pool of threads, and BackgroundDecompressReader
+gives a file-like object whose contents are decompressed by a background
+thread, for ReadBatch to read compressed files directly.
+
+Each compression method is described by a Codec in the codecs registry,
+looked up by name with get_codec(). Compressors and decompressors made by
+a codec all have the compress()/flush() and decompress()/flush() interface
+of the bz2 objects. bzip2, zlib and gzip are always available, and lzma
+(.xz) when the lzma module can be imported. Further codecs can be added
+with register_codec().
+"""
+
+import bz2
+import collections
+import os
+import re
+import sys
+import threading
+import zlib
+import Queue
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# 900k is the bzip2 block size at level 9, so each stream is one bzip2 block
+k_default_block_size = 900000
+# Above this size, a stream with no boundary in sight is decompressed serially
+k_max_span_size = 0x800000
+
+# Stream header followed by the first block header, which is byte aligned
+# at the start of a stream. Later block headers in a stream are not byte
+# aligned, so a match elsewhere is very unlikely, but it is checked for.
+re_bz2_stream_start = re.compile(r'BZh[1-9]1AY&SY')
+k_bz2_magic_len = 10
+# ... or an empty stream
+re_bz2_magic = re.compile(r'BZh[1-9](1AY&SY|\x17rE8P\x90)')
+
+
+class ParallelBZ2Compressor(object):
+    """Compress data in blocks using a pool of worker threads.
+
+    block_size : bytes of input compressed as one independent stream.
+    workers : number of threads compressing at once.
+    max_in_flight : number of blocks allowed to be queued or compressing
+    before compress() waits for the oldest one. This bounds the memory
+    used when the data arrives faster than it can be compressed. Defaults to
+    twice the number of workers.
+    """
+
+    def __init__(self, compresslevel=9, block_size=k_default_block_size,
+                 workers=2, max_in_flight=None):
+        if block_size <= 0:
+            raise ValueError, 'block_size must be positive, not %s' % block_size
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.workers = max(1, workers)
+        self.max_in_flight = max(1, max_in_flight or 2 * self.workers)
+        self._pool = ThreadPool(self.workers)
+        self._pending = []
+        self._pending_size = 0
+        self._in_flight = collections.deque()
+        self._streams_written = 0
+
+    def _collect(self, wait_for_all=False):
+        """Return the compressed data for the blocks at the front of the
+        queue that have finished, waiting if there are too many in flight.
+        """
+        output = []
+        in_flight = self._in_flight
+        while in_flight:
+            if (wait_for_all or len(in_flight) > self.max_in_flight or
+                in_flight[0].ready()):
+                output.append(in_flight.popleft().get())
+            else:
+                break
+        self._streams_written += len(output)
+        return ''.join(output)
+
+    def _submit(self, block):
+        self._in_flight.append(self._pool.apply_async(
+            bz2.compress, (block, self.compresslevel)))
+
+    def close(self):
+        """Stop the worker threads, abandoning any blocks in flight."""
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._in_flight.clear()
+
+    def compress(self, data):
+        if self._pool is None:
+            raise ValueError, 'Compressor has been flushed'
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.block_size:
+            all_data = ''.join(self._pending)
+            block_size = self.block_size
+            full_len = len(all_data) - len(all_data) % block_size
+            for start in xrange(0, full_len, block_size):
+                self._submit(all_data[start:start + block_size])
+            remainder = all_data[full_len:]
+            self._pending = [remainder] if remainder else []
+            self._pending_size = len(remainder)
+        return self._collect()
+
+    def flush(self):
+        """Compress any remaining data, wait for all the blocks and return
+        the rest of the output. The compressor can't be used after this.
+        """
+        if self._pool is None:
+            raise ValueError, 'Compressor has been flushed'
+        if self._pending:
+            self._submit(''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+        try:
+            output = self._collect(wait_for_all=True)
+            if not self._streams_written:
+                # Match BZ2Compressor, which writes an empty stream
+                output = bz2.compress('', self.compresslevel)
+        finally:
+            self.close()
+        return output
+
+
+def make_bz2_compressor(compresslevel=9, workers=0,
+                        block_size=k_default_block_size, max_in_flight=0):
+    """Return a serial bz2.BZ2Compressor if workers is 0, or else a
+    ParallelBZ2Compressor.
+    """
+    if workers:
+        return ParallelBZ2Compressor(compresslevel, block_size, workers,
+                                     max_in_flight)
+    return bz2.BZ2Compressor(compresslevel)
+
+
+def _bz2_stream_ended(decompressor):
+    """Has the bz2.BZ2Decompressor reached the end of its stream?"""
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return True
+    return False
+
+def _decompress_span(span):
+    """Decompress a span of whole streams, returning (data, True), or
+    (None, False) if the span doesn't end at the end of a stream, i.e. a
+    false boundary was found. The data is not checked further in that case.
+    """
+    decompressor = BZ2StreamDecompressor()
+    try:
+        data = decompressor.decompress(span)
+    except IOError:
+        return None, False
+    if decompressor.at_stream_end():
+        return data, True
+    return None, False
+
+
+class StreamDecompressor(object):
+    """Decompress concatenated streams, as bunzip2 and gunzip do, starting
+    a new decompressor from make_decompressor() at the end of each stream.
+    """
+
+    def __init__(self, make_decompressor):
+        self.make_decompressor = make_decompressor
+        self._decompressor = make_decompressor()
+
+    def decompress(self, data):
+        output = []
+        while data:
+            try:
+                output.append(self._decompressor.decompress(data))
+            except EOFError:
+                # The last stream ended exactly at the end of the last data
+                self._decompressor = self.make_decompressor()
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self.make_decompressor()
+        return ''.join(output)
+
+    def flush(self):
+        flush = getattr(self._decompressor, 'flush', None)
+        if flush:
+            return flush()
+        return ''
+
+
+class BZ2StreamDecompressor(StreamDecompressor):
+    """Decompress concatenated bzip2 streams."""
+
+    def __init__(self):
+        StreamDecompressor.__init__(self, bz2.BZ2Decompressor)
+
+    def at_stream_end(self):
+        return _bz2_stream_ended(self._decompressor)
+
+
+class ParallelBZ2Decompressor(object):
+    """Decompress multi-stream bzip2 data using a pool of worker threads.
+
+    The input is scanned for stream headers, and each span of data between
+    two headers is decompressed by a worker. Output is returned strictly in
+    input order. If a span turns out not to end a stream, because the header
+    pattern happened to occur inside compressed data, that stream and the
+    rest of the data in hand are decompressed serially, and scanning starts
+    again after the end of the stream. Input with no stream boundary within
+    max_span_size bytes, e.g. a file from the serial bzip2 program, is
+    decompressed serially too, so that it isn't all held in memory.
+    """
+
+    def __init__(self, workers=2, max_in_flight=None,
+                 max_span_size=k_max_span_size):
+        self.workers = max(1, workers)
+        self.max_in_flight = max(1, max_in_flight or 2 * self.workers)
+        self.max_span_size = max_span_size
+        self._pool = ThreadPool(self.workers)
+        self._in_flight = collections.deque()
+        # Serial decompressor, used only while inside a stream
+        self._serial = None
+        self._pieces = []
+        self._size = 0
+        self._tail = ''
+
+    def _collect(self, output, wait_for_all=False):
+        """Append the output of the finished spans at the front of the queue
+        to output. Return any data that now needs decompressing serially.
+        """
+        in_flight = self._in_flight
+        while in_flight:
+            span, result = in_flight[0]
+            if not (wait_for_all or len(in_flight) > self.max_in_flight or
+                    result.ready()):
+                break
+            in_flight.popleft()
+            data, complete = result.get()
+            if complete:
+                output.append(data)
+            else:
+                # False boundary, so go back to where the stream started.
+                # Any results from the following spans are discarded.
+                spans = [span] + [span2 for span2, result2 in in_flight]
+                in_flight.clear()
+                spans.append(self._take_buffer())
+                self._serial = bz2.BZ2Decompressor()
+                return ''.join(spans)
+        return ''
+
+    def _feed_serial(self, data, output):
+        """Decompress data serially until the current stream ends, and
+        return the data left over after the end of the stream.
+        """
+        try:
+            output.append(self._serial.decompress(data))
+        except EOFError:
+            # Stream ended exactly at the end of the previous data
+            self._serial = None
+            return data
+        leftover = self._serial.unused_data
+        if leftover:
+            self._serial = None
+        return leftover
+
+    def _process(self, data, output):
+        while data:
+            if self._serial:
+                data = self._feed_serial(data, output)
+                continue
+            self._scan(data)
+            data = self._collect(output)
+            if not data and self._size > self.max_span_size:
+                data = self._collect(output, wait_for_all=True)
+                if not data:
+                    # One long stream: there's nothing to be gained by
+                    # waiting for the end of it.
+                    self._serial = bz2.BZ2Decompressor()
+                    data = self._take_buffer()
+
+    def _scan(self, data):
+        """Add data to the buffer, and send off any complete spans."""
+        text = self._tail + data
+        base = self._size - len(self._tail)
+        cuts = [base + match.start() 
+                for match in re_bz2_stream_start.finditer(text)
+                if base + match.start() > 0]
+        self._pieces.append(data)
+        self._size += len(data)
+        self._tail = text[1 - k_bz2_magic_len:]
+        if cuts:
+            all_data = self._take_buffer()
+            prev_cut = 0
+            for cut in cuts:
+                self._submit(all_data[prev_cut:cut])
+                prev_cut = cut
+            remainder = all_data[prev_cut:]
+            self._pieces = [remainder]
+            self._size = len(remainder)
+            self._tail = remainder[1 - k_bz2_magic_len:]
+
+    def _submit(self, span):
+        self._in_flight.append(
+            (span, self._pool.apply_async(_decompress_span, (span,))))
+
+    def _take_buffer(self):
+        data = ''.join(self._pieces)
+        self._pieces = []
+        self._size = 0
+        self._tail = ''
+        return data
+
+    def close(self):
+        """Stop the worker threads, abandoning any spans in flight."""
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._in_flight.clear()
+
+    def decompress(self, data):
+        if self._pool is None:
+            raise ValueError, 'Decompressor has been flushed'
+        output = []
+        self._process(data, output)
+        return ''.join(output)
+
+    def flush(self):
+        """Decompress the last span and return all the remaining output.
+        As with bz2.BZ2Decompressor, a truncated last stream is not an error.
+        """
+        if self._pool is None:
+            raise ValueError, 'Decompressor has been flushed'
+        output = []
+        try:
+            while True:
+                if not self._serial and self._size:
+                    self._submit(self._take_buffer())
+                data = self._collect(output, wait_for_all=True)
+                if not data:
+                    break
+                self._process(data, output)
+        finally:
+            self.close()
+        return ''.join(output)
+
+
+def make_bz2_decompressor(workers=0, max_in_flight=0):
+    """Return a serial BZ2StreamDecompressor if workers is 0, or else a
+    ParallelBZ2Decompressor. Both read multi-stream data.
+    """
+    if workers:
+        return ParallelBZ2Decompressor(workers, max_in_flight)
+    return BZ2StreamDecompressor()
+
+class Codec(object):
+    """Description of a compression method.
+
+    make_compressor(level, **options) and make_decompressor(**options)
+    return new streaming objects. Options not used by the codec, e.g.
+    workers for zlib, are ignored. extension includes the dot. magic is
+    a compiled regex matching the start of compressed data, used by
+    detect_compression(). Levels run from 1 (fastest) to 9 (smallest).
+    """
+
+    def __init__(self, name, extension, make_compressor, make_decompressor,
+                 default_level, magic=None, aliases=()):
+        self.name = name
+        self.extension = extension
+        self._make_compressor = make_compressor
+        self._make_decompressor = make_decompressor
+        self.default_level = default_level
+        self.magic = magic
+        self.aliases = aliases
+
+    def __repr__(self):
+        return 'Codec(%s)' % self.name
+
+    def compressor(self, level=None, **options):
+        if level is None:
+            level = self.default_level
+        if not 1 <= level <= 9:
+            raise ValueError, 'Compression level for %s must be 1 to 9, not %s' % (
+                self.name, level)
+        return self._make_compressor(level, **options)
+
+    def decompressor(self, **options):
+        return self._make_decompressor(**options)
+
+
+# Name or alias --> Codec
+codecs = {}
+
+def register_codec(new_codec):
+    for name in (new_codec.name,) + tuple(new_codec.aliases):
+        codecs[name] = new_codec
+
+def get_codec(name):
+    """Return the Codec with this name or alias, raising ValueError if
+    there isn't one.
+    """
+    try:
+        return codecs[str(name).lower()]
+    except KeyError:
+        raise ValueError, "Compression '%s' not supported. Use one of %s" % (
+            name, ', '.join(sorted(codecs)))
+
+def codec_for_file_name(file_name):
+    """Return the Codec used for files with this extension, or None."""
+    ext = os.path.splitext(file_name or '')[1].lower()
+    for each_codec in codecs.itervalues():
+        if each_codec.extension == ext:
+            return each_codec
+    return None
+
+def detect_compression(head):
+    """Return the name of the codec used, from the first bytes of the
+    data, or None if it isn't recognised.
+    """
+    for name, each_codec in sorted(codecs.iteritems()):
+        if each_codec.magic and each_codec.magic.match(head):
+            return each_codec.name
+    return None
+
+def _bz2_compressor(level, workers=0, block_size=k_default_block_size,
+                    max_in_flight=0, **options):
+    return make_bz2_compressor(level, workers, block_size, max_in_flight)
+
+def _bz2_decompressor(workers=0, max_in_flight=0, **options):
+    return make_bz2_decompressor(workers, max_in_flight)
+
+def _zlib_compressor(wbits):
+    return lambda level, **options: zlib.compressobj(level, zlib.DEFLATED, 
+                                                     wbits)
+
+def _zlib_decompressor(wbits):
+    return lambda **options: StreamDecompressor(
+        lambda: zlib.decompressobj(wbits))
+
+register_codec(Codec('bzip2', '.bz2', _bz2_compressor, _bz2_decompressor, 9,
+                     re_bz2_magic, aliases=('bzip', 'bz2')))
+register_codec(Codec('zlib', '.zz', _zlib_compressor(zlib.MAX_WBITS), 
+                     _zlib_decompressor(zlib.MAX_WBITS), 6))
+# zlib has no magic that is safe to detect: 'x^' could start a text file.
+# wbits + 16 for the gzip header and trailer
+register_codec(Codec('gzip', '.gz', _zlib_compressor(16 + zlib.MAX_WBITS),
+                     _zlib_decompressor(16 + zlib.MAX_WBITS), 6,
+                     re.compile(r'\x1f\x8b'), aliases=('gz',)))
+if lzma:
+    register_codec(Codec(
+        'lzma', '.xz', 
+        lambda level, **options: lzma.LZMACompressor(preset=level),
+        lambda **options: StreamDecompressor(lzma.LZMADecompressor),
+        6, re.compile(r'\xfd7zXZ\x00'), aliases=('xz',)))
+
+
+class BackgroundDecompressReader(object):
+    """Read-only file-like object giving the decompressed contents of a
+    compressed file object. A background thread reads and decompresses
+    read_size blocks ahead of the reader, holding at most queue_size
+    decompressed chunks. compressed_bytes_read is the position in the
+    compressed file of the data returned so far, e.g. to show progress.
+    Errors in the thread are raised by read().
+    """
+    _end_marker = object()
+
+    def __init__(self, file_obj, decompressor, read_size=0x100000,
+                 queue_size=8):
+        self.file_obj = file_obj
+        self.name = getattr(file_obj, 'name', None)
+        self.decompressor = decompressor
+        self.read_size = read_size
+        self.compressed_bytes_read = 0
+        self._queue = Queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._data = ''
+        self._eof = False
+        self._thread = threading.Thread(target=self._produce,
+                                        name='decompress_%s' % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self):
+        raw_pos = 0
+        try:
+            while not self._stop.is_set():
+                raw = self.file_obj.read(self.read_size)
+                if not raw:
+                    self._put((self.decompressor.flush(), raw_pos))
+                    break
+                raw_pos += len(raw)
+                self._put((self.decompressor.decompress(raw), raw_pos))
+        except Exception:
+            self._put(sys.exc_info())
+        self._put(self._end_marker)
+
+    def _put(self, item):
+        # Don't block forever if the reader has gone away
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    @property
+    def closed(self):
+        return self.file_obj.closed
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.file_obj.close()
+        if hasattr(self.decompressor, 'close'):
+            self.decompressor.close()
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._data) < size):
+            item = self._queue.get()
+            if item is self._end_marker:
+                self._eof = True
+            elif len(item) == 3:
+                err_type, err_value, err_traceback = item
+                self._eof = True
+                raise err_type, err_value, err_traceback
+            else:
+                data, self.compressed_bytes_read = item
+                self._data += data
+        if size < 0:
+            size = len(self._data)
+        result = self._data[:size]
+        self._data = self._data[size:]
+        return result
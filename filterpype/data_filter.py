@@ -4,22 +4,51 @@
 # TO-DO: Check that ftype class attribute matches the obj made
 
 import sys
+import collections
+import errno
 import hashlib
+import heapq
 import bz2
+import multiprocessing
 import os
 import time
 import re
 import new
+import operator
+import socket
+import threading
+import traceback
 # configobj used by WriteConfigObjFile
 import configobj
 
 import filterpype.filter_utils as fut
 import filterpype.data_fltr_base as dfb
 import filterpype.embed as embed
+import filterpype.codec as codec
+import filterpype.expression as expression
+import filterpype.parallel as parallel
 
 re_python_key_sub = re.compile(r'\${\b([a-z][a-z0-9_]*)\b}')
 
 
+def _get_seq_num(packet, seq_field_name):
+    """Return the sequence number of the packet, for Merge and Reorder.
+    """
+    try:
+        return getattr(packet, seq_field_name)
+    except AttributeError:
+        raise dfb.DataError, 'Packet has no sequence number "%s"' % (
+            seq_field_name)
+
+def _join_expr(expr):
+    """Return the expression text of an expr key. ConfigObj splits a value
+    with unquoted commas into a list, e.g. "max(p.a, p.b) > 3".
+    """
+    if isinstance(expr, list):
+        return ', '.join(expr)
+    return expr
+
+
 class AttributeChangeDetection(dfb.DataFilter):
     """
 Examines a list of attributes for change in value. Sets the
@@ -197,6 +226,7 @@ class Batch(dfb.DataFilter):
     """
     ftype = 'batch'
     keys = ['size', 'fork_dest:main']
+    side_effects = False
 
     def _init_input(self, data=''):
         """Reset the inputs list to nothing, or whatever was left over from
@@ -281,6 +311,7 @@ class BranchClone(dfb.DataFilter):
     filter, i.e. "(" in the route.
     """
     ftype = 'branch_clone'
+    side_effects = False
 
     def filter_data(self, packet):
         # N.B. Branch always goes first!
@@ -329,32 +360,56 @@ class BranchIf(dfb.DataFilter):
     """Decide on branching, dependent of the name of an attribute
     'branch_key', found either in the filter or the packet. Optional key is
     'branch_on_packet', with default of True. If branch_on_packet is False,
-    then use filter instead of packet. If the attribute is not present, a
-    KeyError will be raised. BranchIf should be followed by HiddenBranchRoute
-    filter, i.e. "(" in route.
+    then use filter instead of packet. If the attribute is not present, an
+    AttributeError will be raised. BranchIf should be followed by
+    HiddenBranchRoute filter, i.e. "(" in route.
+
+    Instead of branch_key, an expression may be given, e.g.
+
+        expr = p.altitude > 1000 and p.speed < f.compare_value
+
+    where "p" is the packet and "f" is this filter, of which only the keys
+    may be used. See expression.py. The packet is sent to the branch if the
+    expression is true.
     """
     ftype = 'branch_if'
-    keys = ['branch_key', 'comparison:equals', 'compare_value:true',
-            'branch_on_packet:true']
+    keys = ['branch_key:none', 'comparison:equals', 'compare_value:true',
+            'branch_on_packet:true', 'expr:none']
+    param_dependencies = dict(branch_key=['init_filter'],
+                              comparison=['init_filter'],
+                              branch_on_packet=['init_filter'],
+                              expr=['init_filter'])
 
-    def filter_data(self, packet):
+    comparisons = dict(equals=operator.eq, less_than=operator.lt,
+                       greater_than=operator.gt, not_equals=operator.ne)
+
+    def init_filter(self):
+        # Make the test once, rather than looking up the comparison for each
+        # packet. compare_value is still read for each packet, as it may be
+        # changed directly.
+        if self.expr:
+            self._branch_test = expression.compile_expression(
+                _join_expr(self.expr), self._keys)
+            return
+        if not self.branch_key:
+            msg = 'Filter "%s" needs a branch_key or an expr'
+            raise dfb.FilterAttributeError, msg % self.name
+        try:
+            compare = self.comparisons[self.comparison]
+        except KeyError:
+            raise dfb.FilterAttributeError, 'Unknown comparison "%s"' % (
+                self.comparison)
+        get_value = operator.attrgetter(self.branch_key)
         if self.branch_on_packet:
-            lhs_value = getattr(packet, self.branch_key)
-        else:
-            lhs_value = getattr(self, self.branch_key)
-
-        if self.comparison == 'equals':
-            result = lhs_value == self.compare_value
-        elif self.comparison == 'less_than':
-            result = lhs_value < self.compare_value
-        elif self.comparison == 'greater_than':
-            result = lhs_value > self.compare_value
-        elif self.comparison == 'not_equals':
-            result = lhs_value != self.compare_value
+            def branch_test(packet, afilter):
+                return compare(get_value(packet), afilter.compare_value)
         else:
-            raise FilterLogicError, 'Unknown comparison "%s"' % (
-                comparison)
-        if result:
+            def branch_test(packet, afilter):
+                return compare(get_value(afilter), afilter.compare_value)
+        self._branch_test = branch_test
+
+    def filter_data(self, packet):
+        if self._branch_test(packet, self):
             self.send_on(packet, 'branch')
         else:
             self.send_on(packet, 'main')
@@ -430,11 +485,22 @@ class BreakPoint(dfb.DataFilter):
         place_break_point_here = None
         self.send_on(packet)
         
-class BZipCompress(dfb.DataFilter):
-    """Take the input stream and compress it using bzip2 compression object.
-       Use level 9 for large files (this is the default).
+class Compress(dfb.DataFilter):
+    """Take the input stream and compress it with a codec from the codec
+       module: bzip2 (the default), zlib, gzip, or lzma if available.
+       compress_level runs from 1 (fastest) to 9 (smallest), defaulting to
+       the codec's usual level.
+
+       workers : bzip2 only. If not 0, the number of threads compressing
+       block_size blocks in parallel, giving multi-stream output as written
+       by pbzip2. At most max_in_flight blocks (default 2 * workers) are held
+       waiting.
     """
-    ftype = 'bzip_compress'
+    ftype = 'compress'
+    keys = ['codec:bzip2', 'compress_level:none', 'workers:0', 
+            'block_size:900000',
+            'max_in_flight:0']
+    compressor = None
 
     def filter_data(self, packet):
         packet.data = self.compressor.compress(packet.data)
@@ -445,20 +511,69 @@ class BZipCompress(dfb.DataFilter):
         self.send_on(dfb.DataPacket(self.compressor.flush()))
 
     def zero_inputs(self):
-        self.compressor = bz2.BZ2Compressor()
-
-
-class BZipDecompress(dfb.DataFilter):
-    """Take the input stream and decompresses it using bzip2.
+        # A parallel compressor's worker threads are stopped before it is
+        # replaced, rather than left running for each reset
+        if hasattr(self.compressor, 'close'):
+            self.compressor.close()
+        try:
+            self.compressor = codec.get_codec(self.codec).compressor(
+                self.compress_level, workers=self.workers, block_size=self.block_size,
+                max_in_flight=self.max_in_flight)
+        except ValueError, err:
+            raise dfb.FilterAttributeError, str(err)
+
+
+class Decompress(dfb.DataFilter):
+    """Take the input stream and decompress it with a codec from the codec
+       module. Concatenated streams, e.g. as written by pbzip2 or by
+       Compress with workers, are all decompressed.
+
+       workers : bzip2 only. If not 0, the number of threads decompressing
+       separate streams in parallel. Output is still sent on in the original
+       order. At most max_in_flight streams (default 2 * workers) are held
+       waiting.
     """
-    ftype = 'bzip_decompress'
+    ftype = 'decompress'
+    keys = ['codec:bzip2', 'workers:0', 'max_in_flight:0']
+    decompressor = None
 
     def filter_data(self, packet):
         decompr_data = self.decompressor.decompress(packet.data)
-        self.send_on(packet.clone(data=decompr_data))
+        # Not clone(data=decompr_data), which keeps the compressed data if
+        # nothing has been decompressed yet
+        decompr_packet = packet.clone()
+        decompr_packet.data = decompr_data
+        self.send_on(decompr_packet)
+
+    def flush_buffer(self):
+        """Send on the output still held by a parallel decompressor"""
+        decompr_data = self.decompressor.flush()
+        if decompr_data:
+            self.send_on(dfb.DataPacket(decompr_data))
 
     def zero_inputs(self):
-        self.decompressor = bz2.BZ2Decompressor()
+        if hasattr(self.decompressor, 'close'):
+            self.decompressor.close()
+        try:
+            self.decompressor = codec.get_codec(self.codec).decompressor(
+                workers=self.workers, max_in_flight=self.max_in_flight)
+        except ValueError, err:
+            raise dfb.FilterAttributeError, str(err)
+
+
+class BZipCompress(Compress):
+    """Take the input stream and compress it using bzip2 compression object.
+       Use level 9 for large files (this is the default). See Compress for
+       parallel compression.
+    """
+    ftype = 'bzip_compress'
+
+
+class BZipDecompress(Decompress):
+    """Take the input stream and decompresses it using bzip2, including
+       multi-stream data. See Decompress for parallel decompression.
+    """
+    ftype = 'bzip_decompress'
 
 
 class CalcSlope(dfb.DataFilter):
@@ -478,6 +593,12 @@ class CalcSlope(dfb.DataFilter):
     """
     ftype = 'calc_slope'
     keys = ['calc_source_name', 'calc_name_suffix:slope']
+    param_dependencies = dict(calc_source_name=['_set_calc_param_name'],
+                              calc_name_suffix=['_set_calc_param_name'])
+
+    def _set_calc_param_name(self):
+        self.calc_param_name = '%s_%s' % (self.calc_source_name, 
+                                          self.calc_name_suffix)
 
     def filter_data(self, grouping_packet):
         vals = [getattr(pkt, self.calc_source_name) 
@@ -493,67 +614,89 @@ class CalcSlope(dfb.DataFilter):
         self.send_on(grouping_packet)
 
     def init_filter(self):
-        self.calc_param_name = '%s_%s' % (self.calc_source_name, 
-                                          self.calc_name_suffix)
+        self._set_calc_param_name()
 
 
 class Calculate(dfb.DataFilter):
-    """ Simple calculator for two numbers
+    """ Simple calculator for two numbers. lhs_value and rhs_value are
+    each either a number, or the name of a packet attribute holding one.
+    The result is written to the packet attribute param_result.
+
+    Instead, an expression may be given, e.g.
+
+        expr = (p.distance - p.start_distance) / p.duration
+
+    where "p" is the packet and "f" is this filter, of which only the keys
+    may be used. See expression.py.
     """
     ftype = 'calculate'
-    keys = ['lhs_value', 'operator:add', 'rhs_value', 'param_result']
+    keys = ['lhs_value:none', 'operator:add', 'rhs_value:none',
+            'param_result', 'expr:none']
+    param_dependencies = dict(lhs_value=['init_filter'],
+                              operator=['init_filter'],
+                              rhs_value=['init_filter'],
+                              expr=['init_filter'])
 
-    def filter_data(self, packet):
-        if hasattr(packet, self.param_result):
-            msg = 'Packet attribute "%s" already has values and can\'t be reset'
-            raise dfb.FilterAttributeError, msg % self.param_result
+    operators = dict(add=operator.add, subtract=operator.sub,
+                     multiply=operator.mul)
 
-        # This is a proof of concept idea.
-        # This will hpoefully, look in the packet for parameter names matching
-        # the lhs and rhs input name. If found then it will take the values from
-        # the packet attributes named.
+    def init_filter(self):
+        # Make the calculation once, so that for each packet only the packet
+        # attributes used need to be looked up.
+        if self.expr:
+            self._calculate = expression.compile_expression(
+                _join_expr(self.expr), self._keys)
+            return
+        if self.lhs_value is None or self.rhs_value is None:
+            msg = 'Filter "%s" needs lhs_value and rhs_value, or an expr'
+            raise dfb.FilterAttributeError, msg % self.name
+        if self.operator == 'divide':
+            calc = self._divide
+        else:
+            try:
+                calc = self.operators[self.operator]
+            except KeyError:
+                raise dfb.FilterAttributeError, 'Unknown operator "%s"' % (
+                    self.operator)
+        get_lhs = self._operand_getter(self.lhs_value)
+        get_rhs = self._operand_getter(self.rhs_value)
+        def calculate(packet, afilter):
+            return calc(get_lhs(packet), get_rhs(packet))
+        self._calculate = calculate
+
+    def _divide(self, lhs, rhs):
+        # Make sure the user is not trying to divide by zero
         try:
-            self.lhs_value + ''
-            if hasattr(packet, self.lhs_value):
-                self.lhs_value = getattr(packet, self.lhs_value)
-        except TypeError:
-            pass
-
+            return float(lhs) / float(rhs)
+        except ZeroDivisionError:
+            raise dfb.FilterLogicError, 'Cannot divide by zero %s, %s' % (
+                str(lhs), str(rhs))
+
+    def _operand_getter(self, value):
+        """Return a function of the packet returning the operand: value
+        itself if it is a number, otherwise the packet attribute it names.
+        """
         try:
-            self.rhs_value + ''
-            if hasattr(packet, self.rhs_value):
-                self.rhs_value = getattr(packet, self.rhs_value)
+            value + 1
+            return lambda packet: value
         except TypeError:
             pass
-        # --- end proof of concept
-
-
-        try:
-            self.lhs_value + 1
-            self.rhs_value + 1
-        except TypeError:
-            msg = 'One or more attributes "%s %s" are not a number'
-            raise dfb.FilterAttributeError, msg % (
-                self.lhs_value, self.rhs_value)
-
-        setattr(packet, self.param_result, self._do_calc(packet.data))
-        self.send_on(packet)
-
-    def _do_calc(self, packet):
-        if self.operator == 'add':
-            result = self.lhs_value + self.rhs_value
-        elif self.operator == 'subtract':
-            result = self.lhs_value - self.rhs_value
-        elif self.operator == 'multiply':
-            result = self.lhs_value * self.rhs_value
-        elif self.operator == 'divide':
-            # Make sure the user is not trying to divide by zero
+        def get_attribute(packet):
             try:
-                result = float(self.lhs_value) / float(self.rhs_value)
-            except ZeroDivisionError:
-                raise dfb.FilterLogicError, 'Cannot divide by zero %s, %s' % (
-                    str(self.lhs_value), str(self.rhs_value))
-        return result
+                attr_value = getattr(packet, value)
+                attr_value + 1
+            except (AttributeError, TypeError):
+                msg = 'Operand "%s" is not a number or a number attribute'
+                raise dfb.FilterAttributeError, msg % value
+            return attr_value
+        return get_attribute
+
+    def transform(self, packet):
+        if hasattr(packet, self.param_result):
+            msg = 'Packet attribute "%s" already has values and can\'t be reset'
+            raise dfb.FilterAttributeError, msg % self.param_result
+        setattr(packet, self.param_result, self._calculate(packet, self))
+        return packet
 
 
 class CallbackOnAttribute(dfb.DataFilter):
@@ -599,12 +742,46 @@ class CallbackOnAttribute(dfb.DataFilter):
     
     print_when_callback allows you to aid your debugging by printing to stdout
     when a callback is made
+
+    async_callback makes the callbacks from a background thread, so that a
+    slow callback doesn't stall the pipeline. Callbacks are still made in
+    order, each with a copy of the environ at the time. At most
+    callback_queue_size callbacks wait to be made; overflow_policy is
+    'block', 'drop_oldest' or 'coalesce' (replace the latest waiting
+    callback for the same message). All waiting callbacks are made before
+    the filter finishes closing. An exception from a callback is raised in
+    the pipeline by the next packet to make a callback, or on closing, and
+    no more callbacks are made. See fut.CallbackDispatcher.
     """
     ftype = 'callback_on_attribute'
     keys = ['watch_attr', 'callback', 'environ:none', 'count_to_confirm:1', 
             'num_watch_pkts:none', 'allowed_inconsistencies:0',
             'watch_for_change:false', 'include_in_environ:[]',
-            'close_when_found:false', 'print_when_callback:false']
+            'close_when_found:false', 'print_when_callback:false',
+            'async_callback:false', 'callback_queue_size:100',
+            'overflow_policy:block']
+
+    def _make_callback(self, message):
+        if not self.async_callback:
+            self.callback(message, **self.environ)
+            return
+        if self._dispatcher is None:
+            self._dispatcher = fut.CallbackDispatcher(
+                self.callback_queue_size, self.overflow_policy,
+                name='%s_callbacks' % self.name)
+            self._dispatcher.start()
+        self._dispatcher.dispatch(message, self.callback, message,
+                                  **dict(self.environ))
+
+    def _finish_callbacks(self):
+        """Wait for any queued asynchronous callbacks to be made. This must
+        be done before shutting down the pipeline from within filter_data(),
+        because close_filter() can't be called while the generator is busy.
+        """
+        if self._dispatcher:
+            dispatcher = self._dispatcher
+            self._dispatcher = None
+            dispatcher.finish()
 
     def _populate_environ(self, packet):
         # add required keys to the environment where they are available
@@ -659,7 +836,7 @@ class CallbackOnAttribute(dfb.DataFilter):
                     #self.environ[self.watch_attr] = value
                     self.attribute_found = True
                     self.prev_value = value
-                    self.callback('found:' + self.watch_attr, **self.environ)
+                    self._make_callback('found:' + self.watch_attr)
                     if self.print_when_callback:
                         print "found '%s': %s" % (self.watch_attr, value)
                     if not packet.message: self.send_on(packet)
@@ -667,6 +844,7 @@ class CallbackOnAttribute(dfb.DataFilter):
                     # shutdown after the attribute is found
                     if self.close_when_found and self.pipeline:
                         self.refinery.return_value = 'found'
+                        self._finish_callbacks()
                         self.pipeline.shut_down()
                     return
                 else:
@@ -681,12 +859,13 @@ class CallbackOnAttribute(dfb.DataFilter):
                 # We have had too many inconsistent values
                 self._populate_environ(packet)
                 self.environ['values_found'] = self.value_dict.keys()
-                self.callback('inconsistency_value_exceeded:' + self.watch_attr,
-                              **self.environ)
+                self._make_callback('inconsistency_value_exceeded:' + 
+                                    self.watch_attr)
                 self.inconsistent_callback_made = True
                 self.value_dict = {value:1}
                 if self.close_when_found and self.pipeline:
                     self.refinery.return_value = 'inconsistant'
+                    self._finish_callbacks()
                     self.pipeline.shut_down()
                     return
 
@@ -697,17 +876,18 @@ class CallbackOnAttribute(dfb.DataFilter):
                 self.attribute_found = True
                 ##self.environ[self.watch_attr] = value
                 self._populate_environ(packet)
-                self.callback('found:' + self.watch_attr, **self.environ)
+                self._make_callback('found:' + self.watch_attr)
                 # If the pipeline does not need to do anything else, let it
                 # shutdown after the attribute is found
                 if self.close_when_found and self.pipeline:
+                    self._finish_callbacks()
                     self.pipeline.shut_down()
         except AttributeError:
             ### Moved below...
             ##if self.pkt_count == self.num_watch_pkts\
                 ##and not self.attribute_found:
                 ### we've not found the packet
-                ##self.callback('not_found:' + self.watch_attr, **self.environ)
+                ##self._make_callback('not_found:' + self.watch_attr)
             # We need to set value to something, after an AttributeError,
             # to avoid "UnboundLocalError: local variable 'value' 
             #           referenced before assignment"
@@ -721,7 +901,7 @@ class CallbackOnAttribute(dfb.DataFilter):
            and not self.attribute_found:
             # we've not found the packet
             self._populate_environ(packet)
-            self.callback('not_found:' + self.watch_attr, **self.environ)
+            self._make_callback('not_found:' + self.watch_attr)
 
         if not packet.message: self.send_on(packet)
 
@@ -743,6 +923,13 @@ class CallbackOnAttribute(dfb.DataFilter):
         except AttributeError:
             raise TypeError('Environ must be a dictionary\nFound: %s : %s' % (
                 type(self.environ), self.environ ) )
+        if self.overflow_policy not in fut.CallbackDispatcher.overflow_policies:
+            raise dfb.FilterAttributeError, \
+                  "%s: overflow_policy must be one of %s, not '%s'" % (
+                      self.name, 
+                      ', '.join(fut.CallbackDispatcher.overflow_policies),
+                      self.overflow_policy)
+        self._dispatcher = None
 
     def open_message_bottle(self, msg_bottle):
         """
@@ -771,8 +958,9 @@ class CallbackOnAttribute(dfb.DataFilter):
         """
         if not self.attribute_found and self.num_watch_pkts == None \
            and self.refinery.return_value != 'inconsistant':
-            self.callback('not_found:' + self.watch_attr, **self.environ)
+            self._make_callback('not_found:' + self.watch_attr)
             self.refinery.return_value = 'not_found'
+        self._finish_callbacks()
 
 
 class CallbackOnMultipleAttributes(dfb.DataFilter):
@@ -966,6 +1154,9 @@ class CollectData(dfb.DataFilter):
     """Record data from each passing packet, until a maximum collection
     size is reached. Then send to the branch a packet with data of all the
     values in a list.
+
+    There are no state_attrs, as collections made from parts of the data
+    can't be merged into those that one filter would have sent.
     """
     ftype = 'collect_data'
     keys = ['collection_size:5']
@@ -989,6 +1180,9 @@ class CountBytes(dfb.DataFilter):
     ftype = 'count_bytes'
     keys = ['count_bytes_field_name:counted_bytes']
     
+    def _get_state_attrs(self):
+        return [self.count_bytes_field_name, 'counted_packets']
+    state_attrs = property(_get_state_attrs)
 
     def filter_data(self, packet):  
         cbfn = self.count_bytes_field_name
@@ -1021,13 +1215,13 @@ class CountLoops(dfb.DataFilter):
     ftype = 'count_loops'
     keys = ['count_loops_field_name:loop_num']
 
-    def filter_data(self, packet):
+    def transform(self, packet):
         clfn = self.count_loops_field_name
         try:
             packet.__dict__[clfn] = packet.__dict__[clfn] + 1
         except KeyError:
             packet.__dict__[clfn] = 1
-        self.send_on(packet)
+        return packet
 
 
 class CountPackets(dfb.DataFilter):
@@ -1038,6 +1232,10 @@ class CountPackets(dfb.DataFilter):
     keys = ['count_packets_field_name:counted_packets',
             'include_message_bottles:false']
 
+    def _get_state_attrs(self):
+        return [self.count_packets_field_name]
+    state_attrs = property(_get_state_attrs)
+
     def filter_data(self, packet): 
         cpfn = self.count_packets_field_name
         self.__dict__[cpfn] = self.__dict__[cpfn] + 1
@@ -1063,6 +1261,7 @@ class DataLength(dfb.DataFilter):
     ftype = 'data_length'
     keys = ['not_data:0x00', 'msg_destin:callback_on_attribute',
             'single_use:true']
+    state_attrs = ['bytes_seen', 'data_last_seen']
 
     def filter_data(self, packet):
         # strip off the stuff that isn't classed as data
@@ -1085,6 +1284,14 @@ class DataLength(dfb.DataFilter):
         # ensure not_data is in string format
         self.not_data = chr(self.not_data)
 
+    def merge_state(self, other):
+        # data_last_seen in other counts from the start of the other's data
+        if not isinstance(other, dict):
+            other = other.export_state()
+        if other['data_last_seen']:
+            self.data_last_seen = self.bytes_seen + other['data_last_seen']
+        self.bytes_seen += other['bytes_seen']
+
     def close_filter(self):
         # put the parameter into a new last packet
         #self.send_on(dfb.DataPacket(total_data_length=self.data_last_seen))
@@ -1368,12 +1575,35 @@ class EmbedPython(dfb.DataFilter):
         self._import_code(self.python_code)
 
 
+class FilterWhere(dfb.DataFilter):
+    """Pass on only the packets for which the expression is true, e.g.
+
+        expr = p.altitude > 1000 and p.speed < 300
+
+    where "p" is the packet and "f" is this filter, of which only the keys
+    may be used. See expression.py. Other packets are dropped.
+    """
+    ftype = 'filter_where'
+    keys = ['expr']
+    param_dependencies = dict(expr=['init_filter'])
+
+    def init_filter(self):
+        self._where = expression.compile_expression(_join_expr(self.expr),
+                                                    self._keys)
+
+    def transform(self, packet):
+        if self._where(packet, self):
+            return packet
+        return None
+
+
 class FormatParam(dfb.DataFilter):
     """Format results received in a list, to be passed on as a string.
     param_name may be an attribute of the results packet.
     """
     ftype = 'format_param'
     keys = ['format']
+    param_dependencies = dict(format=['init_filter'])
 
 
     def filter_data(self, packet):
@@ -1418,13 +1648,13 @@ class GetBytes(dfb.DataFilter):
     ftype = 'get_bytes'
     keys = ['start_byte', 'bytes_to_get', 'param_name']
 
-    def filter_data(self, packet):
+    def transform(self, packet):
 
         if hasattr(packet, self.param_name):
             msg = 'Packet attribute "%s" already has values and can\'t be reset'
             raise dfb.FilterAttributeError, msg % self.param_name
         setattr(packet, self.param_name, self._get_data_value(packet.data))
-        self.send_on(packet)
+        return packet
 
     def _get_data_value(self, data):
         data_value = data[self.start_byte:(
@@ -1445,6 +1675,86 @@ class HashSHA256(dfb.DataFilter):
         self.hasher = hashlib.sha256()
 
 
+class HashMulti(dfb.DataFilter):
+    """Compute several digests of the input stream in one pass, e.g.
+    sha256 for archiving, md5 for old catalogues and crc32 for quick
+    de-duplication. digests may name any hashlib algorithm, or crc32 or
+    adler32.
+
+    If thread_threshold is not 0, the hashing is done by a background
+    thread, so that it overlaps with the work of the filters downstream.
+    Packets are collected until there are thread_threshold bytes waiting,
+    and then all of them are hashed together. hashlib releases the GIL
+    for large blocks.
+
+    When the filter closes, the hex digests are set as attributes named
+    e.g. sha256_digest on the filter and on the refinery, with all of
+    them in the filter's digest_values dictionary. If digest_packet is true,
+    a final empty packet with the same attributes is sent on.
+    """
+    ftype = 'hash_multi'
+    keys = ['digests:sha256', 'thread_threshold:0', 'digest_packet:false']
+
+    def _hash_chunks(self, chunks):
+        for hasher in self.hashers:
+            for chunk in chunks:
+                hasher.update(chunk)
+
+    def close_filter(self):
+        if self._worker:
+            if self._pending:
+                self._worker.put(self._pending)
+                self._pending = []
+            self._worker.finish()
+            self._worker = None
+        self.digest_values = {}
+        for name, hasher in zip(self.digest_names, self.hashers):
+            self.digest_values[name + '_digest'] = hasher.hexdigest()
+        for attr_name, digest in self.digest_values.iteritems():
+            setattr(self, attr_name, digest)
+            setattr(self.refinery, attr_name, digest)
+        if self.digest_packet:
+            self.send_on(dfb.DataPacket('', **self.digest_values))
+
+    def filter_data(self, packet):
+        if self._worker:
+            self._pending.append(packet.data)
+            self._pending_size += packet.data_length
+            if self._pending_size >= self.thread_threshold:
+                self._worker.put(self._pending)
+                self._pending = []
+                self._pending_size = 0
+        else:
+            for hasher in self.hashers:
+                hasher.update(packet.data)
+        self.send_on(packet)
+
+    def init_filter(self):
+        try:
+            self.digests + ''  # Test for a string
+            self.digest_names = [name.strip().lower() 
+                                 for name in self.digests.split(',')]
+        except TypeError:
+            self.digest_names = [name.lower() for name in self.digests]
+        for name in self.digest_names:
+            try:
+                fut.make_hasher(name)
+            except ValueError:
+                raise dfb.FilterAttributeError, \
+                      "%s: digest '%s' is not supported" % (self.name, name)
+
+    def zero_inputs(self):
+        self.hashers = [fut.make_hasher(name) for name in self.digest_names]
+        self._pending = []
+        self._pending_size = 0
+        if self.thread_threshold:
+            self._worker = fut.QueueWorker(self._hash_chunks, 2, 
+                                           name='%s_hasher' % self.name)
+            self._worker.start()
+        else:
+            self._worker = None
+
+
 class HeaderAsAttribute(dfb.DataFilter):
     """In cases where the header is required for further processing later in
     pipeline, this filter assigns the header_attribute to the packet, while the
@@ -1459,12 +1769,12 @@ class HeaderAsAttribute(dfb.DataFilter):
             "header_attribute:header_data",
             "send_on_if_only_header:false"]
     
-    def filter_data(self, packet):
+    def transform(self, packet):
         # If we are not sending on packets if there is not enough data for both
         # the header_attribute and new data.
         if not self.send_on_if_only_header and packet.data_length <= self.header_size:
             # Do not send_on.
-            return
+            return None
         # Set the self.header_attribute of the packet with self.header_size
         # amount of data.
         setattr(packet,
@@ -1472,7 +1782,7 @@ class HeaderAsAttribute(dfb.DataFilter):
                 packet.data[:self.header_size])
         # Set the packet's data to be the remaining data after the header.
         packet.data = packet.data[self.header_size:]
-        self.send_on(packet)
+        return packet
 
 
 class Join(dfb.DataFilter):
@@ -1482,6 +1792,7 @@ class Join(dfb.DataFilter):
     """
     ftype = 'join'
     keys = ['join_str:space']  
+    side_effects = False
 
     def filter_data(self, packet):
         try:
@@ -1503,6 +1814,51 @@ class Join(dfb.DataFilter):
         self.parts = []
 
 
+class Merge(dfb.DataFilter):
+    """Interleave in seq_num order the packets of several routes that join
+    at this filter, e.g. the main and branch routes after a fork, or the
+    outputs of parallel workers. The packets on each route must already be
+    in order. Routes are told apart by the filter that sent the packet.
+
+    Packets wait in a heap until each of the inputs routes has at least one
+    waiting, and then the lowest is sent on, as nothing lower can still
+    arrive. If more than max_buffered packets are waiting (because a route
+    has stopped sending), the lowest is sent on anyway. When the filter
+    closes, the waiting packets are sent on in order.
+    """
+    ftype = 'merge'
+    keys = ['inputs:2', 'seq_field_name:seq_num', 'max_buffered:1000']
+
+    def _send_lowest(self):
+        seq_num, arrival, source, packet = heapq.heappop(self._heap)
+        self._waiting[source] -= 1
+        if not self._waiting[source]:
+            del self._waiting[source]
+        self.send_on(packet)
+
+    def close_filter(self):
+        while self._heap:
+            self._send_lowest()
+
+    def filter_data(self, packet):
+        seq_num = _get_seq_num(packet, self.seq_field_name)
+        source = packet.sent_from
+        # The arrival count breaks ties between equal numbers, first come
+        # first served, so that packets are never compared
+        heapq.heappush(self._heap, (seq_num, self._arrivals, source, packet))
+        self._arrivals += 1
+        self._waiting[source] = self._waiting.get(source, 0) + 1
+        while self._heap and (len(self._waiting) >= self.inputs or 
+                              len(self._heap) > self.max_buffered):
+            self._send_lowest()
+
+    def zero_inputs(self):
+        self._heap = []
+        self._arrivals = 0
+        # Number of packets waiting from each route
+        self._waiting = {}
+
+
 class PassNonZero(dfb.DataFilter):
     """Check that the first n bytes of data for being non-zero (i.e. not 0x00
     or 0xFF). If the first n bytes are 00/FF and all the same, don't pass on
@@ -1538,9 +1894,10 @@ class PassThrough(dfb.DataFilter):
        binary branching.
     """
     ftype = 'pass_through'
+    side_effects = False
 
-    def filter_data(self, packet):
-        self.send_on(packet)
+    def transform(self, packet):
+        return packet
 
 
 class Peek(dfb.DataFilter):
@@ -1593,6 +1950,250 @@ class PrintParam(dfb.DataFilter):
             self.pipeline_name = 'no_pipeline'
             
 
+class ProcessBoundary(dfb.DataFilter):
+    """Run the rest of the route in a worker process, so that CPU-bound
+    Python filters after the boundary run alongside those before it, e.g.
+
+        read_batch >>> process_boundary >>> py_calculate >>> write_file
+
+    The worker is forked when the first packet arrives, taking a copy of
+    the filters after the boundary. Their output stays in the worker, so
+    that part of the route should end by writing its results out. Packets
+    and message bottles go to the worker in order, through a shared memory
+    RingBuffer of buffer_size bytes; when it is full, the filters before
+    the boundary wait. Packet attributes must be picklable.
+
+    Closing the boundary closes the filters in the worker, flushing their
+    buffers, and waits for it to finish. An exception in the worker is
+    raised before the boundary as a FilterProcessingException, for each
+    packet or message bottle sent to the boundary after it, and on closing.
+    Unix only.
+    """
+    ftype = 'process_boundary'
+    keys = ['buffer_size:0x100000']
+
+    _process = None
+    _worker_error = None
+
+    def _check_worker(self):
+        """Raise the worker's exception, if it has sent one back, or an
+        exception if it has stopped without saying why. Checked before each
+        packet is written, so costs only a poll of the results pipe.
+        """
+        if self._worker_error is None:
+            if self._results.poll():
+                self._take_result()
+            elif not self._process.is_alive():
+                self._worker_error = 'Worker process after %s has stopped' % (
+                    self.name)
+        if self._worker_error:
+            raise dfb.FilterProcessingException, self._worker_error
+
+    def _close_filter_next(self):
+        # The filters after the boundary are closed in the worker
+        pass
+
+    def _process_message_bottle(self, packet):
+        if packet.destination == self.name:
+            self.open_message_bottle(packet)
+        else:
+            self._check_worker()
+            self._ring.write_frame(parallel.k_packet_frame, packet, 
+                                   self._check_worker)
+
+    def _run_worker(self):
+        # In the worker process
+        self._results.close()
+        try:
+            while True:
+                kind, packet = self._ring.read_frame()
+                if kind == parallel.k_close_frame:
+                    break
+                if packet.message:
+                    dfb.DataFilter._process_message_bottle(self, packet)
+                else:
+                    self.send_on(packet)
+            dfb.DataFilter._close_filter_next(self)
+        except Exception, err:
+            self._send_result.send(('%s: %s' % (err.__class__.__name__, err),
+                                    traceback.format_exc()))
+        else:
+            self._send_result.send(None)
+
+    def _take_result(self):
+        """Receive the worker's result, keeping any exception it reports.
+        """
+        result = self._results.recv()
+        if result:
+            msg, worker_traceback = result
+            fut.dbg_print(worker_traceback)
+            self._worker_error = 'Exception in worker process after %s: %s' % (
+                self.name, msg)
+
+    def close_filter(self):
+        if self._process:
+            try:
+                if self._worker_error is None:
+                    self._ring.write_frame(parallel.k_close_frame,
+                                           check=self._check_worker)
+                    self._take_result()
+            finally:
+                self._process.join()
+                self._process = None
+                self._ring.close()
+            if self._worker_error:
+                raise dfb.FilterProcessingException, self._worker_error
+
+    def filter_data(self, packet):
+        self._check_worker()
+        self._ring.write_frame(parallel.k_packet_frame, packet, 
+                               self._check_worker)
+
+    def zero_inputs(self):
+        self._worker_error = None
+        self._ring = parallel.RingBuffer(self.buffer_size)
+        self._results, self._send_result = multiprocessing.Pipe(False)
+        self._process = multiprocessing.Process(
+            target=self._run_worker, name='%s worker' % self.name)
+        self._process.daemon = True
+        self._process.start()
+        # Only the worker sends results
+        self._send_result.close()
+
+
+class ProgressMeter(dfb.DataFilter):
+    """Report reading progress and throughput through the callback, at most
+    every interval_ms milliseconds, or every percent_step percent of the
+    file if that is set as well, rather than for every packet.
+
+    The position in the file is taken from the bytes_attr packet attribute,
+    as set by read_batch (read_bytes). If bytes_attr is none, the packet
+    data lengths are counted instead. A packet's file_position attribute,
+    also set by read_batch, is used in preference: when read_batch
+    decompresses, this is the position in the compressed file, to compare
+    with its size, while read_bytes counts the decompressed data. The file
+    size is the file_size key if given, or else it is looked up once for
+    each file, from the packet's source_file_name. A new file is recognised
+    by its name, or by the position going back.
+
+    Each report is made as:
+
+        self.callback(progress_message, **environ)
+
+    with read_percent (-1 if the size is unknown) added to the environ, as
+    callback_on_attribute does. If full_environ is true, these are added as
+    well: bytes_read, bytes_per_sec, eta_secs (None until they can be
+    estimated), file_size and source_file_name. The first and last packets of
+    each file are always reported.
+
+    Between reports, the only work done for each packet is comparing the
+    position with the precalculated position of the next report.
+    """
+    ftype = 'progress_meter'
+    keys = ['callback:none', 'environ:none', 'interval_ms:500', 
+            'percent_step:0', 'file_size:none', 'bytes_attr:read_bytes',
+            'progress_message:progress', 'full_environ:false']
+
+    def _next_report_at(self, position, bytes_per_sec, wait_secs=None):
+        """Position at which the next report is due, wait_secs from now"""
+        if wait_secs is None:
+            wait_secs = self.interval_ms / 1000.0
+        step = 0
+        if self.interval_ms and bytes_per_sec:
+            step = int(bytes_per_sec * wait_secs)
+        if self.percent_step and self._size:
+            step = max(step, int(self._size * self.percent_step / 100.0))
+        next_report = position + max(step, 1)
+        if self._size and position < self._size:
+            # Always report the end of the file
+            next_report = min(next_report, self._size)
+        return next_report
+
+    def _report(self, packet, position):
+        now = time.time()
+        file_name = getattr(packet, 'source_file_name', None)
+        if (file_name != self._file_name or position < self._position or
+            self._start_time is None):
+            self._start_file(file_name, now)
+            if not self.bytes_attr:
+                position = self._bytes_counted = packet.data_length
+            # Throughput is measured from the first packet of the file
+            self._start_position = position
+        elif (self.interval_ms and 
+              (now - self._report_time) * 1000 < self.interval_ms and
+              not (self._size and position >= self._size)):
+            # Too soon: the throughput estimate was too low
+            elapsed = now - self._start_time
+            if elapsed > 0:
+                self._next_report = self._next_report_at(
+                    position, (position - self._start_position) / elapsed,
+                    self.interval_ms / 1000.0 - (now - self._report_time))
+            else:
+                self._next_report = position + 1
+            return
+        elapsed = now - self._start_time
+        bytes_per_sec = eta_secs = None
+        if elapsed > 0 and position > self._start_position:
+            bytes_per_sec = (position - self._start_position) / elapsed
+            if self._size:
+                eta_secs = max(0, self._size - position) / bytes_per_sec
+        if self._size:
+            read_percent = min(100, int(position * 100 / self._size))
+        else:
+            read_percent = -1
+        self._position = position
+        self._report_time = now
+        if self._size and position >= self._size:
+            # Finished this file, so the next packet must be from a new one
+            self._next_report = 0
+        else:
+            self._next_report = self._next_report_at(position, bytes_per_sec)
+        if self.callback is None:
+            return
+        self.environ['read_percent'] = read_percent
+        if self.full_environ:
+            self.environ.update(bytes_read=position, 
+                                bytes_per_sec=bytes_per_sec, 
+                                eta_secs=eta_secs, file_size=self._size, 
+                                source_file_name=file_name)
+        self.callback(self.progress_message, **self.environ)
+
+    def _start_file(self, file_name, now):
+        self._file_name = file_name
+        self._start_time = now
+        self._report_time = now
+        self._start_position = 0
+        self._size = self.file_size
+        if self._size is None and file_name:
+            try:
+                self._size = os.path.getsize(file_name)
+            except (OSError, TypeError):
+                pass
+
+    def filter_data(self, packet):
+        if self.bytes_attr:
+            position = getattr(packet, 'file_position', None)
+            if position is None:
+                position = getattr(packet, self.bytes_attr)
+        else:
+            self._bytes_counted += packet.data_length
+            position = self._bytes_counted
+        if position >= self._next_report:
+            self._report(packet, position)
+        self.send_on(packet)
+
+    def init_filter(self):
+        if self.environ is None:
+            self.environ = {}
+        self._file_name = None
+        self._start_time = None
+        self._position = 0
+        self._bytes_counted = 0
+        self._size = None
+        # Report the first packet
+        self._next_report = 0
+
+
 class ReadBatch(dfb.DataFilter):
     """Chop file up into string blocks to pass inside packets into pipeline.
 
@@ -1617,13 +2218,25 @@ class ReadBatch(dfb.DataFilter):
           
     :param max_reads: Number of batches to read.
     :type  max_reads: int
+    :param decompress: If true, a bzip2, gzip or xz file (recognised by its
+                       first bytes) is decompressed by a background thread while
+                       the rest of the pipeline runs, and the batches hold
+                       the decompressed data. read_percent and
+                       file_position still refer to the compressed file,
+                       while read_bytes counts the decompressed data. Other
+                       files are read as usual.
+    :type  decompress: bool
+    :param decompress_workers: Threads decompressing bzip2 streams in
+                               parallel, or 0 to decompress serially.
+    :type  decompress_workers: int
     """  
     ftype = 'read_batch'
     keys = ['batch_size:0x2000', 'max_reads:0', 
             'initial_skip:0', 'read_every:1', 'binary_mode:true', 
             'source_file_name:none', 
             'file_size:none',
-            'print_progress:false']
+            'print_progress:false',
+            'decompress:false', 'decompress_workers:0']
 
     def _ensure_file_closed(self):
         """Check that the file has been closed, or close it.
@@ -1658,6 +2271,25 @@ class ReadBatch(dfb.DataFilter):
             mode = 'r'
         return open(self.full_file_name, mode)
 
+    def _open_decompressed(self, file1):
+        """Return a reader of the decompressed data if file1 is compressed,
+        or else file1 itself. Files that can't seek back after looking at the
+        first bytes are not checked.
+        """
+        try:
+            start = file1.tell()
+            head = file1.read(codec.k_bz2_magic_len)
+            file1.seek(start)
+        except (AttributeError, IOError):
+            return file1
+        codec_name = codec.detect_compression(head)
+        if codec_name:
+            return codec.BackgroundDecompressReader(
+                file1, codec.get_codec(codec_name).decompressor(
+                    workers=self.decompress_workers),
+                read_size=max(self.batch_size, 0x100000))
+        return file1
+
 
     def _calculate_progress(self, bytes_read='unknown'):
         """ Stores the current progress (percent of data read) within the
@@ -1671,24 +2303,11 @@ class ReadBatch(dfb.DataFilter):
         if bytes_read == 'unknown' or self.file_size == -1:
             return -1
         
-        if self.file_size is None:
-            try:
-                self.file_size = os.path.getsize(self.file1.name)
-                if self.file_size == 0L:
-                    # getsize on raw usb can return 0L on Unix
-                    raise OSError
-            except OSError:
-                # some special file objects can have a file_size attribute
-                try:
-                    self.file_size = self.file1.file_size
-                except AttributeError:
-                    # cannot get file size for raw usb devices
-                    raise dfb.FilterAttributeError(\
-                        "file_size could not be obtained. Required as a filter "+
-                        "attribute. If not, os.path.getsize('%s') is queried." \
-                        % self.file1.name)
+        if self._this_file_size is None:
+            # Looked up once for each file, not for every block
+            self._this_file_size = self._get_file_size()
         #try:
-        progress = int(bytes_read * 100.0 / self.file_size)
+        progress = int(bytes_read * 100.0 / self._this_file_size)
         #except ZeroDivisionError, err:
             #print "**4322** Progress cannot be estimated as file_size is '%s'. %s" % (self.file_size, err)
         # TO-DO: Take this out:
@@ -1703,6 +2322,29 @@ class ReadBatch(dfb.DataFilter):
         return progress
 
 
+    def _get_file_size(self):
+        """Return the file_size key if set, or else the size of the file
+        being read.
+        """
+        if self.file_size is not None:
+            return self.file_size
+        try:
+            file_size = os.path.getsize(self.file1.name)
+            if file_size == 0L:
+                # getsize on raw usb can return 0L on Unix
+                raise OSError
+            return file_size
+        except OSError:
+            # some special file objects can have a file_size attribute
+            try:
+                return self.file1.file_size
+            except AttributeError:
+                # cannot get file size for raw usb devices
+                raise dfb.FilterAttributeError(\
+                    "file_size could not be obtained. Required as a filter "+
+                    "attribute. If not, os.path.getsize('%s') is queried." \
+                    % self.file1.name)
+
     ##def _report_progress(self, bytes_read='unknown'):
         ##"""Use the callback, if one is available, to report how much of the
         ##file has been read. This can be passed in explicitly
@@ -1758,51 +2400,64 @@ class ReadBatch(dfb.DataFilter):
         # Having this (yield) here makes this conform to filter.   TO-DO         
         # This is now used to take in the file name, to enable processing
         # a list of files without recreating filter each file.
-
+        for block_packet in self.iter_packets(packet):
+            self.send_on(block_packet)
+
+    def iter_packets(self, packet):
+        """Generate the packets of data read from the file named (or given)
+        in packet.data. Used by filter_data(), and by Pipeline.iter_data()
+        to read only as much as is asked for. The file is closed when the
+        generator finishes or is closed.
+        """
         if self.shutting_down:  # TO-DO
             return
         full_file_name_or_obj = packet.data
         self._ensure_file_closed()
         self.file1 = self._get_file_obj(full_file_name_or_obj)
+        if self.decompress:
+            self.file1 = self._open_decompressed(self.file1)
         self.char_count = 0
+        self._this_file_size = None
 
         self.file_counter += 1
-        # Skip initial unread data
-        for block_no in xrange(self.initial_skip):
-            block = self.file1.read(self.batch_size)
-            if len(block) == 0:
-                break
-        read_count = 0
-        while not self.shutting_down:  # TO-DO
-            if self.refinery.shutting_down:
-                self.shutting_down = True
-                # Use "continue" rather than "break", to get to "else"
-                continue  
-            block = self.file1.read(self.batch_size)
-
-            if len(block) > 0:
-                self.char_count += len(block)
-                percent = self._calculate_progress(self.char_count)
-                packet = dfb.DataPacket(
-                    block, source_file_name=self.full_file_name,
-                    read_percent=percent,
-                    read_bytes=self.char_count
-                )
-                self.send_on(packet)
-                ##self._report_progress(self.char_count)
-            else:
-                # File has run out, so we loop, closing first, to avoid
-                # leaving while waiting for a (yield).
-                self._ensure_file_closed()
-                break
-            read_count += 1
-            if self.max_reads and read_count >= self.max_reads:
-                # Enough of the file has been read, so close and move
-                # on to the next file.
-                self._ensure_file_closed()
-                break
-        else:
-            # We haven't broken out of the loop, so close normally.
+        try:
+            # Skip initial unread data
+            for block_no in xrange(self.initial_skip):
+                block = self.file1.read(self.batch_size)
+                if len(block) == 0:
+                    break
+            read_count = 0
+            while not self.shutting_down:  # TO-DO
+                if self.refinery.shutting_down:
+                    self.shutting_down = True
+                    # Use "continue" rather than "break", to get to "else"
+                    continue  
+                block = self.file1.read(self.batch_size)
+
+                if len(block) > 0:
+                    self.char_count += len(block)
+                    # In the file as stored, whether or not decompressed
+                    position = getattr(self.file1, 'compressed_bytes_read',
+                                       self.char_count)
+                    percent = self._calculate_progress(position)
+                    yield dfb.DataPacket(
+                        block, source_file_name=self.full_file_name,
+                        read_percent=percent,
+                        read_bytes=self.char_count,
+                        file_position=position
+                    )
+                    ##self._report_progress(self.char_count)
+                else:
+                    # File has run out
+                    break
+                read_count += 1
+                if self.max_reads and read_count >= self.max_reads:
+                    # Enough of the file has been read, so move on to the
+                    # next file.
+                    break
+        finally:
+            # Close the file however we leave, including the consumer of
+            # the packets stopping early.
             self._ensure_file_closed()
 
     def zero_inputs(self):  # TO-DO change to open_filter?
@@ -2037,6 +2692,7 @@ class SwapTwoBytes(dfb.DataFilter):
         The result will be stored back into packet.data.
     """
     ftype = 'swap_two_bytes'
+    side_effects = False
 
     def filter_data(self, packet):
         hanging_char = None
@@ -2062,20 +2718,92 @@ class SwapTwoBytes(dfb.DataFilter):
         self.send_on(packet)
 
 
+class Reorder(dfb.DataFilter):
+    """Send on data packets strictly in seq_num order, starting from
+    first_seq_num, however out of order they arrive, e.g. after parallel
+    branches or workers. Packets wait in a heap until the next number
+    arrives.
+
+    A number that never arrives would hold up everything after it, so the
+    gap is skipped when more than max_buffered packets are waiting, or (if
+    gap_timeout isn't 0) when gap_timeout seconds have passed since the gap
+    held anything up. The time is checked as each packet arrives. Skipped
+    numbers are counted in skipped_count. A packet arriving after its number
+    has been passed, e.g. a duplicate, is dropped and counted in late_count.
+    When the filter closes, the waiting packets are sent on in order.
+    """
+    ftype = 'reorder'
+    keys = ['seq_field_name:seq_num', 'first_seq_num:0', 
+            'max_buffered:1000', 'gap_timeout:0']
+
+    def _release(self):
+        """Send on the waiting packets that are next in order.
+        """
+        heap = self._heap
+        sent = False
+        while heap and heap[0][0] <= self.next_seq_num:
+            seq_num, arrival, packet = heapq.heappop(heap)
+            if seq_num < self.next_seq_num:
+                self.late_count += 1
+                continue
+            self.next_seq_num = seq_num + 1
+            self.send_on(packet)
+            sent = True
+        if not heap:
+            self._gap_since = None
+        elif sent or self._gap_since is None:
+            self._gap_since = time.time()
+
+    def _skip_gap(self):
+        seq_num = self._heap[0][0]
+        self.skipped_count += seq_num - self.next_seq_num
+        self.next_seq_num = seq_num
+        self._release()
+
+    def close_filter(self):
+        while self._heap:
+            self._skip_gap()
+
+    def filter_data(self, packet):
+        seq_num = _get_seq_num(packet, self.seq_field_name)
+        if seq_num < self.next_seq_num:
+            self.late_count += 1
+            return
+        # The arrival count breaks ties between equal numbers, so that
+        # packets are never compared
+        heapq.heappush(self._heap, (seq_num, self._arrivals, packet))
+        self._arrivals += 1
+        self._release()
+        while self._heap and (len(self._heap) > self.max_buffered or (
+            self.gap_timeout and 
+            time.time() - self._gap_since >= self.gap_timeout)):
+            self._skip_gap()
+
+    def zero_inputs(self):
+        self._heap = []
+        self._arrivals = 0
+        self._gap_since = None
+        self.next_seq_num = self.first_seq_num
+        self.skipped_count = 0
+        self.late_count = 0
+
+
 class ReverseString(dfb.DataFilter):
     """ Reverse a string (in packet.data) that is of at least 2 characters long.
         The result will be stored back into packet.data.
     """
     ftype = 'reverse_string'
+    side_effects = False
+    pure = True
 
-    def filter_data(self, packet):
+    def transform(self, packet):
         try:
             packet.data + ''
         except TypeError:
             raise TypeError, 'Cannot swap on a non-string'
 
         packet.data = packet.data[::-1]
-        self.send_on(packet)
+        return packet
 
 
 class R111esetBranch(dfb.DataFilter):
@@ -2169,6 +2897,91 @@ class Reset(dfb.DataFilter):
         self.send_on(packet)   
 
 
+class RouteBy(dfb.DataFilter):
+    """Send each data packet to one of several named outputs, chosen by the
+    value of the packet's attribute. The output is found by looking the
+    value up in a dictionary, so the cost is the same however many outputs
+    there are. The outputs are written in the route in square brackets,
+    each with its name and route, before the filter that is the main output:
+
+        route_by:colour >>>
+            [red: write_red >>> sink_red]
+            [blue: sink_blue]
+            [7: sink_seven]
+        sink_other
+
+    Output names are converted like key values, so "7" matches an integer
+    7, as well as the string "7". Packets whose value has no output, or that
+    don't have the attribute, go on to the main output. Message bottles go
+    down every output, and then on to the main output.
+    """
+    ftype = 'route_by'
+    keys = ['attribute']
+
+    def __init__(self, *args, **kwargs):
+        # Set up before the pipeline connects the outputs
+        # Output filters by output name
+        self.output_filters = {}
+        self._output_names = []
+        # Output filters by output name, and by the value converted from it
+        self._dispatch = {}
+        super(RouteBy, self).__init__(*args, **kwargs)
+
+    def _close(self):
+        """Override base functionality to ensure the outputs are closed as
+        well.
+        """
+        for output in self._output_list():
+            output._close()
+        dfb.DataFilter._close(self)
+
+    def _output_list(self):
+        """Return the output filters, each once, in the order they were
+        added.
+        """
+        outputs = []
+        for name in self._output_names:
+            if self.output_filters[name] not in outputs:
+                outputs.append(self.output_filters[name])
+        return outputs
+
+    def add_output(self, name, output):
+        """Connect the output called name to the output filter.
+        """
+        if name not in self.output_filters:
+            self._output_names.append(name)
+        self.output_filters[name] = output
+        self._dispatch[name] = output
+        self._dispatch[fut.convert_config_str(name)] = output
+
+    def filter_data(self, packet):
+        try:
+            output = self._dispatch.get(getattr(packet, self.attribute))
+        except (AttributeError, TypeError):  # No attribute, or unhashable
+            output = None
+        if output is not None:
+            packet.sent_from = self
+            packet.fork_dest = 'main'
+            output.send(packet)
+        else:
+            self.send_on(packet)
+
+    def replace_output(self, old_output, new_output):
+        """Connect to new_output all the outputs that go to old_output.
+        """
+        for name, output in self.output_filters.items():
+            if output is old_output:
+                self.add_output(name, new_output)
+
+    def send_on(self, packet, fork_dest='main'):
+        if packet.message:
+            for output in self._output_list():
+                packet.sent_from = self
+                packet.fork_dest = 'main'
+                output.send(packet)
+        dfb.DataFilter.send_on(self, packet, fork_dest)
+
+
 class SeqPacket(dfb.DataFilter):
     """Give each data packet a sequential number (e.g. as an ID), starting
     from 0 or whatever reset_counter_to is set to. To allow for looping, the
@@ -2181,7 +2994,7 @@ class SeqPacket(dfb.DataFilter):
     ftype = 'seq_packet'
     keys = ['seq_packet_field_name:seq_num', 'field_width:6']
 
-    def filter_data(self, packet):  
+    def transform(self, packet):  
         ##print '**10360** packet in to SeqPacket', packet
         ##if packet.message: 
             ##setattr(packet, self.seq_packet_field_name, -1)
@@ -2204,7 +3017,7 @@ class SeqPacket(dfb.DataFilter):
         # The packet is sent on (a) if it's a normal data packet
         #                       (b) if message isn't the expected one
         #                       (c) if it is to be used more than once
-        self.send_on(packet)
+        return packet
 
     def init_filter(self):
         self.zero_inputs()
@@ -2286,6 +3099,8 @@ class SplitWords(dfb.DataFilter):
     """
     ftype = 'split_words'
     keys = ['split_on_str:None']
+    side_effects = False
+    pure = True
 
     def filter_data(self, packet):
         words = packet.data.split(self.split_on_str)
@@ -2304,6 +3119,8 @@ class SplitLines(dfb.DataFilter):
     """
     ftype = 'split_lines'
     keys = [] ##'split_on_str:None'
+    side_effects = False
+    pure = True
 
     def filter_data(self, packet):
         lines = packet.data.splitlines()
@@ -2332,11 +3149,11 @@ class TagPacket(dfb.DataFilter):
         ##setattr(self, self.tag_field_name, value)
     ##tag = property(_get_tag, _set_tag, doc='Tag the tag_packet filter')    
 
-    def filter_data(self, packet):
+    def transform(self, packet):
 ##        fut.copy_attr(self, packet, self.tag_field_name)
 ##        for field_name in self.tag_field_names:
         setattr(packet, self.tag_field_name, self.tag_field_value)
-        self.send_on(packet)
+        return packet
 
     def zero_inputs(self):
         self.tag = ''
@@ -2601,6 +3418,56 @@ class TankBranch(TankQueue):
             self.send_on(dfb.DataPacket(self.sorted_packets), 'branch')
 
 
+class ThreadBoundary(dfb.DataFilter):
+    """Split the route into segments running in different threads, e.g.
+
+        read_batch >>> thread_boundary >>> bzip_compress >>> 
+        thread_boundary >>> write_file
+
+    Packets are put on a queue, and sent on by a worker thread, so that work
+    after the boundary (e.g. compressing, which releases the GIL) overlaps
+    with work before it. At most queue_size packets wait to be sent on;
+    then the thread before the boundary waits for room.
+
+    Message bottles passing the boundary go through the queue, to stay in
+    order with the data packets. An exception after the boundary is
+    re-raised before the boundary, by the next packet or on closing. On
+    closing, the packets still queued are sent on before the filters after
+    the boundary are closed. Shutting down is seen by both sides, through
+    the refinery's shutting_down.
+    """
+    ftype = 'thread_boundary'
+    keys = ['queue_size:8']
+
+    _worker = None
+
+    def _send_across(self, packet):
+        # Called in the worker thread
+        if packet.message:
+            dfb.DataFilter._process_message_bottle(self, packet)
+        else:
+            self.send_on(packet)
+
+    def _process_message_bottle(self, packet):
+        self._worker.put(packet)
+
+    def close_filter(self):
+        # Shutting down from after the boundary may close the filters
+        # before it from the worker thread, which can't wait for itself.
+        if threading.current_thread() is not self._worker:
+            self._worker.finish()
+
+    def filter_data(self, packet):
+        self._worker.put(packet)
+
+    def zero_inputs(self):
+        if self._worker:
+            self._worker.finish()
+        self._worker = fut.QueueWorker(self._send_across, self.queue_size,
+                                       name='%s worker' % self.name)
+        self._worker.start()
+
+
 class Transmit(dfb.DataFilter):   # TO-DO  Test needed
     """Reset to zero an attribute in the next filter, to a value dependent on
     the current packet.
@@ -2635,6 +3502,7 @@ class Waste(dfb.DataFilter):
     when combining results from branches and the main stream is not wanted.
     """ 
     ftype = 'waste'
+    side_effects = False
 
     def filter_data(self, packet):
         pass
@@ -2649,7 +3517,7 @@ class Wrap(dfb.DataFilter):
     # wrap_mode 'once' or 'repeated'
     keys = ['data_prefix:empty', 'data_suffix:empty', 'wrap_mode:repeated'] 
 
-    def filter_data(self, packet):
+    def transform(self, packet):
         # Without unicode() we get error 
         # 'ascii' codec can't decode byte 0xff in position 0
         # because data has been converted to unicode on reading.
@@ -2657,7 +3525,7 @@ class Wrap(dfb.DataFilter):
                                 ##packet.data, 
                                 ##unicode(self.data_suffix, 'ISO-8859-1')])
         packet.data = ''.join([self.data_prefix, packet.data, self.data_suffix])
-        self.send_on(packet)
+        return packet
 
 
 class SetAttributesToData(dfb.DataFilter):
@@ -2964,38 +3832,115 @@ class WriteFile(dfb.DataFilter):
     By providing a message bottle with the message 'change_write_suffix'
     and the packet attribute 'packet.file_name_suffix'
     the current file will be closed and a new one will
-    be opened with the suffix appended to it.
+    be opened with the suffix appended to it. The message
+    'change_dest_file_name', with packet.dest_file_name, does the same for the
+    whole file name, as does a 'reset' of dest_file_name, write_suffix or
+    compress. If the attribute is changed directly instead, call
+    close_output_file() first.
     
-    compress : currenly only 'bzip' is enabled (true / bzip resolves to bzip2)
+    compress : the name of a codec in the codec module, e.g. bzip2, zlib,
+    gzip or lzma (true / bzip resolves to bzip2). The codec's extension is
+    added to the file name. 'auto' chooses the codec from the extension
+    that dest_file_name already has, and doesn't compress if it isn't known.
+    compress_level is 1 (fastest) to 9 (smallest), or the codec's default.
+
+    compress_workers : if not 0, bzip compression is done by this many
+    threads in parallel, each compressing compress_block_size bytes as a
+    separate stream. compress_in_flight limits the blocks held in memory.
+
+    buffer_size : packet data is held in memory until at least this many
+    bytes are waiting, and then written with a single writelines() call, so
+    that small packets don't each cost a system call. 0 writes every packet
+    as it arrives. Buffered data is always written when the file is closed.
+
+    write_behind : if true, the compression and writing are done by a
+    background thread, so that disk latency overlaps with the work of the
+    upstream filters. write_behind_queue is the number of buffers allowed to
+    wait for the thread before the pipeline blocks. Any error in the thread
+    is raised in the pipeline on the next write, or on closing.
     """
     ftype = 'write_file'
     keys = ['dest_file_name', 'append:False', 'binary_mode:true', 
-            'do_write_file:True', 'compress:none']
+            'do_write_file:True', 'compress:none', 'buffer_size:0x400000',
+            'write_behind:false', 'write_behind_queue:4',
+            'compress_workers:0', 'compress_block_size:900000', 
+            'compress_in_flight:0', 'compress_level:none']
+
+    # Changing any of these with a 'reset' message closes the current file
+    dest_params = ('dest_file_name', 'write_suffix', 'compress', 'append',
+                   'binary_mode', 'compress_level')
 
     def _ensure_file_closed(self):
-        """Check that the file has been closed, or close it.
+        """Check that the file has been closed, or close it. Any buffered
+        data is written first, and the write-behind thread, if any, is
+        allowed to finish before the compressor is flushed.
         """
-        if hasattr(self, 'out_file'):
-            if self.out_file and not self.out_file.closed:
-                # if compression, flush any remaining data
-                if self.compress:
-                    # NB: Assumes all compressor types have a flush method
-                    self.out_file.write(self.compressor.flush())
-                    # Set compressor to None to make sure the object goes away,
-                    # otherwise we can end up with a memory leak
-                    if getattr(self, 'compressor'):
+        try:
+            self._flush_pending()
+        finally:
+            writer = getattr(self, '_writer', None)
+            self._writer = None
+            try:
+                if writer:
+                    writer.finish()
+            finally:
+                out_file = getattr(self, 'out_file', None)
+                self.out_file = None
+                if out_file and not out_file.closed:
+                    try:
+                        # if compression, flush any remaining data
+                        if self.compressor:
+                            # NB: Assumes all compressor types have a flush method
+                            out_file.write(self.compressor.flush())
+                    finally:
+                        # Set compressor to None to make sure the object goes
+                        # away, otherwise we can end up with a memory leak
+                        if hasattr(self.compressor, 'close'):
+                            self.compressor.close()
                         self.compressor = None
-                self.out_file.close()
+                        out_file.close()
+
+    def _flush_pending(self):
+        """Write out the buffered chunks, opening the file if necessary. The
+        file is opened, and so created, once any packet has arrived, even if
+        it had no data.
+        """
+        if not self._pending and not self._packet_arrived:
+            return
+        chunks = self._pending
+        self._pending = []
+        self._pending_size = 0
+        self._packet_arrived = False
+        if not self.out_file:
+            self._open_dest_file()
+        if not chunks:
+            return
+        if self._writer:
+            self._writer.put(chunks)
         else:
-            self.out_file = None
+            self._write_chunks(chunks)
+
+    def _get_codec(self):
+        """Return the codec.Codec to compress with, or None."""
+        if not self.compress:
+            return None
+        if self.compress is True:
+            return codec.get_codec('bzip2')
+        if str(self.compress).lower() == 'auto':
+            return codec.codec_for_file_name(self._get_dest_file_name(False))
+        try:
+            return codec.get_codec(self.compress)
+        except ValueError, err:
+            raise dfb.FilterAttributeError, str(err)
 
-    def _get_dest_file_name(self):
+    def _get_dest_file_name(self, with_extension=True):
         if not hasattr(self, 'write_suffix'):
             file_name = self.dest_file_name
         else:
             file_name = os.extsep.join([self.dest_file_name, self.write_suffix])
-        if self.compress in ('bzip', 'bzip2', True):
-            return file_name + '.bz2'
+        if (with_extension and self.compress and 
+            str(self.compress).lower() != 'auto'):
+            return file_name + self._get_codec().extension
         else:
             return file_name
     
@@ -3005,63 +3950,78 @@ class WriteFile(dfb.DataFilter):
             print "'%s' not writing any data as dest_file_name is None" % self.name
             #return
             self.enabled = False
+        else:
+            # Check now for an unknown codec, not when the data is written
+            self._get_codec()
+        self.out_file = None
+        self.compressor = None
+        self._writer = None
+        self._pending = []
+        self._pending_size = 0
+        self._packet_arrived = False
+
+    def _open_dest_file(self):
+        write_codec = self._get_codec()
+        if write_codec:
+            try:
+                self.compressor = write_codec.compressor(
+                    self.compress_level, workers=self.compress_workers,
+                    block_size=self.compress_block_size,
+                    max_in_flight=self.compress_in_flight)
+            except MemoryError, err:
+                msg = "Memory Error in WriteFile filter: %s" % err
+                raise MemoryError, msg
+            except ValueError, err:
+                raise dfb.FilterAttributeError, str(err)
+        else:
+            self.compressor = None
 
+        if self.binary_mode:
+            mode2 = 'b'
+        else:
+            mode2 = ''
+        if self.append:
+            self.out_file = open(self._get_dest_file_name(), 'a' + mode2)
+        else:
+            self.out_file = open(self._get_dest_file_name(), 'w' + mode2)
+        ##print '**10900** Writing to file: ...%s' % (
+            ##self._get_dest_file_name()[-55:])
+        if not self.compressor:
+            print "Writing to new file: %s" % os.path.basename(self.out_file.name)
+
+        if self.write_behind:
+            self._writer = fut.QueueWorker(self._write_chunks,
+                                           self.write_behind_queue,
+                                           name='%s_writer' % self.name)
+            self._writer.start()
+
+    def _write_chunks(self, chunks):
+        """Write a list of data strings, called from the write-behind thread
+        if there is one.
+        """
+        if self.compressor:
+            self.out_file.write(self.compressor.compress(''.join(chunks)))
+        else:
+            self.out_file.writelines(chunks)
 
     def _write_data(self, data):
 
         if self.do_write_file:
-            # TO-DO: Write a nice little test to ensure this works (GK)
-            
             # this feature will allow us to have lots of different write_file
             # filters in a pipeline (very useful for testing etc) but also
             # have the ability only write out data to the write_file filters
             # that we need to. To do so, set dest_file_name to None (as a
             # default key in the pipeline) to disable the writing to that file.
-            
-            # do this in init_filter()
-            #if self.dest_file_name is None:
-                #print "'%s' not writing any data as dest_file_name is None" % self.name
-                ##return
-                #self.enabled = False
-
+            # This is checked in init_filter().
             if not self.enabled:
                 return
-                
-            try:
-                if self.compress:
-                    self.out_file.write(self.compressor.compress(data))
-                else:
-                    self.out_file.write(data)
-            except AttributeError:
-                if self.binary_mode:
-                    mode2 = 'b'
-                else:
-                    mode2 = ''
-                
-                if self.append:
-                    self.out_file = open(self._get_dest_file_name(), 'a' + mode2)
-                else:
-                    self.out_file = open(self._get_dest_file_name(), 'w' + mode2)
-                ##print '**10900** Writing to file: ...%s' % (
-                    ##self._get_dest_file_name()[-55:])
-
-                if self.compress in ('bzip', 'bzip2', True):
-                    try:
-                        self.compressor = bz2.BZ2Compressor()
-                    except MemoryError, err:
-                        msg = "Memory Error in WriteFile filter: %" % err
-                        raise MemoryError, msg
-                        
-                elif self.compress:
-                    raise dfb.FilterAttributeError, "Compression '%s' not supported" % self.compress
-                
-                if self.compress:
-                    self.out_file.write(self.compressor.compress(data))
-                else:
-                    print "Writing to new file: %s" % os.path.basename(self.out_file.name)
-                    self.out_file.write(data)
-                
-                ##self.out_file.write(data)
+            self._packet_arrived = True
+            if not data:
+                return
+            self._pending.append(data)
+            self._pending_size += len(data)
+            if self._pending_size >= self.buffer_size:
+                self._flush_pending()
 
     def close_filter(self):
         self._ensure_file_closed()
@@ -3069,15 +4029,6 @@ class WriteFile(dfb.DataFilter):
     def close_output_file(self):
         self._ensure_file_closed()
 
-    def before_filter_data(self, packet):
-        try:
-            self.out_file.isatty
-        except AttributeError:
-            return
-        if self.out_file.name != self._get_dest_file_name():
-            self._ensure_file_closed()
-            self.out_file = None
-
     def filter_data(self, packet):
         self._write_data(packet.data)
         self.send_on(packet)
@@ -3088,13 +4039,88 @@ class WriteFile(dfb.DataFilter):
     def open_message_bottle(self, packet):
         if packet.message == 'change_write_suffix':
             self._ensure_file_closed()
-            self.out_file = None
             self.write_suffix = packet.file_name_suffix
         elif packet.message == 'change_dest_file_name':
             self._ensure_file_closed()
-            self.out_file = None
             self.dest_file_name = packet.dest_file_name
         else:
+            if (packet.message == 'reset' and 
+                packet.param_name in self.dest_params):
+                self._ensure_file_closed()
             dfb.DataFilter.open_message_bottle(self, packet)
 
+
+class WriteStream(dfb.DataFilter):
+    """Write the packet data to a socket, pipe or other stream with a
+    fileno(), set as the stream attribute before the first packet arrives
+    (e.g. by EventLoop.add_output()). Packets are sent on unchanged.
+
+    Data that can't be written yet to a non-blocking stream is kept in
+    pending, and written by write_pending() when the stream is ready. An
+    EventLoop does this, and stops reading the sources of the refinery while
+    more than high_water bytes are waiting. When the filter closes, the
+    stream is closed as soon as everything has been written, unless
+    close_stream is false.
+    """
+    ftype = 'write_stream'
+    keys = ['high_water:0x10000', 'close_stream:true']
+
+    stream = None
+    pending_bytes = 0
+
+    def _close_stream(self):
+        if self.close_stream and self.stream:
+            self.stream.close()
+        self.stream = None
+
+    def _write(self, data):
+        """Return the number of bytes written, 0 if the stream isn't ready.
+        """
+        try:
+            if hasattr(self.stream, 'send'):
+                return self.stream.send(data)
+            return os.write(self.stream.fileno(), data)
+        except (socket.error, OSError), err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def close_filter(self):
+        if not self.pending_bytes:
+            self._close_stream()
+
+    def filter_data(self, packet):
+        if packet.data:
+            if not self.stream:
+                raise dfb.FilterAttributeError, \
+                      'No stream set for %s to write to' % self.name
+            self.pending.append(packet.data)
+            self.pending_bytes += len(packet.data)
+            self.write_pending()
+        self.send_on(packet)
+
+    def fileno(self):
+        # For select() to wait until the stream is ready for writing
+        return self.stream.fileno()
+
+    def write_pending(self):
+        """Write as much of the pending data as the stream will take now.
+        """
+        while self.pending:
+            data = self.pending[0]
+            written = self._write(data)
+            if not written:
+                break
+            self.pending_bytes -= written
+            if written < len(data):
+                self.pending[0] = data[written:]
+            else:
+                del self.pending[0]
+        if self.closing and not self.pending_bytes:
+            self._close_stream()
+
+    def zero_inputs(self):
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+
 ##+++++TO-DO:+++++  yield 'pass data back??'  <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
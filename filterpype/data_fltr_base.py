@@ -13,6 +13,9 @@
 
 from __future__ import with_statement
 import heapq
+import operator
+import sys
+import threading
 import time
 from contextlib import contextmanager 
 import re
@@ -27,6 +30,8 @@ re_caps_params = re.compile(r'\b[A-Z][A-Z0-9_]+\b')
 re_caps_params_with_percent = re.compile(r'^%[A-Z][A-Z0-9_]+$')
 
 k_unset = '$$<unset>$$'
+# Packet attributes set by send_on()
+k_packet_routing_attrs = ('sent_from', 'fork_dest')
 
 
 class DataError(Exception):
@@ -99,6 +104,65 @@ def closer(afilter):
             raise
 
 
+# Methods that must not be overridden in a filter for message bottles to be
+# delivered straight to it, or to be passed straight over it.
+k_bottle_opening_methods = ('_coroutine', '_process_message_bottle', 'send')
+k_bottle_passing_methods = k_bottle_opening_methods + (
+    'send_on', 'before_send_on', 'after_send_on')
+# Methods that must not be overridden in a filter for its transform() to be
+# called from a FusedFilters stage instead of its own coroutine.
+k_fusable_methods = k_bottle_passing_methods + (
+    '_close', '_close_filter_next', '_process_data_packet', 'filter_data',
+    'before_filter_data', 'after_filter_data', 'flush_buffer', 'close_filter')
+
+def _uses_base_methods(afilter, method_names):
+    """Return True if none of method_names is overridden in the filter's class.
+    """
+    for method_name in method_names:
+        if getattr(afilter.__class__, method_name).im_func is not \
+           getattr(DataFilter, method_name).im_func:
+            return False
+    return True
+
+def _raise_in_filter(afilter, err):
+    """Re-raise err, being handled after afilter failed, with the name and
+    ftype of the filter added to its message, unless the refinery has
+    already done that for an exception further down the route.
+    """
+    # Uses the refinery to check _already_raised.
+    if not hasattr(afilter.refinery, "_already_raised"):
+        msg = "Exception in '%s' (%s): %s" \
+            % (afilter.name, afilter.ftype, str(err))
+        afilter.refinery._already_raised = True
+        raise type(err), msg, sys.exc_info()[2]
+    else:
+        raise err
+
+def merge_values(value, other):
+    """Return value combined with other, from the same counter in another
+    filter: numbers are added, lists and strings joined, and dictionaries
+    merged key by key.
+    """
+    if isinstance(value, dict):
+        merged = value.copy()
+        for key, other_item in other.iteritems():
+            if key in merged:
+                merged[key] = merge_values(merged[key], other_item)
+            else:
+                merged[key] = other_item
+        return merged
+    return value + other
+
+def _route_unchanged(connections):
+    """Check that the connections noted when a bottle route was planned, as
+    (filter, attribute name, connected filter), are still in place.
+    """
+    for afilter, attr_name, connected in connections:
+        if getattr(afilter, attr_name) is not connected:
+            return False
+    return True
+
+
 class DataFilterBase(object):
     """This is the Filter part of the Pipes and Filters design pattern, using
     Python co-routines to push the data from one filter to the next.
@@ -135,7 +199,52 @@ class DataFilterBase(object):
     callbacks = ['results_callback']
 ##    standard_keys = ['_can_be_refinery', '_class', 'factory', 'ftype', 
     standard_keys = ['_class', '_key_values', '_name', 'factory', 'ftype', 
-                     'pipeline', 'dynamic', 'update_live'] + callbacks
+                     'pipeline', 'dynamic', 'update_live', 
+                     'side_effects', 'pure', 'cache_size', 'cache_bytes',
+                     'cache_attrs'] + callbacks
+    # A filter without side effects does nothing but send on packets, so it
+    # may be taken out of the route by Pipeline.optimise_route() if its
+    # output is thrown away. Set "side_effects = true" in a filter's config
+    # section to keep it in.
+    side_effects = True
+    # A pure filter sends on packets that depend only on the packet it is
+    # sent (its data and the attributes named in cache_attrs), keeping
+    # nothing from one packet to the next. Only a pure filter may have a
+    # packet cache. Set cache_size in the config section of a pure filter to
+    # keep the packets it sends on for the last cache_size different inputs,
+    # with data of at most cache_bytes in all.
+    # For a repeated input, these are sent on again instead of calling
+    # filter_data(). See _init_packet_cache().
+    pure = False
+    cache_size = 0
+    cache_bytes = 0x1000000
+    cache_attrs = []
+    packet_cache = None  # fut.LruCache, with the hit and miss counts
+    # Set False (on the refinery) to pass every message bottle along the
+    # route, filter by filter, as before. See _send_bottle_direct().
+    direct_bottle_delivery = True
+    # Derived values to recalculate when keys are reset, as
+    # {key: [method names]}, e.g. {'size': ['_calc_block_count']}. A key not
+    # listed has nothing derived from it in a filter, but in a pipeline it
+    # makes update_filters() run again for the whole pipeline.
+    param_dependencies = {}
+    # Set True on the filter or pipeline that packets are sent in to, for its
+    # route to be run by a PacketScheduler instead of by nested send() calls.
+    iterative_scheduling = False
+    # A filter that changes each data packet on its own, sending on that one
+    # packet or nothing, can define transform(packet) instead of filter_data(),
+    # returning the packet to send on, or None. A pipeline with "fuse = true"
+    # then runs a linear section of such filters as one FusedFilters stage.
+    transform = None
+    # A source filter, making new packets from the one it is sent (e.g. the
+    # blocks of a file), can define iter_packets(packet) to generate them.
+    # Pipeline.iter_data() then pulls them through the pipeline one by one.
+    iter_packets = None
+    # Names of the attributes where the filter counts or collects what has
+    # passed through, so that filters processing parts of the same data (e.g.
+    # in different processes) can be combined with export_state() and 
+    # merge_state(). None if the filter's state can't be merged.
+    state_attrs = None
 
     ##def __init__(self, factory=None, pipeline=None, **kwargs):
         ##self.factory = factory
@@ -229,6 +338,8 @@ class DataFilterBase(object):
 ##        self._can_be_refinery = False # True for pipelines, not filters
         # Filters will be linked up later by the pipeline
         self.next_filter = None
+        # Planned message bottle routes, used only in the refinery
+        self._bottle_routes = {}
 
         # TO-DO: Surely callbacks in a pipeline hierarchy should be in the
         # pipeline.py Pipeline base class rather than here?
@@ -366,11 +477,23 @@ class DataFilterBase(object):
         ##except KeyError:
             ##pass  
 
+    def _call_scheduled(self, func, *args):
+        """Call func(*args) now, unless a PacketScheduler is running, or
+        should be, in which case leave the scheduler to make the call.
+        """
+        scheduler = PacketScheduler.current()
+        if scheduler:
+            scheduler.add(func, *args)
+        elif self.iterative_scheduling:
+            PacketScheduler().run(func, *args)
+        else:
+            func(*args)
+
     def _close(self):
         """Call the coroutine close() to raise the GeneratorExit exception.
         """
         if self._corout:
-            self._corout.close()
+            self._call_scheduled(self._corout.close)
 
     def _close_filter_next(self):
         """Close the next (main) filter if there is one. 
@@ -563,6 +686,75 @@ class DataFilterBase(object):
         # This does something only in Pipeline class.
         pass
 
+    def _plan_bottle_route(self, fork_dest, destination, single_use):
+        """Work out which filters would open a message bottle sent on from
+        this filter, if it were passed along the route filter by filter: in
+        the same order (branch before main), stopping at the filter with the
+        destination name, and going on past a filter with the destination
+        ftype only if the bottle is not single_use.
+
+        Return (connections, targets), where connections are the links
+        followed, to check that the route hasn't been changed since. targets
+        is None if the bottle can't bypass the filters in between, because
+        one of them would do something with the bottle on the way (e.g. a
+        Sink capturing messages), or because the route loops or rejoins.
+        """
+        connections = []
+        targets = []
+
+        def next_hops(afilter, forks):
+            # Where afilter.send_on(bottle, fork) would send the bottle on to,
+            # for each fork in turn. None if we can't tell.
+            hops = []
+            next_filter = afilter.next_filter
+            connections.append((afilter, 'next_filter', next_filter))
+            if isinstance(next_filter, HiddenBranchRoute):
+                if next_filter.name == destination or \
+                   next_filter.ftype == destination or \
+                   not _uses_base_methods(next_filter, 
+                                          k_bottle_opening_methods):
+                    return None
+                for fork in forks:
+                    attr_name = dict(main='next_filter',
+                                     branch='branch_filter')[fork]
+                    hop = getattr(next_filter, attr_name)
+                    connections.append((next_filter, attr_name, hop))
+                    if hop is None:
+                        return None
+                    hops.append(hop)
+            elif next_filter and 'main' in forks:
+                hops.append(next_filter)
+            return hops
+
+        seen = set([self])
+        to_visit = next_hops(self, [fork_dest])
+        if to_visit is None:
+            return connections, None
+        to_visit.reverse()
+        while to_visit:
+            afilter = to_visit.pop()
+            if afilter in seen or not _uses_base_methods(
+                                      afilter, k_bottle_opening_methods):
+                return connections, None
+            seen.add(afilter)
+            if afilter.name == destination:
+                targets.append(afilter)
+                continue
+            elif afilter.ftype == destination:
+                targets.append(afilter)
+                if single_use:
+                    continue
+            elif afilter.ftype == 'hidden_branch_route':
+                # Only reached from another HiddenBranchRoute
+                return connections, None
+            if not _uses_base_methods(afilter, k_bottle_passing_methods):
+                return connections, None
+            hops = next_hops(afilter, ['branch', 'main'])
+            if hops is None:
+                return connections, None
+            to_visit.extend(reversed(hops))
+        return connections, targets
+
     def _prime(self):
         """Prime the filter by calling next() on the coroutine, to get it
            ready to receive the first packet of data. This is called 
@@ -688,7 +880,7 @@ class DataFilterBase(object):
         #     been updated
         # Optionally initialise the coroutine, for instance, to set up 
         # calculated parameters
-        self._recurse(['init_filter'])
+        self._recurse(['init_filter', '_init_packet_cache'])
         # Validation can be performed now, unless this filter is part of a
         # pipeline. The pipeline may be doing a _filter_update() that is
         # needed before validation.
@@ -932,8 +1124,15 @@ class DataFilterBase(object):
                     ##raise AttributeError, 'oops'
 
     def filter_data(self, packet):
-        raise FilterError, 'Abstract class: inherit from DataFilter ' + \
-              'or DataFilterExt and override filter_data()'
+        """Send on the packet returned by transform(), unless it is None.
+        A filter without a transform() must override this.
+        """
+        if self.transform is None:
+            raise FilterError, 'Abstract class: inherit from DataFilter ' + \
+                  'or DataFilterExt and override filter_data()'
+        packet = self.transform(packet)
+        if packet is not None:
+            self.send_on(packet)
 
     def flush_buffer(self):
         """Override this for clearing out any buffered data: always before
@@ -944,6 +1143,29 @@ class DataFilterBase(object):
     def init_filter(self):
         pass
 
+    def reset_params(self, **params):
+        """Set new values for one or more keys, then recalculate only the
+        values derived from them, as listed in param_dependencies. Each
+        update method is called once, however many of its keys have changed.
+        """
+        update_names = []
+        update_pipeline = False
+        for param_name, new_value in params.iteritems():
+            setattr(self, param_name, new_value)
+            try:
+                func_names = self.param_dependencies[param_name]
+            except KeyError:
+                # Undeclared key: a pipeline may pass it on to its filters
+                if self.filter_list:
+                    update_pipeline = True
+                continue
+            for func_name in func_names:
+                if func_name not in update_names:
+                    update_names.append(func_name)
+        if update_pipeline:
+            self._recurse(['_coded_update_filters'])
+        self._do_recursive_call(update_names)
+
     def send(self, *packets):
         """For the first filter in the pipeline, send in the starting data.
         This must be a DataPacket object.
@@ -954,6 +1176,8 @@ class DataFilterBase(object):
         if not self._primed:
             self._prime()
         if self._corout:
+            scheduled = PacketScheduler.running_count or \
+                        self.iterative_scheduling
             for packet in packets:
                 # Ensure that the only things being sent around the pipeline
                 # are data packets or message bottles. (The data contained in
@@ -961,7 +1185,45 @@ class DataFilterBase(object):
                 if not issubclass(packet.__class__,  DataPacket):
                     raise DataError, 'Bad type: %s is not a packet' % (
                         packet.__class__.__name__)
-                self._corout.send(packet)
+                if scheduled:
+                    self._call_scheduled(self._corout.send, packet)
+                else:
+                    self._corout.send(packet)
+
+    def _send_bottle_direct(self, bottle, fork_dest):
+        """Send a new message bottle straight to the filters that will open
+        it, instead of passing it through every filter and branch on the way.
+        The filters in between only pass bottles on, and do it at once, so the
+        bottle arrives at the same point relative to the data packets as it
+        would have done.
+
+        The route is planned the first time a bottle for the destination is
+        sent on from this filter, and kept by the refinery until the filters
+        are reconnected. Return False if the bottle must go along the route
+        in the usual way.
+        """
+        refinery = self.refinery
+        if not refinery.direct_bottle_delivery:
+            return False
+        route_key = (self, fork_dest, bottle.destination, bottle.single_use)
+        route = refinery._bottle_routes.get(route_key)
+        if route is None or not _route_unchanged(route[0]):
+            route = self._plan_bottle_route(fork_dest, bottle.destination,
+                                            bottle.single_use)
+            refinery._bottle_routes[route_key] = route
+        targets = route[1]
+        if targets is None:
+            return False
+        bottle.sent_from = self
+        bottle.fork_dest = fork_dest
+        # Targets mustn't send on a bottle for other filters of their ftype
+        bottle._delivered_direct = True
+        try:
+            for target in targets:
+                target.send(bottle)
+        finally:
+            bottle._delivered_direct = False
+        return True
 
     def send_on(self, packet, fork_dest='main'):
         """Send on packets to their destination.
@@ -971,6 +1233,12 @@ class DataFilterBase(object):
         # to branch, if there is a branch filter, else thrown away.
         
         self.before_send_on(packet, fork_dest)
+        # A message bottle that hasn't been sent on before can usually skip
+        # the filters that won't open it.
+        if packet.message and packet.sent_from is None and \
+           self._send_bottle_direct(packet, fork_dest):
+            self.after_send_on(packet, fork_dest)
+            return
         #! TO~DO: Read the comments in the following commented-out-lines to
         #! understand what is trying to be achieved. This has been left
         #! commented out due to lack of testing/understanding of the
@@ -1123,6 +1391,27 @@ class DataFilterBase(object):
         """
         pass
 
+    def export_state(self):
+        """Return a dictionary of the state_attrs values, for merge_state()
+        in another filter of the same type.
+        """
+        if self.state_attrs is None:
+            raise FilterError, 'Filter "%s" has no state to export' % (
+                self.name)
+        return dict((attr_name, getattr(self, attr_name)) 
+                    for attr_name in self.state_attrs)
+
+    def merge_state(self, other):
+        """Add in the state of other, another filter of the same type or the
+        state exported from one, that has processed the data following the
+        data this filter has processed. Override this if the values can't
+        just be combined by merge_values().
+        """
+        if not isinstance(other, dict):
+            other = other.export_state()
+        for attr_name, value in self.export_state().iteritems():
+            setattr(self, attr_name, merge_values(value, other[attr_name]))
+
 
 class DataFilter(DataFilterBase):
     """Basic framework for data filter coroutine, sending packets on after
@@ -1144,14 +1433,7 @@ class DataFilter(DataFilterBase):
                     #except FilterProcessingException, err:
                         #raise
                     except Exception, err:
-                        # Uses the refinery to check _already_raised.
-                        if not hasattr(self.refinery, "_already_raised"):
-                            msg = "Exception in '%s' (%s): %s" \
-                                % (self.name, self.ftype, str(err))
-                            self.refinery._already_raised = True
-                            raise type(err), msg
-                        else:
-                            raise err
+                        _raise_in_filter(self, err)
                 else:
                     self._process_message_bottle(packet)
 
@@ -1167,6 +1449,110 @@ class DataFilter(DataFilterBase):
         self.filter_data(packet)             # The main filtering is done here
         self.after_filter_data(packet)             # Hook 2
 
+    def _init_packet_cache(self):
+        """If cache_size is set, make the packet cache and process data
+        packets through it. Refuse to cache the results of a filter that isn't
+        declared pure, or that keeps state from one packet to the next (it
+        overrides flush_buffer() or close_filter(), or has state_attrs), as
+        its results for a repeated input could differ from the first.
+        """
+        cache_size = fut.convert_config_str(self.cache_size)
+        if not cache_size:
+            return
+        if self.filter_list:
+            msg = 'cache_size can\'t be set for pipeline "%s"'
+            raise FilterAttributeError, msg % self.name
+        if not fut.convert_config_str(self.pure):
+            msg = 'Filter "%s" isn\'t declared pure, so its results can\'t ' \
+                  'be cached. Set "pure = true" if its output depends ' \
+                  'only on each packet.'
+            raise FilterAttributeError, msg % self.name
+        if self.state_attrs is not None or not _uses_base_methods(
+                                   self, ('flush_buffer', 'close_filter')):
+            msg = 'Filter "%s" keeps state between packets, so its ' \
+                  'results can\'t be cached'
+            raise FilterAttributeError, msg % self.name
+        cache_attrs = self.cache_attrs
+        if isinstance(cache_attrs, basestring):
+            cache_attrs = [cache_attrs]
+        if cache_attrs:
+            get_attrs = operator.attrgetter(*cache_attrs)
+            self._cache_key = lambda packet: (packet.data, get_attrs(packet))
+        else:
+            # The data alone, without building a tuple for each packet
+            self._cache_key = operator.attrgetter('data')
+        self.packet_cache = fut.LruCache(
+            cache_size, fut.convert_config_str(self.cache_bytes))
+        # Packets sent on while _cache_outputs is a list are recorded in it.
+        # send_on is wrapped once here rather than for each packet missing the
+        # cache. The route optimisations look at the class's send_on(), so
+        # they aren't affected by the wrapper.
+        self._cache_outputs = None
+        self._class_send_on = self.__class__.send_on.__get__(self)
+        self.send_on = self._record_and_send_on
+        self._process_data_packet = self._process_data_packet_cached
+
+    def _record_and_send_on(self, out_packet, fork_dest='main'):
+        """Send on the packet, first recording it against the packet being
+        processed if it missed the packet cache.
+        """
+        if self._cache_outputs is not None:
+            before = self._cache_input
+            after = out_packet.__dict__
+            if out_packet.__class__ is self._cache_input_class:
+                changed = dict(
+                    (name, value) for name, value in after.iteritems()
+                    if name not in k_packet_routing_attrs and
+                    (name not in before or before[name] is not value))
+                removed = [name for name in before if name not in after and
+                           name not in k_packet_routing_attrs]
+            else:
+                changed = after.copy()
+                removed = None
+            self._cache_outputs.append((out_packet.__class__, changed,
+                                        removed, fork_dest))
+            self._cache_sizes.append(out_packet.data_length)
+        self._class_send_on(out_packet, fork_dest)
+
+    def _process_data_packet_cached(self, packet):
+        """Send on the packets recorded for an earlier packet with the same
+        data and cache_attrs, or else process the packet as usual, recording
+        the packets sent on. Each recorded packet is kept as the attributes,
+        including data, that it didn't share with its input packet, to be
+        applied to a clone of the new input packet. The recorded values are
+        shared by all the packets sent on for them, not copied.
+        """
+        try:
+            key = self._cache_key(packet)
+            outputs = self.packet_cache.get(key)
+        except TypeError:
+            # Unhashable data or attributes
+            DataFilter._process_data_packet(self, packet)
+            return
+        if outputs is not None:
+            send_on = self._class_send_on
+            for packet_class, changed, removed, fork_dest in outputs:
+                if packet_class is packet.__class__:
+                    out_packet = packet.clone()
+                    for attr_name in removed:
+                        out_packet.__dict__.pop(attr_name, None)
+                else:
+                    # e.g. a message bottle, kept whole
+                    out_packet = packet_class.__new__(packet_class)
+                out_packet.__dict__.update(changed)
+                send_on(out_packet, fork_dest)
+            return
+        outputs = self._cache_outputs = []
+        sizes = self._cache_sizes = [packet.data_length]
+        self._cache_input = packet.__dict__.copy()
+        self._cache_input_class = packet.__class__
+        try:
+            DataFilter._process_data_packet(self, packet)
+        finally:
+            self._cache_outputs = self._cache_sizes = None
+            self._cache_input = None
+        self.packet_cache.put(key, outputs, sum(sizes))
+
     def _process_message_bottle(self, packet):
         
         
@@ -1182,9 +1568,10 @@ class DataFilter(DataFilterBase):
             # we also want to send this on for other filters of the 
             # same type to open the message unless the message only
             # has a single_use flag set.
-            if not packet.single_use:
-                self.send_on(packet, 'branch', optional=True)
-                self.send_on(packet, 'main')                        
+            if not packet.single_use and \
+               not getattr(packet, '_delivered_direct', False):
+                self.send_on(packet, 'branch')
+                self.send_on(packet, 'main')
         elif self.ftype == 'hidden_branch_route':
             # Message bottles will now travel down every branch:
             # small hack (TO-DO discuss) to ensure that messages
@@ -1252,7 +1639,8 @@ class DataFilter(DataFilterBase):
         """Open the message bottle, and take appropriate action.
         We know what to do with these general purpose commands, applying
         generally to any filter:
-            reset
+            reset          (param_name, new_value)
+            reset_params   (params, a dictionary of new values)
 
         Other functionality may be needed, specific to one filter. In this
         case, override the open_message_bottle() in the filter. 
@@ -1263,11 +1651,10 @@ class DataFilter(DataFilterBase):
 ##            new_value = eval(str(packet.expression))
 ##            print '**10245** Reset %s parameter "%s" to "%s"' % (
 ##                self.name, packet.param_name, packet.new_value)
-            setattr(self, packet.param_name, packet.new_value)
             # Now input params have been changed, ensure that effect is seen
-##            self.update_filters()
-            # Well-spotted Chris!
-            self._recurse(['_coded_update_filters'])  
+            self.reset_params(**{packet.param_name:packet.new_value})
+        elif packet.message == 'reset_params':
+            self.reset_params(**packet.params)
         else:
             e_msg = "'%s' open_message_bottle does not recognise message '%s'"
             raise MessageError, e_msg % (self.name, packet.message)
@@ -1485,6 +1872,7 @@ class HiddenBranchRoute(DataFilter):
     Since it is never created by ftype, we need to set ftype manually.
     """
     ftype = 'hidden_branch_route'
+    side_effects = False
 
     def _close(self):
         """Override base functionality to ensure branches are closed as well.
@@ -1504,6 +1892,68 @@ class HiddenBranchRoute(DataFilter):
         route_dict[fork_destination].send(packet)
 
 
+def make_fused_transform(filters):
+    """Generate a function that calls the transform() of each filter in turn
+    with the packet returned by the one before, stopping if one returns None.
+    An exception in a transform() is reported against its own filter, not
+    the FusedFilters.
+    """
+    lines = ['def fused_transform(packet):']
+    namespace = dict(_raise_in_filter=_raise_in_filter)
+    for j, afilter in enumerate(filters):
+        transform_name = 'transform_%d' % j
+        namespace[transform_name] = afilter.transform
+        namespace['filter_%d' % j] = afilter
+        lines.append('    try:')
+        lines.append('        packet = %s(packet)' % transform_name)
+        lines.append('    except Exception, err:')
+        lines.append('        _raise_in_filter(filter_%d, err)' % j)
+        if j < len(filters) - 1:
+            lines.append('    if packet is None:')
+            lines.append('        return None')
+    lines.append('    return packet')
+    exec '\n'.join(lines) + '\n' in namespace
+    return namespace['fused_transform']
+
+
+class FusedFilters(DataFilter):
+    """Run a linear section of the route, made of filters that each have a
+    transform(packet) method, as one filter. Each data packet goes through
+    the section with a single coroutine send(), calling the transforms from
+    a function generated by make_fused_transform().
+
+    Made by Pipeline.fuse_filters(), not by ftype. The fused filters keep
+    their key values, can be found with getf(), and still open the message
+    bottles sent to them, but are never primed themselves.
+    """
+    ftype = 'fused_filters'
+
+    def __init__(self, **kwargs):
+        # fused_filters must be in kwargs
+        DataFilter.__init__(self, **kwargs)
+        self.name = '+'.join(afilter.name for afilter in self.fused_filters)
+        self.transform = make_fused_transform(self.fused_filters)
+
+    def _process_message_bottle(self, packet):
+        """Let the fused filters open the bottle in turn, as if it were going
+        from one to the next.
+        """
+        for afilter in self.fused_filters:
+            if afilter.name == packet.destination:
+                afilter.open_message_bottle(packet)
+                return
+            elif afilter.ftype == packet.destination:
+                afilter.open_message_bottle(packet)
+                if packet.single_use:
+                    return
+        self.send_on(packet, 'branch')
+        self.send_on(packet, 'main')
+
+    def zero_inputs(self):
+        for afilter in self.fused_filters:
+            afilter.zero_inputs()
+
+
 class MessageBottle(DataPacket):
     """Message is a type of data packet, usually with only one-time use.
     MessageBottle    -----TO-DO-----
@@ -1535,6 +1985,69 @@ class MessageBottle(DataPacket):
                             single_use=single_use, **kwargs)
 
 
+class PacketScheduler(object):
+    """Run the filters from a stack of work to do, instead of each filter
+    calling send() on the next from inside its own send(). The Python stack
+    then stays the same depth however long the route, and a filter can send
+    packets back to a filter before it without getting ValueError:
+    "generator already executing", which TankFeed works around otherwise.
+
+    Whatever a filter sends on (or closes) while handling one packet is held
+    until it has finished, then delivered in the order sent, each followed by
+    everything that leads to, before the next. So packets arrive along each
+    connection in the same depth-first order as with nested calls. What
+    differs is that a filter doesn't see the effects further down the route
+    of a packet it has sent on until its filter_data() has returned.
+
+    A scheduler starts when packets are sent in to a filter or pipeline with
+    iterative_scheduling set, and runs until all the work is done. Filters
+    further on join the running scheduler for the thread.
+    """
+    _thread_state = threading.local()
+    _count_lock = threading.Lock()
+    running_count = 0  # Schedulers running, in all threads
+
+    def __init__(self):
+        self._outputs = None
+
+    @classmethod
+    def current(cls):
+        """Return the scheduler running in this thread, or None.
+        """
+        if cls.running_count:
+            return cls._thread_state.__dict__.get('scheduler')
+        return None
+
+    def _change_count(self, change):
+        with self._count_lock:
+            PacketScheduler.running_count += change
+
+    def add(self, func, *args):
+        """Call func(*args) when the call being made now has finished.
+        """
+        self._outputs.append((func, args))
+
+    def run(self, func, *args):
+        """Call func(*args), and then all the calls added as a result.
+        """
+        self._thread_state.scheduler = self
+        self._change_count(1)
+        try:
+            work = [(func, args)]
+            while work:
+                func, args = work.pop()
+                self._outputs = outputs = []
+                func(*args)
+                if outputs:
+                    # First sent is next to go
+                    outputs.reverse()
+                    work.extend(outputs)
+        finally:
+            self._outputs = None
+            self._thread_state.scheduler = None
+            self._change_count(-1)
+
+
 class PriorityQueue(object):
     """Priority queue to enable looping, using TankQueue and TankFeed. List is
     sorted by heapq, using priority as the first sort field. If priorities are
@@ -126,6 +126,7 @@ class SumBits(dfb.DataFilter):
     should not change.
     """
     ftype = 'sum_bits'
+    state_attrs = ['byte_count', 'bit_sum']
          
     def filter_data(self, packet):
         self.bit_sum += fut.bit_sum(packet.data)
@@ -141,6 +142,7 @@ class SumBytes(dfb.DataFilter):
     """However much the bytes are shuffled, their sum should not change.
     """
     ftype = 'sum_bytes'
+    state_attrs = ['byte_count', 'byte_sum', 'byte_dict']
     
     def filter_data(self, packet):
         for char in packet.data:
@@ -161,6 +163,7 @@ class SumNibbles(dfb.DataFilter):
     should not change.
     """
     ftype = 'sum_nibbles'
+    state_attrs = ['byte_count', 'nibble_sum', 'nibble_dict']
 
     def filter_data(self, packet):
         for char in packet.data:
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Run pipelines from sockets, pipes and subprocesses, so that waiting for
+data on one stream doesn't hold up all the others.
+
+An EventLoop waits with select() on all the streams it has been given, and
+can run many refineries in one thread. Each StreamSource reads whatever has
+arrived on its stream and sends it in to its pipeline as a DataPacket. The
+filters then run synchronously, as they always do, so they need no changes.
+A pipeline sending its output to a stream ends in a WriteStream filter,
+registered with add_output(). While a WriteStream has more than high_water
+bytes waiting to be written, the sources of its refinery are not read, which
+gives back-pressure all the way to the source.
+
+select() works only with sockets on Windows, so there pipes and subprocesses
+can't be used.
+"""
+
+import fcntl
+import os
+import select
+import subprocess
+
+import filterpype.data_fltr_base as dfb
+
+
+def set_non_blocking(stream):
+    """Make reads and writes on a socket or file descriptor return at once.
+    """
+    if hasattr(stream, 'setblocking'):
+        stream.setblocking(0)
+    else:
+        fd = stream.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class StreamSource(object):
+    """Read data from a socket, pipe or file object as it arrives, and send
+    it in to the pipeline. Each packet has the running total of bytes read
+    as read_bytes, like the packets from ReadBatch.
+
+    When the stream ends, the EventLoop shuts down the refinery, once all its
+    other sources have ended too, unless shut_down_at_end is False.
+    """
+
+    def __init__(self, stream, pipeline, read_size=0x2000, 
+                 shut_down_at_end=True):
+        self.stream = stream
+        self.pipeline = pipeline
+        self.read_size = read_size
+        self.shut_down_at_end = shut_down_at_end
+        self.bytes_read = 0
+        self.finished = False
+
+    def close(self):
+        self.finished = True
+        self.stream.close()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def read(self):
+        """Read what has arrived, which must not block, and send it in to the
+        pipeline. Close the stream at the end of the data.
+        """
+        if hasattr(self.stream, 'recv'):
+            data = self.stream.recv(self.read_size)
+        else:
+            data = os.read(self.stream.fileno(), self.read_size)
+        if not data:
+            self.close()
+            return
+        self.bytes_read += len(data)
+        self.pipeline.send(dfb.DataPacket(data, read_bytes=self.bytes_read))
+
+
+class ProcessSource(StreamSource):
+    """Run a command, reading its standard output. returncode is set when
+    the output has ended and the process has finished.
+    """
+
+    def __init__(self, args, pipeline, **kwargs):
+        # Without close_fds, the process could keep other streams of the
+        # loop open, so they wouldn't end.
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                        close_fds=True)
+        self.returncode = None
+        StreamSource.__init__(self, self.process.stdout, pipeline, **kwargs)
+
+    def close(self):
+        StreamSource.close(self)
+        self.returncode = self.process.wait()
+
+
+class EventLoop(object):
+    """Read from sources and write to outputs as they become ready, until all
+    the sources have ended and all the output has been written.
+    """
+
+    def __init__(self):
+        self.sources = []
+        self.outputs = []
+
+    def _readers(self):
+        """Return the sources that haven't ended, and aren't held back by
+        output from their refinery waiting to be written.
+        """
+        full_refineries = set(output.refinery for output in self.outputs
+                              if output.pending_bytes > output.high_water)
+        return [source for source in self.sources if not source.finished 
+                and source.pipeline.refinery not in full_refineries]
+
+    def _source_ended(self, source):
+        refinery = source.pipeline.refinery
+        for other in self.sources:
+            if not other.finished and other.pipeline.refinery is refinery:
+                return
+        if source.shut_down_at_end:
+            refinery.shut_down()
+
+    def add_output(self, write_stream, stream):
+        """Set the stream for a WriteStream filter to write to, without
+        blocking.
+        """
+        set_non_blocking(stream)
+        write_stream.stream = stream
+        self.outputs.append(write_stream)
+
+    def add_source(self, source):
+        self.sources.append(source)
+        return source
+
+    def run(self, timeout=None):
+        """Run until everything has been read and written, and return True,
+        or return False if no stream was ready for timeout seconds.
+        """
+        while True:
+            readers = self._readers()
+            writers = [output for output in self.outputs 
+                       if output.pending_bytes]
+            if not readers and not writers:
+                return True
+            readable, writable = select.select(readers, writers, [], 
+                                               timeout)[:2]
+            if not readable and not writable:
+                return False
+            for output in writable:
+                output.write_pending()
+            for source in readable:
+                source.read()
+                if source.finished:
+                    self._source_ended(source)
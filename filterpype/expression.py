@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""A small, safe expression language for filter keys, e.g.
+
+    expr = p.altitude > 1000 and p.speed < f.compare_value
+
+"p" is the packet and "f" is the filter using the expression, so an
+expression can compare packet attributes with the filter's own keys, which
+may be reset while the pipeline runs. The expression is checked and
+compiled once, by compile_expression(), into a Python function of
+(packet, afilter), so nothing is looked up by name for each packet.
+
+Expressions are Python expressions limited to:
+
+    constants       numbers, strings, True, False, None, lists and tuples
+    attributes      p.name, not starting with "_", and f.name, where name
+                    is one of the filter's keys, if filter_keys are given
+    operators       + - * / // % **, comparisons (including chained, "in",
+                    "not in", "is" and "is not"), and, or, not,
+                    x if condition else y. The exponent of ** must be a
+                    number of at most k_max_exponent, and not of a power
+                    itself, so that no power takes too long to work out
+    indexing        e.g. p.values[0], p.data[2:4]
+    functions       those in k_functions, e.g. abs(p.roll) < 30
+
+Anything else, e.g. other names, other calls or lambdas, raises
+FilterAttributeError when the expression is compiled.
+"""
+
+import ast
+
+import filterpype.data_fltr_base as dfb
+
+k_packet_name = 'p'
+k_filter_name = 'f'
+k_functions = dict(abs=abs, bool=bool, float=float, int=int, len=len,
+                   max=max, min=min, round=round, str=str)
+k_constants = ('True', 'False', 'None')
+k_max_exponent = 100
+
+# Node types allowed in an expression, apart from names and calls, which are
+# checked separately
+k_allowed_nodes = (
+    ast.Expression, ast.Attribute, ast.BoolOp, ast.BinOp, ast.UnaryOp,
+    ast.Compare, ast.IfExp, ast.Num, ast.Str, ast.List, ast.Tuple,
+    ast.Subscript, ast.Index, ast.Slice, ast.Load,
+    ast.And, ast.Or, ast.Not, ast.USub, ast.UAdd,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn,
+    ast.Is, ast.IsNot,
+)
+
+# Compiled functions and the filter attributes they use, by expression,
+# shared by all the filters using them
+_compiled = {}
+
+
+def _check_node(node, text):
+    """Raise FilterAttributeError if node, or any node inside it, is not
+    allowed in an expression.
+    """
+    if isinstance(node, ast.Name):
+        if node.id not in (k_packet_name, k_filter_name) + k_constants:
+            msg = 'Unknown name "%s" in expression "%s"'
+            raise dfb.FilterAttributeError, msg % (node.id, text)
+    elif isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or \
+           node.func.id not in k_functions or \
+           node.keywords or node.starargs or node.kwargs:
+            msg = 'Only calls of %s are allowed in expression "%s"'
+            raise dfb.FilterAttributeError, msg % (
+                ', '.join(sorted(k_functions)), text)
+        for arg in node.args:
+            _check_node(arg, text)
+        return
+    elif isinstance(node, ast.Attribute):
+        if node.attr.startswith('_') or \
+           not isinstance(node.value, ast.Name) or \
+           node.value.id not in (k_packet_name, k_filter_name):
+            msg = 'Attribute "%s" must be of p or f, and not start with "_" ' \
+                  'in expression "%s"'
+            raise dfb.FilterAttributeError, msg % (node.attr, text)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+        exponent = node.right
+        if isinstance(exponent, ast.UnaryOp) and \
+           isinstance(exponent.op, (ast.USub, ast.UAdd)):
+            exponent = exponent.operand
+        if not isinstance(exponent, ast.Num) or \
+           abs(exponent.n) > k_max_exponent or \
+           any(isinstance(child, ast.Pow) for child in ast.walk(node.left)):
+            msg = 'The exponent of ** must be a number of at most %d, and ' \
+                  'not of another power, in expression "%s"'
+            raise dfb.FilterAttributeError, msg % (k_max_exponent, text)
+    elif not isinstance(node, k_allowed_nodes):
+        msg = '%s is not allowed in expression "%s"'
+        raise dfb.FilterAttributeError, msg % (node.__class__.__name__, text)
+    for child in ast.iter_child_nodes(node):
+        _check_node(child, text)
+
+def _filter_attrs(tree):
+    """Return the set of the names of the filter attributes in the tree.
+    """
+    return set(node.attr for node in ast.walk(tree)
+               if isinstance(node, ast.Attribute) and
+               isinstance(node.value, ast.Name) and
+               node.value.id == k_filter_name)
+
+def compile_expression(text, filter_keys=None):
+    """Return a function of (packet, afilter) that evaluates the expression.
+    If filter_keys is given, the only filter attributes allowed are the
+    keys listed, e.g. afilter._keys.
+    """
+    try:
+        function, filter_attrs = _compiled[text]
+    except KeyError:
+        function, filter_attrs = _compile(text)
+        _compiled[text] = function, filter_attrs
+    if filter_keys is not None:
+        unknown = filter_attrs.difference(filter_keys)
+        if unknown:
+            msg = 'f.%s is not one of the filter\'s keys in expression "%s"'
+            raise dfb.FilterAttributeError, msg % (sorted(unknown)[0], text)
+    return function
+
+def _compile(text):
+    """Return (function, filter attribute names) for the expression.
+    """
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError, err:
+        raise dfb.FilterAttributeError, 'Bad expression "%s": %s' % (
+            text, err)
+    _check_node(tree, text)
+    # All names in the expression are now known to be p, f, the constants
+    # or the functions, so nothing else can be reached from it.
+    namespace = dict(k_functions, __builtins__={})
+    namespace.update({'True': True, 'False': False, 'None': None})
+    arguments = ast.arguments(args=[ast.Name(id=name, ctx=ast.Param())
+                                     for name in (k_packet_name,
+                                                  k_filter_name)],
+                              vararg=None, kwarg=None, defaults=[])
+    lambda_tree = ast.Expression(body=ast.Lambda(args=arguments,
+                                                 body=tree.body))
+    code = compile(ast.fix_missing_locations(lambda_tree), '<expression>',
+                   'eval')
+    return eval(code, namespace), _filter_attrs(tree)
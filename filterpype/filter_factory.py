@@ -42,6 +42,7 @@ class FilterFactory(object):
             callback_on_multiple_attributes = df.CallbackOnMultipleAttributes,
             collect_data            = df.CollectData,
             combine                 = df.Combine,
+            compress                = df.Compress,
             concat_path             = df.ConcatPath,
             convert_bytes_to_int    = df.ConvertBytesToInt,
             convert_filename_to_path= df.ConvertFilenameToPath, # TO-DO remove
@@ -50,26 +51,34 @@ class FilterFactory(object):
             count_loops             = df.CountLoops, 
             count_packets           = df.CountPackets,
             data_length             = df.DataLength,
+            decompress              = df.Decompress,
             dedupe_data             = df.DedupeData,
             distill_header          = df.DistillHeader,
+            filter_where            = df.FilterWhere,
             format_param            = df.FormatParam, 
             get_bytes               = df.GetBytes,
+            hash_multi              = df.HashMulti,
             hash_sha256             = df.HashSHA256,
             header_as_attribute     = df.HeaderAsAttribute,
             hidden_branch_route     = dfb.HiddenBranchRoute,            
             join                    = df.Join,
+            merge                   = df.Merge,
             null                    = df.Waste,
             pass_non_zero           = df.PassNonZero,
             pass_through            = df.PassThrough,
             peek                    = df.Peek,
             print_param             = df.PrintParam,
+            process_boundary        = df.ProcessBoundary,
+            progress_meter          = df.ProgressMeter,
             py                      = df.EmbedPython,
             read_batch              = df.ReadBatch,
             read_bytes              = df.ReadBytes,
             rename_file             = df.RenameFile,
+            reorder                 = df.Reorder,
             reset                   = df.Reset,
             r111eset_branch         = df.R111esetBranch,
             reverse_string          = df.ReverseString,
+            route_by                = df.RouteBy,
             swap_two_bytes          = df.SwapTwoBytes,
             send_message            = df.SendMessage,
             seq_packet              = df.SeqPacket,
@@ -82,10 +91,12 @@ class FilterFactory(object):
             tank_branch             = df.TankBranch,
             tank_feed               = df.TankFeed,
             tank_queue              = df.TankQueue,
+            thread_boundary         = df.ThreadBoundary,
             waste                   = df.Waste,     # Also 'null'
             wrap                    = df.Wrap,
             write_configobj_file    = df.WriteConfigObjFile,
             write_file              = df.WriteFile,
+            write_stream            = df.WriteStream,
             
             check_essential_keys    = ppln.CheckEssentialKeys,
             extract_many_attributes = ppln.ExtractManyAttributes,
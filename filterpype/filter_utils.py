@@ -8,6 +8,11 @@ import glob
 import uuid
 import string
 import struct
+import collections
+import threading
+import hashlib
+import zlib
+import Queue
 
 _bit_sum_dict = {}
 
@@ -403,6 +408,96 @@ def latest_defaults(keys):
             keys_out.append(bare_key)
     return keys_out
 
+class LruCache(object):
+    """Dictionary of at most max_entries items, of total size at most
+    max_bytes (if not 0), discarding the least recently used items to make
+    room. get() counts the hits and misses, and put() the evictions.
+    """
+
+    def __init__(self, max_entries, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key: (value, size), oldest first
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        self._items.clear()
+        self.total_bytes = 0
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as the most recently used,
+        or default if there is none.
+        """
+        # dict.get() is much faster than OrderedDict.pop() for a miss
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        del self._items[key]
+        self._items[key] = item
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value, size=0):
+        """Add or replace the value for key. A value larger than max_bytes
+        isn't kept.
+        """
+        if key in self._items:
+            self.total_bytes -= self._items.pop(key)[1]
+        if self.max_bytes and size > self.max_bytes:
+            return
+        while self._items and (len(self._items) >= self.max_entries or
+               self.max_bytes and self.total_bytes + size > self.max_bytes):
+            self.total_bytes -= self._items.popitem(last=False)[1][1]
+            self.evictions += 1
+        self._items[key] = (value, size)
+        self.total_bytes += size
+
+    def stats(self):
+        """Return a dictionary of the cache statistics.
+        """
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+        return dict(hits=self.hits, misses=self.misses, hit_rate=hit_rate,
+                    evictions=self.evictions, entries=len(self._items),
+                    total_bytes=self.total_bytes)
+
+class ZlibChecksum(object):
+    """Running crc32 or adler32 checksum, with the update() and hexdigest()
+    methods of the hashlib objects.
+    """
+    start_values = dict(crc32=0, adler32=1)
+
+    def __init__(self, name):
+        self.name = name
+        self._func = getattr(zlib, name)
+        self.value = self.start_values[name]
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+    def update(self, data):
+        self.value = self._func(data, self.value)
+
+def make_hasher(name):
+    """Return a new hashlib object for the algorithm name, e.g. 'sha256', or
+    a ZlibChecksum for 'crc32' or 'adler32'. ValueError is raised for an
+    unknown name.
+    """
+    if name in ZlibChecksum.start_values:
+        return ZlibChecksum(name)
+    return hashlib.new(name)
+
 def make_dict(*args, **kwargs):
     """Ease the dictionary making process by removing the need for quoting
        the keys.  \*args is for tuples coming from an existing dictionary,
@@ -462,6 +557,141 @@ def pypes_for_dict_gen(file_dir):
 ##        print '**10550**', short_file_name, file_name
         yield short_file_name, file_name
         
+class CallbackDispatcher(threading.Thread):
+    """Daemon thread making callbacks in the order they were dispatched,
+    so that a slow callback doesn't hold up the caller.
+
+    At most queue_size callbacks wait to be made. When the queue is full,
+    the overflow policy decides what happens to a new one:
+        block        wait for room in the queue
+        drop_oldest  discard the oldest waiting callback (counted in dropped)
+        coalesce     replace the newest waiting callback if it has the same
+                     key, or else wait. Order is kept, because only the
+                     latest of a run of similar callbacks is replaced.
+
+    An exception raised by a callback is re-raised in the calling thread by
+    the next dispatch() or by finish(). Later callbacks are not made, even
+    once the exception has been raised: failed stays True.
+    """
+    overflow_policies = ('block', 'drop_oldest', 'coalesce')
+
+    def __init__(self, queue_size=100, overflow='block', name=None):
+        threading.Thread.__init__(self, name=name)
+        if overflow not in self.overflow_policies:
+            raise ValueError, "Overflow policy '%s' is not one of %s" % (
+                overflow, ', '.join(self.overflow_policies))
+        self.daemon = True
+        self.queue_size = max(1, queue_size)
+        self.overflow = overflow
+        self.error = None
+        self.failed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._stopping = False
+
+    def dispatch(self, key, func, *args, **kwargs):
+        self.raise_error()
+        with self._condition:
+            while len(self._items) >= self.queue_size:
+                if self.overflow == 'drop_oldest':
+                    self._items.popleft()
+                    self.dropped += 1
+                    break
+                if self.overflow == 'coalesce' and self._items[-1][0] == key:
+                    self._items.pop()
+                    self.coalesced += 1
+                    break
+                self._condition.wait()
+            self._items.append((key, func, args, kwargs))
+            self._condition.notify_all()
+
+    def finish(self):
+        """Make all the waiting callbacks, stop the thread and re-raise any
+        exception from a callback.
+        """
+        if self.is_alive():
+            with self._condition:
+                self._stopping = True
+                self._condition.notify_all()
+            self.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error:
+            err_type, err_value, err_traceback = self.error
+            self.error = None
+            raise err_type, err_value, err_traceback
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._items and not self._stopping:
+                    self._condition.wait()
+                if not self._items:
+                    break
+                key, func, args, kwargs = self._items.popleft()
+                self._condition.notify_all()
+            if not self.failed:
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    self.error = sys.exc_info()
+                    self.failed = True
+
+
+class QueueWorker(threading.Thread):
+    """Daemon thread that calls func(item) for each item put on a bounded
+    queue, strictly in the order the items were put. put() blocks when
+    queue_size items are waiting, which gives back-pressure to the caller.
+
+    An exception raised by func is kept, and re-raised in the calling thread
+    by every later put() and by finish(), so that errors are not lost in
+    the background. Once func has failed, failed is True and all the items
+    still queued, or put later, are discarded, so that nothing is written
+    after a failed write.
+    """
+    _stop_marker = object()
+
+    def __init__(self, func, queue_size=0, name=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.func = func
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.failed = False
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._stop_marker:
+                break
+            if not self.failed:
+                try:
+                    self.func(item)
+                except Exception:
+                    self.error = sys.exc_info()
+                    self.failed = True
+
+    def finish(self):
+        """Wait until all the queued items have been processed, stop the
+        thread and re-raise any exception from func.
+        """
+        if self.is_alive():
+            self.queue.put(self._stop_marker)
+            self.join()
+        self.raise_error()
+
+    def put(self, item):
+        self.raise_error()
+        self.queue.put(item)
+
+    def raise_error(self):
+        if self.failed:
+            err_type, err_value, err_traceback = self.error
+            raise err_type, err_value, err_traceback
+
 def random_file_name(ext='.dat'):
     """Returns a unique random file name generated as a UUID string. This is
     statistically guaranteed to avoid a name clash.
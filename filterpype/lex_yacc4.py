@@ -2,8 +2,9 @@
 
 """Tokenises and parses the route part of a filter config in a pipeline.
    
-Remember to delete lextab.py/.pyc and parsetab.py/.pyc if anything changes,
-otherwise the previous version will be used.
+PLY caches the tables built from the grammar in lextab_<n>.py and
+parsetab_<n>.py, n being k_grammar_version. Increase k_grammar_version if
+anything changes, otherwise the previous version will be used.
 """
 import sys
 import ply.lex as lex
@@ -12,10 +13,14 @@ from ply.lex import TOKEN
 
 import filterpype.filter_utils as fut
 
-# Format temporary filter label as %4.4d for a maximum of 10**(n-1) filters
+# Format temporary filter label as %6.6d for a maximum of 10**(n-1) filters
+k_label_digits = 6
 k_label_sep = '~'
-k_filter_format = '%4.4d' + k_label_sep + '%s'
-k_fork_filter_format = '%4.4d' + k_label_sep + 'hidden_branch_route_%2.2d'
+k_filter_format = '%6.6d' + k_label_sep + '%s'
+k_fork_filter_format = '%6.6d' + k_label_sep + 'hidden_branch_route_%2.2d'
+# Names the tables cached by PLY, so that tables left from an older grammar
+# aren't used
+k_grammar_version = 2
 
 
 route1 = '''
@@ -62,24 +67,29 @@ class RouteParser(object):
     """Parse the pipeline route, defined by a list of filters, with embedded
     parentheses.
     """
-    # If any of these are changed, remember to remove lextab.py/c and
-    # parsetab.py/c from main and tests directories, otherwise the old code
-    # will continue to run.
+    # If any of these are changed, remember to increase k_grammar_version,
+    # otherwise the old code will continue to run.
     digit = r'([0-9])'
     nondigit = r'([_A-Za-z\.\:\-%\$\{\}])'  
     identifier = r'(' + nondigit + r'(' + digit + r'|' + nondigit + r')*)' 
     comment = r'(\#).*'
     
+    # Start of a named output of a route_by filter, e.g. "[red:"
+    output = r'\[[^\]\s:]+:'
+    
     tokens = (
         'FILTER',
         'LPAREN',
         'RPAREN',
         'JOINTO',
+        'OUTPUT',
+        'RBRACKET',
     )
 
     t_LPAREN  = r'\('
     t_RPAREN  = r'\)'
     t_JOINTO = r'>>>'
+    t_RBRACKET = r'\]'
     
     # A string containing ignored characters (spaces and tabs)
     t_ignore  = ' \t'
@@ -87,9 +97,11 @@ class RouteParser(object):
     def __init__(self, debug=False):
         self.debug = debug
         # Build the lexer, ready for later running Python with optimisation on
-        self.lexer = lex.lex(object=self, debug=0, optimize=1)
+        self.lexer = lex.lex(object=self, debug=0, optimize=1,
+                             lextab='lextab_%d' % k_grammar_version)
         # Build the parser, ready for later running Python with optimisation on
-        self.parser = yacc.yacc(module=self, debug=0, optimize=1)   
+        self.parser = yacc.yacc(module=self, debug=0, optimize=1,
+                                tabmodule='parsetab_%d' % k_grammar_version)
         self.fork_stack = []
         self.filter_dict = {}
 ##        print '**3710** RouteParser, in self.__init__()'
@@ -172,8 +184,8 @@ class RouteParser(object):
     def _start_branch(self, prev_pipe):
         self.branch_counter += 1
         prev_filter = prev_pipe.split()[-1]
-        # Split off the four-digit label from the filter; add 5 to value
-        # e.g. 0010~some_filter  -->  15
+        # Split off the six-digit label from the filter; add 5 to value
+        # e.g. 000010~some_filter  -->  15
         prefix = int(prev_filter.split(k_label_sep)[0]) + 5
         # Generate fork_filter name, e.g. 0015~hidden_branch_route_01
         fork_filter = k_fork_filter_format % (prefix, self.branch_counter)
@@ -200,12 +212,13 @@ class RouteParser(object):
         route3 = self.parser.parse('(%s\n)' % route2, 
                                    debug=debug, tracking=tracking)
         if route3:
-            route4 = route3.split('None ')[1]  # Remove leading None
+            route4 = route3.split('None ', 1)[1]  # Remove leading None
             if not route4[0] == '(' or not route4[-1] == ')':
                 raise SyntaxError, 'Bad parentheses in "%s"' % route4
             route_with_prefixes = route4[1:-1]  # Remove outer parentheses
+            label_regex = r'\d{%d}%s' % (k_label_digits, k_label_sep)
             route5 = fut.strip_prefixes(route_with_prefixes,
-                                         prefix_regex=r'\d\d\d\d' + k_label_sep)
+                                         prefix_regex=label_regex)
             self.connections.sort()
             connections2_gen = (link.split() for link in self.connections)
             connections3 = [self.remake_connection(*link2) 
@@ -326,6 +339,35 @@ D
         ##self._connect_pipes(p[1], p[3], 'pipe4')
         ##p[0] = the_pipe
     
+    def p_pipe4(self, p):
+        "pipe : pipe JOINTO outputs FILTER"
+        # Named outputs of a route_by filter, e.g.
+        #     route_by:colour >>> [red: A >>> B] [blue: C] D
+        # As with a branch, the trailing FILTER is the main output, which
+        # here takes the packets that have no output of their own.
+        filter_from = p[1].split()[-1].strip('()')
+        for label, output_pipe in p[3]:
+            filter_to = output_pipe.split()[0].strip('()')
+            self.connections.append('%s [%s] %s' % (filter_from, label,
+                                                    filter_to))
+        self._connect_pipes(p[1], p[4], 'pipe4')
+        p[0] = ' '.join([p[1]] + ['[%s: %s]' % output for output in p[3]] + 
+                        [p[4]])
+
+    def p_outputs1(self, p):
+        "outputs : output"
+        p[0] = [p[1]]
+
+    def p_outputs2(self, p):
+        "outputs : outputs output"
+        p[0] = p[1] + [p[2]]
+
+    def p_output(self, p):
+        "output : OUTPUT pipe RBRACKET"
+        # Nothing follows the end of the output route
+        self._connect_pipes(p[2].split()[-1], None, 'output')
+        p[0] = (p[1], p[2])
+
     def p_branch(self, p):
         "branch : LPAREN start_branch pipe RPAREN end_branch"
 ##        print '**2196** yacc: Branch pipe found = (%s)' % p[3]
@@ -377,6 +419,11 @@ D
                                  conn_type, 
                                  fut.strip_prefix(link_to, k_label_sep))
 
+    @TOKEN(output)
+    def t_OUTPUT(self, t):
+        t.value = t.value[1:-1]  # Output name
+        return t
+
     @TOKEN(identifier)
     def t_FILTER(self, t):
         self.filter_dict[t.value.lower()] = t.value
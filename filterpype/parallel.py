@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Support for running part of a route in a worker process, used by the
+ProcessBoundary filter.
+
+Packets go from one process to the other through a RingBuffer: a bounded
+byte stream in shared memory (an anonymous mmap), written by one process and
+read by the other, strictly in order. Only the packet's attributes are
+pickled, as a compact header; string data is copied into the buffer as it
+is, by encode_packet().
+
+The worker process is made by fork(), inheriting the filters after the
+boundary, so this works only on Unix.
+"""
+
+import cPickle
+import mmap
+import multiprocessing
+import struct
+
+import filterpype.data_fltr_base as dfb
+
+# How long to wait before checking that the other process is still there
+k_wait_secs = 0.1
+# Frame header: kind of frame, header length, data length
+k_frame_format = '<cII'
+k_frame_header_size = struct.calcsize(k_frame_format)
+k_packet_frame = 'P'
+k_close_frame = 'C'
+
+
+def encode_packet(packet):
+    """Return (header, data) for sending the packet to another process. The
+    header is the pickled class and attributes of the packet, except for a
+    string data, which is returned separately. sent_from is left out,
+    because it refers to a filter in this process.
+    """
+    attrs = packet.__dict__.copy()
+    attrs.pop('sent_from', None)
+    data = attrs.get('data')
+    if isinstance(data, str):
+        del attrs['data']
+    else:
+        data = ''
+    try:
+        header = cPickle.dumps((packet.__class__, attrs), 
+                               cPickle.HIGHEST_PROTOCOL)
+    except (cPickle.PicklingError, TypeError), err:
+        raise dfb.DataError, 'Packet can\'t be sent to another process: %s' % (
+            err)
+    return header, data
+
+def decode_packet(header, data):
+    """Make the packet encoded by encode_packet() again.
+    """
+    packet_class, attrs = cPickle.loads(header)
+    packet = packet_class.__new__(packet_class)
+    packet.__dict__.update(attrs)
+    packet.sent_from = None
+    if 'data' not in attrs:
+        packet.data = data
+    return packet
+
+
+class RingBuffer(object):
+    """Byte stream of bounded size, from one process to another, through
+    shared memory. It must be made before the processes fork.
+
+    write() waits while the buffer is full, and read() until all the bytes
+    asked for have arrived. While waiting, they call check() every
+    k_wait_secs, which can raise an exception if the other process has
+    failed.
+    """
+
+    def __init__(self, size=0x100000):
+        self.size = size
+        self._buffer = mmap.mmap(-1, size)
+        # Totals of bytes ever written and read. Each is changed by only one
+        # of the processes.
+        self._written = multiprocessing.RawValue('L', 0)
+        self._read = multiprocessing.RawValue('L', 0)
+        self._condition = multiprocessing.Condition()
+
+    def _wait(self, ready, check):
+        """Wait until ready() returns a true value, and return that.
+        """
+        with self._condition:
+            while True:
+                value = ready()
+                if value:
+                    return value
+                self._condition.wait(k_wait_secs)
+                if check:
+                    check()
+
+    def _moved(self, total, count):
+        with self._condition:
+            total.value += count
+            self._condition.notify_all()
+
+    def close(self):
+        self._buffer.close()
+
+    def read(self, length, check=None):
+        parts = []
+        while length:
+            available = self._wait(
+                lambda: self._written.value - self._read.value, check)
+            count = min(available, length)
+            start = self._read.value % self.size
+            first = min(count, self.size - start)
+            parts.append(self._buffer[start:start + first])
+            if first < count:
+                parts.append(self._buffer[:count - first])
+            self._moved(self._read, count)
+            length -= count
+        return ''.join(parts)
+
+    def write(self, data, check=None):
+        position = 0
+        while position < len(data):
+            free = self._wait(
+                lambda: self.size - (self._written.value - self._read.value),
+                check)
+            count = min(free, len(data) - position)
+            start = self._written.value % self.size
+            first = min(count, self.size - start)
+            self._buffer[start:start + first] = \
+                data[position:position + first]
+            if first < count:
+                self._buffer[:count - first] = \
+                    data[position + first:position + count]
+            self._moved(self._written, count)
+            position += count
+
+    def read_frame(self, check=None):
+        """Return (kind, packet) for the next frame, packet being None for a
+        close frame.
+        """
+        kind, header_size, data_size = struct.unpack(
+            k_frame_format, self.read(k_frame_header_size, check))
+        if kind == k_close_frame:
+            return kind, None
+        header = self.read(header_size, check)
+        return kind, decode_packet(header, self.read(data_size, check))
+
+    def write_frame(self, kind, packet=None, check=None):
+        if packet is None:
+            header = data = ''
+        else:
+            header, data = encode_packet(packet)
+        self.write(struct.pack(k_frame_format, kind, len(header), len(data))
+                   + header, check)
+        if data:
+            self.write(data, check)
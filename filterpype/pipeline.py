@@ -19,9 +19,10 @@ import filterpype.filter_utils as fut
 ## Circular import error if included: import filter_factory as ff
 import filterpype.data_fltr_base as dfb
 
-# Search for (>>> or ^^^), surrounded by spaces
+# Search for (>>> or ^^^ or a named output such as [red]), surrounded by
+# spaces
 spaces = r' *'
-re_main_or_branch = re.compile(spaces + r'(>>>|\^\^\^)' + spaces)
+re_main_or_branch = re.compile(spaces + r'(>>>|\^\^\^|\[[^\]\s]+\])' + spaces)
 
 class Pipeline(dfb.DataFilter):
     """A pipeline is a filter that has a filters dictionary which
@@ -39,9 +40,22 @@ class Pipeline(dfb.DataFilter):
     """
     config = 'not_set'  # To be overridden by subclass
     route = ''
+    # Set "flatten = true" in [--main--] for the filters of this pipeline to
+    # be connected straight into the enclosing pipeline's route. See
+    # _flatten_connections() for what the pipeline itself then misses.
+    flatten = False
+    # Set "optimise = true" in [--main--] to call optimise_route() when the
+    # filters have been connected.
+    optimise = False
+    # Set "fuse = true" in [--main--] to call fuse_filters() when the filters
+    # have been connected.
+    fuse = False
     
     def __call__(self, data_in, clear_pipe=True):
         return self.pump_data(data_in, clear_pipe)
+
+    def __iter__(self):
+        return self.iter_data()
             
     def __init__(self, **kwargs):
         """ A pipeline has a number of reserved keywords which are used to
@@ -168,7 +182,7 @@ class Pipeline(dfb.DataFilter):
     def _close(self):
         """Send the pipeline _close() to the first filter in the pipeline.
         """
-        self.first_filter._close()
+        self._call_scheduled(self.first_filter._close)
     
     def _coded_update_filters(self):
         """Call update_filters() function if it has been defined within a
@@ -197,6 +211,11 @@ class Pipeline(dfb.DataFilter):
         if from_filter_name.startswith('hidden_branch') and \
            join == '^^^':
             from_filter.branch_filter = to_filter
+        elif join.startswith('['):
+            if not isinstance(from_filter, df.RouteBy):
+                msg = 'Filter "%s" can\'t have named outputs, e.g. %s'
+                raise dfb.PipelineConfigError, msg % (from_filter_name, join)
+            from_filter.add_output(join[1:-1], to_filter)
         else:
             from_filter.next_filter = to_filter
             
@@ -225,6 +244,59 @@ class Pipeline(dfb.DataFilter):
         # final from_filter_name.
         assert to_filter_name == 'None', 'to_filter_name is not None??'
         self.last_filter = self.getf(from_filter_name)
+        self._flatten_connections()
+        if self.optimise:
+            self.optimise_route()
+        if self.fuse:
+            self.fuse_filters()
+
+    def _flatten_connections(self):
+        """Wherever a filter in this pipeline, or in a pipeline inside it, is
+        connected to a pipeline with flatten set, connect it instead to that
+        pipeline's first filter. The flattened pipeline's last filter is
+        already connected on to whatever follows the pipeline, so packets
+        then go from filter to filter without passing through the pipeline.
+        Filters are still found with getf(), and keep their own pipeline for
+        key values and substitutions.
+
+        A flattened pipeline is never sent anything itself, so message
+        bottles addressed to it are not opened, and its own close_filter()
+        and flush_buffer() are not called (its filters are still closed and
+        flushed). Flattening is refused for a pipeline class overriding any
+        of these, but a pipeline that has to be reset by a message bottle
+        mustn't be flattened.
+        """
+        self.first_filter = self._entry_filter(self.first_filter)
+        to_check = self._filter_dict.values()
+        while to_check:
+            afilter = to_check.pop()
+            if isinstance(afilter, Pipeline):
+                to_check.extend(afilter._filter_dict.values())
+            elif afilter.next_filter:
+                afilter.next_filter = self._entry_filter(afilter.next_filter)
+            if isinstance(afilter, dfb.HiddenBranchRoute):
+                afilter.branch_filter = self._entry_filter(
+                    afilter.branch_filter)
+            if isinstance(afilter, df.RouteBy):
+                for output in afilter.output_filters.values():
+                    afilter.replace_output(output, self._entry_filter(output))
+
+    def _entry_filter(self, afilter):
+        """Return the filter that packets for afilter should be sent to: the
+        first filter of a pipeline to be flattened, or else afilter.
+        """
+        while isinstance(afilter, Pipeline) and afilter.flatten:
+            for method_name in ['filter_data', 'zero_inputs', 'send',
+                                'before_filter_data', 'after_filter_data',
+                                'close_filter', 'flush_buffer',
+                                'open_message_bottle']:
+                if getattr(afilter.__class__, method_name).im_func is not \
+                   getattr(Pipeline, method_name).im_func:
+                    msg = 'Can\'t flatten pipeline %s, which overrides %s()'
+                    raise dfb.PipelineConfigError, msg % (afilter.name,
+                                                          method_name)
+            afilter = afilter.first_filter
+        return afilter
         
     # When an enclosing pipeline sets the next_filter property, to pass on
     # the data packets, there needs to be a side effect for a pipeline. 
@@ -315,6 +387,12 @@ class Pipeline(dfb.DataFilter):
                             keys_with_vals = keys_with_vals + [key_list]
                     elif name == 'dynamic':
                         self.dynamic = fut.convert_config_str(value)
+                    elif name == 'flatten':
+                        self.flatten = fut.convert_config_str(value)
+                    elif name == 'optimise':
+                        self.optimise = fut.convert_config_str(value)
+                    elif name == 'fuse':
+                        self.fuse = fut.convert_config_str(value)
                     elif name.startswith('update_live'):  # e.g. update_live_27
                         update_list = value
                         try:
@@ -636,9 +714,221 @@ class Pipeline(dfb.DataFilter):
         if not filter_name:
             raise dfb.FilterNameError
         # Throw away any _key_values after ':' 
-        return self._filter_dict[filter_name.split(':')[0]]
+        short_name = filter_name.split(':')[0]
+        try:
+            return self._filter_dict[short_name]
+        except KeyError:
+            # 'inner.filter' is a filter in the pipeline named inner
+            if '.' not in short_name:
+                raise
+            pipeline_name, inner_name = short_name.split('.', 1)
+            return self._filter_dict[pipeline_name].get_filter(inner_name)
     getf = get_filter
             
+    def _discards_all(self, start_filter):
+        """Return True if everything sent to start_filter is thrown away
+        without side effects: every filter reached is in this pipeline, has
+        side_effects False, and the route ends in a Waste filter or nothing.
+        """
+        to_check = [start_filter]
+        seen = set()
+        while to_check:
+            afilter = to_check.pop()
+            if afilter is None or afilter in seen:
+                continue
+            seen.add(afilter)
+            if afilter.pipeline is not self or afilter is self.last_filter or \
+               fut.convert_config_str(afilter.side_effects):
+                return False
+            if isinstance(afilter, df.Waste):
+                continue
+            to_check.append(afilter.next_filter)
+            if isinstance(afilter, dfb.HiddenBranchRoute):
+                to_check.append(afilter.branch_filter)
+        return True
+
+    def _is_fusable(self, afilter):
+        """Return True if afilter can have its transform() called from a
+        FusedFilters stage, instead of being sent packets itself.
+        """
+        return afilter.pipeline is self and afilter is not self.last_filter \
+               and afilter.transform is not None and \
+               afilter.packet_cache is None and \
+               dfb._uses_base_methods(afilter, dfb.k_fusable_methods)
+
+    def _is_no_op(self, afilter):
+        """Return True if afilter only sends each packet on down main, to a
+        filter that can be connected to directly instead.
+        """
+        if afilter is self.last_filter or not afilter.next_filter or \
+           fut.convert_config_str(afilter.side_effects):
+            return False
+        filter_class = afilter.__class__
+        if filter_class is df.PassThrough:
+            return True
+        elif filter_class is df.BranchClone:
+            # The clone sent to the branch is thrown away, if no branch
+            return not isinstance(afilter.next_filter, dfb.HiddenBranchRoute) \
+                   or afilter.next_filter.branch_filter is None
+        elif filter_class is dfb.HiddenBranchRoute:
+            return afilter.branch_filter is None
+        return False
+
+    def optimise_route(self):
+        """Connect past the filters in this pipeline that make no difference
+        to its output. Only filters with side_effects False are affected:
+        
+        - a branch that only leads to Waste (or nowhere) is removed, along
+          with its HiddenBranchRoute, so a BranchClone before it no longer
+          has anything to do;
+        - pass_through filters, and branch_clone filters without a branch,
+          are bypassed.
+
+        The pipeline's last filter is never bypassed, because it is still to
+        be connected to whatever follows the pipeline. Returns the number
+        of filters taken out of the route. Message bottles for these filters
+        will no longer reach them.
+        """
+        filters = self._filter_dict.values()
+        for afilter in filters:
+            if isinstance(afilter, dfb.HiddenBranchRoute) and \
+               afilter.next_filter and afilter is not self.last_filter and \
+               self._discards_all(afilter.branch_filter):
+                afilter.branch_filter = None
+        bypassed = {}  # Filter bypassed: filter to connect to instead
+
+        def connect_to(afilter):
+            no_ops = []
+            while afilter and self._is_no_op(afilter) and \
+                  afilter not in no_ops:
+                if afilter in bypassed:
+                    afilter = bypassed[afilter]
+                    break
+                no_ops.append(afilter)
+                afilter = afilter.next_filter
+            for no_op in no_ops:
+                bypassed[no_op] = afilter
+            return afilter
+
+        self.first_filter = connect_to(self.first_filter)
+        for afilter in filters:
+            afilter.next_filter = connect_to(afilter.next_filter)
+            if isinstance(afilter, dfb.HiddenBranchRoute) and \
+               afilter.branch_filter:
+                afilter.branch_filter = connect_to(afilter.branch_filter)
+        return len(bypassed)
+
+    def fuse_filters(self):
+        """Replace each linear run of two or more filters with a transform()
+        method by a single FusedFilters stage, so that a packet goes through
+        the run in one step instead of one coroutine send() per filter. A run
+        stops at a filter without transform(), and before any filter that
+        another branch or loop also sends to. The pipeline's last filter is
+        never fused, because it is still to be connected to whatever follows
+        the pipeline. Returns the number of filters fused.
+        """
+        # Count the links into each filter reached from the first filter
+        links_in = {self.first_filter:1}
+        links_from = {}
+        reached = []
+        to_visit = [self.first_filter]
+        while to_visit:
+            afilter = to_visit.pop()
+            if afilter in reached:
+                continue
+            reached.append(afilter)
+            if afilter is self.last_filter:
+                continue
+            links = [afilter.next_filter]
+            if isinstance(afilter, dfb.HiddenBranchRoute):
+                links.append(afilter.branch_filter)
+            if isinstance(afilter, df.RouteBy):
+                links.extend(afilter.output_filters.values())
+            for link in links:
+                if link:
+                    links_in[link] = links_in.get(link, 0) + 1
+                    links_from.setdefault(link, []).append(afilter)
+                    to_visit.append(link)
+
+        fusable = set(afilter for afilter in reached 
+                      if self._is_fusable(afilter))
+        def continues_run(afilter):
+            return afilter in fusable and links_in[afilter] == 1 and \
+                   links_from.get(afilter, [None])[0] in fusable
+        fused_count = 0
+        for first in reached:
+            if first not in fusable or continues_run(first):
+                continue
+            run = [first]
+            while continues_run(run[-1].next_filter) and \
+                  run[-1].next_filter is not first:
+                run.append(run[-1].next_filter)
+            if len(run) < 2:
+                continue
+            stage = dfb.FusedFilters(pipeline=self, fused_filters=run)
+            stage.next_filter = run[-1].next_filter
+            if self.first_filter is first:
+                self.first_filter = stage
+            for prev_filter in links_from.get(first, []):
+                if prev_filter.next_filter is first:
+                    prev_filter.next_filter = stage
+                if getattr(prev_filter, 'branch_filter', None) is first:
+                    prev_filter.branch_filter = stage
+                if isinstance(prev_filter, df.RouteBy):
+                    prev_filter.replace_output(first, stage)
+            fused_count += len(run)
+        return fused_count
+
+    def iter_data(self, *packets):
+        """Pull mode: generate the packets coming out of the end of the
+        pipeline, doing only as much work as is needed for each one asked
+        for. Each of packets (by default one empty packet, so a source filter
+        uses its fixed file name) is sent in to the first filter. If that has
+        iter_packets(), e.g. ReadBatch, its packets are pulled from it one at
+        a time, so that a file is read only as far as the consumer goes.
+
+        The pipeline is shut down when the packets run out, or the consumer
+        stops early, so the filters flush their buffers and close as usual.
+        Output from flushing is generated only if the consumer hasn't
+        stopped. Note that pipeline.send() and a filter_data() overridden in
+        the pipeline are bypassed. The last filter's next_filter is put back
+        as it was when the pipeline has been shut down.
+        """
+        if not packets:
+            packets = [dfb.DataPacket()]
+        pull_sink = df.Sink(max_results=0)
+        last_filter = self.last_filter
+        next_filter = last_filter.next_filter
+        last_filter.next_filter = pull_sink
+        source = self.first_filter
+        if source.iter_packets and not source._primed:
+            # Ready for closing with the rest of the pipeline
+            source._prime()
+        try:
+            for packet in packets:
+                if source.iter_packets:
+                    source_packets = source.iter_packets(packet)
+                    send = source.send_on
+                else:
+                    source_packets = iter([packet])
+                    send = source.send
+                try:
+                    for source_packet in source_packets:
+                        send(source_packet)
+                        results, pull_sink.results = pull_sink.results, []
+                        for result in results:
+                            yield result
+                finally:
+                    if hasattr(source_packets, 'close'):
+                        source_packets.close()
+        finally:
+            try:
+                self.shut_down()
+            finally:
+                last_filter.next_filter = next_filter
+        for result in pull_sink.results:
+            yield result
+
     def pump_data(self, data_in=None, zero_inputs=True): # << TO-DO Needs work
         ##, close_at_end=True):
         """Put the data into the pipeline by wrapping it in a Datapacket.
@@ -807,11 +1097,11 @@ class CopyFileCompression(Pipeline):
     file_size = ${file_size}
     
     [callback_read_progress]
-    ftype = callback_on_attribute
-    watch_attr = read_percent
+    ftype = progress_meter
+    progress_message = found:read_percent
     callback = ${callback}
     environ = ${environ}
-    watch_for_change = True
+    file_size = ${file_size}
     
     [write_with_compression]
     ftype = write_file
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""Process one large file with several copies of a pipeline at once, each
+reading its own byte range of the file in a separate process.
+
+The file is cut into ranges of about the same size, and the start of each
+range is moved on to the next frame boundary by a sync function, so that no
+frame is split between two pipelines. A sync function is called as
+sync(file_obj, offset) and returns the offset of the first frame starting
+at or after offset, or the file size if there is none. align_to_frame_size()
+and align_to_sync_word() make sync functions for the usual frame formats.
+
+Each pipeline is sent a RangeFile, which ReadBatch reads like an ordinary
+file, and its outputs are merged back in file order by RangeSplitter:
+
+    WriteFile   each pipeline writes to a part file, and the parts are then
+                joined into the real destination file, in range order.
+                Compressed parts are complete streams, so the joined file is
+                a valid multi-stream file.
+    Sink        the results of each pipeline are collected, and returned
+                as one list per sink, by its path name (e.g. "inner.sink"
+                for a sink in a nested pipeline), in range order. As for a
+                single Sink, only the last max_results of these are kept.
+    others      filters with state_attrs, such as CountBytes, export their
+                state, which is merged in range order into the filters of
+                one more copy of the pipeline, RangeSplitter.pipeline, so
+                that it holds the totals for the whole file.
+
+A WriteFile that is given a new dest_file_name by a message bottle while
+running is not joined up.
+"""
+
+import multiprocessing
+import os
+import shutil
+
+import filterpype.data_fltr_base as dfb
+import filterpype.data_filter as df
+import filterpype.pipeline as ppln
+import filterpype.serialise as serialise
+
+# How much of the file a sync function reads at a time
+k_sync_read_size = 0x10000
+
+
+def align_to_frame_size(frame_size, header_size=0):
+    """Return a sync function for a file of fixed size frames, after a
+    header of header_size bytes.
+    """
+    def sync(file_obj, offset):
+        frames = max(0, offset - header_size + frame_size - 1) // frame_size
+        return header_size + frames * frame_size
+    return sync
+
+def align_to_sync_word(sync_word):
+    """Return a sync function for a file of frames that each start with
+    sync_word.
+    """
+    def sync(file_obj, offset):
+        file_obj.seek(offset)
+        pos = offset  # Offset in the file of buf[0]
+        buf = ''
+        while True:
+            block = file_obj.read(k_sync_read_size)
+            if not block:
+                return pos + len(buf)
+            buf += block
+            found = buf.find(sync_word)
+            if found >= 0:
+                return pos + found
+            # Keep enough to find a sync word split between two blocks
+            drop = max(0, len(buf) - len(sync_word) + 1)
+            pos += drop
+            buf = buf[drop:]
+    return sync
+
+def split_ranges(file_name, num_ranges, sync=None):
+    """Return a list of (start, end) byte ranges that together cover the
+    file, about the same size and each starting at a frame boundary found by
+    sync. There may be fewer than num_ranges if frames are large.
+    """
+    file_size = os.path.getsize(file_name)
+    starts = [0]
+    file_obj = open(file_name, 'rb')
+    try:
+        for j in xrange(1, num_ranges):
+            start = file_size * j // num_ranges
+            if sync:
+                start = min(sync(file_obj, start), file_size)
+            starts.append(max(start, starts[-1]))
+    finally:
+        file_obj.close()
+    starts.append(file_size)
+    return [(start, end) for start, end in zip(starts[:-1], starts[1:])
+            if end > start]
+
+
+class RangeFile(object):
+    """Read-only file object for the bytes from start up to end of a file.
+    file_size is the length of the range, for ReadBatch's read_percent.
+    """
+
+    def __init__(self, file_name, start, end):
+        self.file_name = file_name
+        self.name = '%s[%d:%d]' % (file_name, start, end)
+        self.start = start
+        self.end = end
+        self.file_size = end - start
+        self._file = open(file_name, 'rb')
+        self._file.seek(start)
+
+    def _get_closed(self):
+        return self._file.closed
+    closed = property(_get_closed, doc='True once the file is closed')
+
+    def close(self):
+        self._file.close()
+
+    def read(self, size=-1):
+        left = self.end - self._file.tell()
+        if size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return ''
+        return self._file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            offset += self.start
+        elif whence == os.SEEK_END:
+            offset += self.end
+        else:
+            offset += self._file.tell()
+        self._file.seek(min(max(offset, self.start), self.end))
+
+    def tell(self):
+        return self._file.tell() - self.start
+
+
+def _filters_by_path(pipeline, prefix=''):
+    """Return a dictionary of the filters in the pipeline and the pipelines
+    inside it, by their path names, e.g. "inner.count_bytes", for getf().
+    """
+    filters = {}
+    for name, afilter in pipeline._filter_dict.iteritems():
+        if isinstance(afilter, ppln.Pipeline):
+            filters.update(_filters_by_path(afilter, prefix + name + '.'))
+        else:
+            filters[prefix + name] = afilter
+    return filters
+
+def _part_file_name(file_name, index):
+    """Return the name of the part file, with the index before the
+    extension, so that "compress = auto" still finds the codec from it.
+    """
+    root, ext = os.path.splitext(file_name)
+    return '%s.part%04d%s' % (root, index, ext)
+
+def run_range(config, factory, file_name, start, end, index):
+    """Run a new pipeline made from config on bytes start to end of the file.
+    Return (dest_parts, sink_records, filter_states): a list of
+    (destination file name, part file name, append) for each WriteFile that
+    wrote a part, the encoded results of each Sink, and the exported state of
+    each filter that has state_attrs, both by filter path name.
+    """
+    pipeline = ppln.Pipeline(factory=factory, config=config)
+    filters = _filters_by_path(pipeline)
+    writers = []
+    for afilter in filters.itervalues():
+        if isinstance(afilter, df.WriteFile) and afilter.dest_file_name:
+            dest_name = afilter._get_dest_file_name()
+            afilter.dest_file_name = _part_file_name(afilter.dest_file_name,
+                                                     index)
+            writers.append((afilter, dest_name))
+    pipeline.send(dfb.DataPacket(RangeFile(file_name, start, end)))
+    pipeline.shut_down()
+    dest_parts = []
+    for afilter, dest_name in writers:
+        part_name = afilter._get_dest_file_name()
+        if os.path.exists(part_name):
+            dest_parts.append((dest_name, part_name, afilter.append))
+    sink_records = {}
+    filter_states = {}
+    for path, afilter in filters.iteritems():
+        if isinstance(afilter, df.Sink):
+            sink_records[path] = [
+                serialise.encode_packet(packet, pickle_other=True)
+                for packet in afilter.results]
+        elif afilter.state_attrs is not None:
+            filter_states[path] = afilter.export_state()
+    return dest_parts, sink_records, filter_states
+
+def _run_range_args(args):
+    return run_range(*args)
+
+
+class RangeSplitter(object):
+    """Process file_name with a copy of the pipeline made from config for
+    each byte range, in a pool of worker processes.
+
+    num_ranges defaults to the number of workers, which defaults to the
+    number of CPUs. With workers=0, the ranges are processed one after
+    another in this process, which is useful for debugging. The factory
+    must be picklable, as it is sent to the workers.
+    """
+
+    def __init__(self, config, factory, file_name, sync=None,
+                 num_ranges=None, workers=None):
+        self.config = config
+        self.factory = factory
+        self.file_name = file_name
+        self.sync = sync
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.num_ranges = num_ranges or max(workers, 1)
+        # Results of each sink by path name, in range order, after run()
+        self.sink_results = {}
+        # Pipeline holding the merged state of the filters, after run()
+        self.pipeline = None
+
+    def _join_parts(self, range_outputs):
+        dest_parts = {}
+        appends = {}
+        for parts in range_outputs:
+            for dest_name, part_name, append in parts:
+                dest_parts.setdefault(dest_name, []).append(part_name)
+                appends[dest_name] = append
+        for dest_name, part_names in dest_parts.iteritems():
+            if appends[dest_name]:
+                mode = 'ab'
+            else:
+                mode = 'wb'
+            dest_file = open(dest_name, mode)
+            try:
+                for part_name in part_names:
+                    part_file = open(part_name, 'rb')
+                    try:
+                        shutil.copyfileobj(part_file, dest_file, 0x100000)
+                    finally:
+                        part_file.close()
+                    os.remove(part_name)
+            finally:
+                dest_file.close()
+        return sorted(dest_parts)
+
+    def run(self):
+        """Process all the ranges, then join up the outputs. Return the
+        list of ranges processed.
+        """
+        ranges = split_ranges(self.file_name, self.num_ranges, self.sync)
+        tasks = [(self.config, self.factory, self.file_name, start, end,
+                  index) for index, (start, end) in enumerate(ranges)]
+        if self.workers:
+            pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+            try:
+                outputs = pool.map(_run_range_args, tasks, chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            outputs = [run_range(*task) for task in tasks]
+        self._join_parts([output[0] for output in outputs])
+        self.sink_results = {}
+        self.pipeline = ppln.Pipeline(factory=self.factory,
+                                      config=self.config)
+        # The filters are never sent anything, so they aren't zeroed
+        for afilter in _filters_by_path(self.pipeline).itervalues():
+            if afilter.state_attrs is not None:
+                afilter.zero_inputs()
+        for dest_parts, sink_records, filter_states in outputs:
+            for path, records in sink_records.iteritems():
+                self.sink_results.setdefault(path, []).extend(
+                    serialise.decode_packet(record, allow_pickle=True)
+                    for record in records)
+            for path, state in filter_states.iteritems():
+                self.pipeline.getf(path).merge_state(state)
+        for path, results in self.sink_results.iteritems():
+            max_results = self.pipeline.getf(path).max_results
+            if max_results:
+                del results[:-max_results]
+        return ranges
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""Skip running a pipeline on a file whose results are already known.
+
+ResultCache.run() makes the pipeline from config, factory and key_values,
+and then either runs it on the file, recording its outputs in an entry of
+the cache, or, if an entry for the same run exists, replays the outputs
+recorded there instead:
+
+    WriteFile   the files written are copied back to their destinations,
+                or, for an append WriteFile whose file already existed,
+                the data it appended is appended again. Files whose size
+                and mtime the run didn't change aren't recorded.
+    Sink        the results are set to the packets recorded
+    callbacks   each filter with a callback key, e.g. CallbackOnAttribute
+                or ProgressMeter, makes the same calls to its callback, in
+                the same order
+
+An entry is found by a key made from:
+
+    the input file  its name and a hash of its contents, or, with
+                    check_contents=False, its name, size and mtime
+    the pipeline    the config, the factory class and the key values,
+                    except callables such as callbacks
+    filterpype.__version__
+
+Each entry is a directory in cache_dir, holding the output files and a
+pickled manifest, so the cache directory must only be writable by trusted
+users. When the entries total more than max_size bytes, the least recently
+used are removed. Filters whose results depend on anything else, e.g. the
+time, or another file, shouldn't be cached. As with RangeSplitter, a
+WriteFile that is given a new dest_file_name while running only has its
+last file recorded.
+"""
+
+import cPickle as pickle
+import hashlib
+import os
+import shutil
+import tempfile
+
+import filterpype
+import filterpype.data_fltr_base as dfb
+import filterpype.data_filter as df
+import filterpype.pipeline as ppln
+import filterpype.serialise as serialise
+
+k_manifest_name = 'manifest.pickle'
+# Changed when the manifest changes, so that older entries aren't found
+k_entry_format = 2
+k_hash_read_size = 0x100000
+
+
+def _filters_by_path(pipeline, prefix=''):
+    """Return a dictionary of the filters in the pipeline and the pipelines
+    inside it, by their path names, e.g. "inner.sink", for get_filter().
+    """
+    filters = {}
+    for name, afilter in pipeline._filter_dict.iteritems():
+        if isinstance(afilter, ppln.Pipeline):
+            filters.update(_filters_by_path(afilter, prefix + name + '.'))
+        else:
+            filters[prefix + name] = afilter
+    return filters
+
+def _file_state(file_name):
+    """Return the size and mtime of the file, or None if there isn't one.
+    """
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+def _copy_file(source_name, dest_name, offset=0, mode='wb'):
+    """Copy the source file from offset on to the destination, opened with
+    mode.
+    """
+    source = open(source_name, 'rb')
+    try:
+        source.seek(offset)
+        dest = open(dest_name, mode)
+        try:
+            shutil.copyfileobj(source, dest)
+        finally:
+            dest.close()
+    finally:
+        source.close()
+
+def _dir_size(dir_name):
+    return sum(os.path.getsize(os.path.join(dir_name, file_name))
+               for file_name in os.listdir(dir_name))
+
+def input_key(file_name, check_contents=True):
+    """Return a string identifying the file and, as far as checked, its
+    contents.
+    """
+    file_name = os.path.abspath(file_name)
+    if not check_contents:
+        stat = os.stat(file_name)
+        return '%s\0%d\0%r' % (file_name, stat.st_size, stat.st_mtime)
+    hasher = hashlib.sha256()
+    file_obj = open(file_name, 'rb')
+    try:
+        while True:
+            block = file_obj.read(k_hash_read_size)
+            if not block:
+                break
+            hasher.update(block)
+    finally:
+        file_obj.close()
+    return '%s\0%s' % (file_name, hasher.hexdigest())
+
+def pipeline_key(config, factory, key_values):
+    """Return a string identifying the pipeline made from config, factory
+    and key_values, in this version of FilterPype.
+    """
+    values = sorted((key, repr(value))
+                    for key, value in key_values.iteritems()
+                    if not callable(value))
+    factory_class = factory.__class__
+    return '%s\0%s.%s\0%r\0%s' % (
+        config, factory_class.__module__, factory_class.__name__, values,
+        filterpype.__version__)
+
+
+class CallbackRecorder(object):
+    """Stand in for a filter's callback, recording each call before passing
+    it on.
+    """
+
+    def __init__(self, filter_path, callback, calls):
+        self.filter_path = filter_path
+        self.callback = callback
+        self.calls = calls
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append((self.filter_path, args, kwargs))
+        return self.callback(*args, **kwargs)
+
+
+class ResultCache(object):
+    """Cache of pipeline results in cache_dir, of at most max_size bytes.
+
+    hits and misses count the runs replayed and run since the cache was
+    made, and evictions the entries removed to keep within max_size.
+    """
+
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024,
+                 check_contents=True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.check_contents = check_contents
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_dir(self, file_name, config, factory, key_values):
+        key = hashlib.sha256('%s\0%s\0%d' % (
+            input_key(file_name, self.check_contents),
+            pipeline_key(config, factory, key_values),
+            k_entry_format)).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def _entries(self):
+        """Return a list of (last used time, size, entry directory) for
+        each complete entry.
+        """
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            manifest_name = os.path.join(entry_dir, k_manifest_name)
+            try:
+                entries.append((os.path.getmtime(manifest_name),
+                                _dir_size(entry_dir), entry_dir))
+            except OSError:
+                # Being written or removed by another process
+                pass
+        return entries
+
+    def stats(self):
+        """Return a dictionary of the cache statistics.
+        """
+        entries = self._entries()
+        runs = self.hits + self.misses
+        if runs:
+            hit_rate = float(self.hits) / runs
+        else:
+            hit_rate = 0.0
+        return dict(hits=self.hits, misses=self.misses, hit_rate=hit_rate,
+                    evictions=self.evictions, entries=len(entries),
+                    total_size=sum(entry[1] for entry in entries))
+
+    def clear(self):
+        """Remove all the entries.
+        """
+        for entry_name in os.listdir(self.cache_dir):
+            shutil.rmtree(os.path.join(self.cache_dir, entry_name),
+                          ignore_errors=True)
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total_size = sum(entry[1] for entry in entries)
+        for last_used, size, entry_dir in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            self.evictions += 1
+
+    def run(self, config, factory, file_name, **key_values):
+        """Return the pipeline made from config, factory and key_values, after
+        running it on the file or replaying its recorded outputs.
+        """
+        pipeline = ppln.Pipeline(factory=factory, config=config,
+                                 **key_values)
+        entry_dir = self._entry_dir(file_name, config, factory, key_values)
+        manifest_name = os.path.join(entry_dir, k_manifest_name)
+        try:
+            manifest_file = open(manifest_name, 'rb')
+        except IOError:
+            self.misses += 1
+            self._run(pipeline, file_name, entry_dir)
+        else:
+            try:
+                manifest = pickle.load(manifest_file)
+            finally:
+                manifest_file.close()
+            self.hits += 1
+            # Mark the entry as the most recently used
+            os.utime(manifest_name, None)
+            self._replay(pipeline, manifest, entry_dir)
+        return pipeline
+
+    def _run(self, pipeline, file_name, entry_dir):
+        filters = _filters_by_path(pipeline)
+        calls = []
+        for path, afilter in filters.iteritems():
+            if 'callback' in afilter._keys and callable(afilter.callback):
+                afilter.callback = CallbackRecorder(path, afilter.callback,
+                                                    calls)
+        writers = [(path, afilter)
+                   for path, afilter in sorted(filters.iteritems())
+                   if isinstance(afilter, df.WriteFile) and
+                   afilter.dest_file_name]
+        # The files already there, to record only those written by the run
+        states = {}
+        for path, afilter in writers:
+            dest_name = afilter._get_dest_file_name()
+            states[dest_name] = _file_state(dest_name)
+        pipeline.send(dfb.DataPacket(file_name))
+        pipeline.shut_down()
+        # (destination, stored name, True if appended to the destination)
+        outputs = []
+        offsets = []
+        for path, afilter in writers:
+            dest_name = afilter._get_dest_file_name()
+            state = _file_state(dest_name)
+            old_state = states.get(dest_name)
+            if state is None or state == old_state:
+                continue
+            appended = bool(afilter.append and old_state)
+            outputs.append((dest_name, 'out%04d' % len(outputs), appended))
+            # Only store what was appended to the file
+            offsets.append(appended and old_state[0] or 0)
+        sinks = {}
+        for path, afilter in sorted(filters.iteritems()):
+            if isinstance(afilter, df.Sink):
+                sinks[path] = [serialise.encode_packet(packet,
+                                                       pickle_other=True)
+                               for packet in afilter.results]
+        manifest = dict(outputs=outputs, sinks=sinks, callbacks=calls)
+        try:
+            manifest_data = pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            # The results can't be recorded, so aren't cached
+            return
+        # Write the entry under a temporary name, so that no other run can
+        # find it before it is complete.
+        temp_dir = tempfile.mkdtemp(prefix='tmp', dir=self.cache_dir)
+        try:
+            for (dest_name, stored_name, appended), offset in zip(outputs,
+                                                                  offsets):
+                _copy_file(dest_name, os.path.join(temp_dir, stored_name),
+                           offset)
+            manifest_file = open(os.path.join(temp_dir, k_manifest_name),
+                                 'wb')
+            try:
+                manifest_file.write(manifest_data)
+            finally:
+                manifest_file.close()
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Another process has already stored the entry
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self._evict()
+
+    def _replay(self, pipeline, manifest, entry_dir):
+        filters = _filters_by_path(pipeline)
+        for dest_name, stored_name, appended in manifest['outputs']:
+            _copy_file(os.path.join(entry_dir, stored_name), dest_name,
+                       mode=appended and 'ab' or 'wb')
+        for path, records in manifest['sinks'].iteritems():
+            # Written by this cache, so trusted with pickled values
+            filters[path].results = [
+                serialise.decode_packet(record, allow_pickle=True)
+                for record in records]
+        for path, args, kwargs in manifest['callbacks']:
+            filters[path].callback(*args, **kwargs)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""Compact, versioned binary encoding of DataPackets and MessageBottles, for
+sending them to another process, spilling them to disk or replaying them.
+
+Each packet becomes one record:
+
+    header  'FP', format version (1 byte), kind ('D' data packet or
+            'M' message bottle), body length (4 bytes)
+    body    number of attributes (2 bytes), then for each attribute its
+            name (1 byte length + name) and tagged value, and last of all
+            the tagged packet data. String data is written as raw bytes.
+
+Values are tagged by type: None, bool, int, long, float, str, unicode, and
+lists, tuples and dictionaries of these. Routing fields that only make sense
+inside one pipeline (sent_from, fork_dest) are left out. Other types can't be
+encoded, unless pickle_other is set, when they are pickled. Unpickling can run
+any code, so a record holding a pickled value is only decoded if allow_pickle
+is set, by callers that wrote the record themselves, and otherwise raises
+DataError. So does a record that is cut short or corrupt.
+
+All numbers are little-endian. write_packet() and read_packet() work with
+any file-like object, one record at a time.
+"""
+
+import cPickle
+import struct
+
+import filterpype.data_fltr_base as dfb
+
+k_magic = 'FP'
+k_version = 1
+k_data_kind = 'D'
+k_bottle_kind = 'M'
+# Attributes that refer to the filters a packet has passed through
+k_transient_attrs = frozenset(['sent_from', 'fork_dest', '_delivered_direct'])
+
+record_header = struct.Struct('<2sBcI')
+count_format = struct.Struct('<H')
+length_format = struct.Struct('<I')
+int_format = struct.Struct('<q')
+float_format = struct.Struct('<d')
+k_min_int = -2 ** 63
+k_max_int = 2 ** 63 - 1
+k_max_name_length = 255
+k_max_attrs = 0xFFFF
+
+kind_classes = {k_data_kind:dfb.DataPacket, k_bottle_kind:dfb.MessageBottle}
+
+
+def _encode_sequence(tag, values, parts, pickle_other):
+    parts.append(tag + length_format.pack(len(values)))
+    for value in values:
+        _encode_value(value, parts, pickle_other)
+
+def _encode_value(value, parts, pickle_other):
+    value_type = type(value)
+    if value is None:
+        parts.append('N')
+    elif value_type is bool:
+        parts.append(value and 'T' or 'F')
+    elif value_type is str:
+        parts.append('s' + length_format.pack(len(value)))
+        parts.append(value)
+    elif value_type in (int, long) and k_min_int <= value <= k_max_int:
+        parts.append('i' + int_format.pack(value))
+    elif value_type is long:
+        digits = str(value)
+        parts.append('L' + length_format.pack(len(digits)) + digits)
+    elif value_type is float:
+        parts.append('f' + float_format.pack(value))
+    elif value_type is unicode:
+        encoded = value.encode('utf-8')
+        parts.append('u' + length_format.pack(len(encoded)) + encoded)
+    elif value_type is list:
+        _encode_sequence('l', value, parts, pickle_other)
+    elif value_type is tuple:
+        _encode_sequence('t', value, parts, pickle_other)
+    elif value_type is dict:
+        parts.append('d' + length_format.pack(len(value)))
+        for key, item in value.iteritems():
+            _encode_value(key, parts, pickle_other)
+            _encode_value(item, parts, pickle_other)
+    elif pickle_other:
+        pickled = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        parts.append('p' + length_format.pack(len(pickled)) + pickled)
+    else:
+        raise dfb.DataError, 'Can\'t encode %s value %r' % (
+            value_type.__name__, value)
+
+def _decode_value(record, pos, allow_pickle):
+    """Return the value starting at pos in record, and the position after it.
+    """
+    tag = record[pos]
+    pos += 1
+    if tag == 'N':
+        return None, pos
+    elif tag == 'T':
+        return True, pos
+    elif tag == 'F':
+        return False, pos
+    elif tag == 'i':
+        return int_format.unpack_from(record, pos)[0], pos + 8
+    elif tag == 'f':
+        return float_format.unpack_from(record, pos)[0], pos + 8
+    elif tag in 'lt':
+        count = length_format.unpack_from(record, pos)[0]
+        pos += 4
+        values = []
+        for j in xrange(count):
+            value, pos = _decode_value(record, pos, allow_pickle)
+            values.append(value)
+        if tag == 't':
+            values = tuple(values)
+        return values, pos
+    elif tag == 'd':
+        count = length_format.unpack_from(record, pos)[0]
+        pos += 4
+        values = {}
+        for j in xrange(count):
+            key, pos = _decode_value(record, pos, allow_pickle)
+            values[key], pos = _decode_value(record, pos, allow_pickle)
+        return values, pos
+    elif tag in 'sLup':
+        length = length_format.unpack_from(record, pos)[0]
+        pos += 4
+        value = record[pos:pos + length]
+        if len(value) != length:
+            raise dfb.DataError, 'Packet record is cut short'
+        if tag == 'L':
+            value = long(value)
+        elif tag == 'u':
+            value = value.decode('utf-8')
+        elif tag == 'p':
+            if not allow_pickle:
+                raise dfb.DataError, \
+                      'Pickled value in packet record, not allowed'
+            value = cPickle.loads(value)
+        return value, pos + length
+    raise dfb.DataError, 'Unknown value tag %r in packet record' % tag
+
+def encode_packet(packet, pickle_other=False):
+    """Return the packet encoded as a record string.
+    """
+    if packet.message:
+        kind = k_bottle_kind
+    else:
+        kind = k_data_kind
+    attrs = [(name, value) for name, value in packet.__dict__.iteritems()
+             if name != 'data' and name not in k_transient_attrs]
+    if len(attrs) > k_max_attrs:
+        raise dfb.DataError, 'Can\'t encode more than %d attributes' % \
+              k_max_attrs
+    parts = [None, count_format.pack(len(attrs))]
+    for name, value in attrs:
+        if len(name) > k_max_name_length:
+            raise dfb.DataError, 'Can\'t encode attribute name %r, longer ' \
+                  'than %d characters' % (name, k_max_name_length)
+        parts.append(chr(len(name)) + name)
+        _encode_value(value, parts, pickle_other)
+    _encode_value(packet.data, parts, pickle_other)
+    body_length = sum(len(part) for part in parts[1:])
+    parts[0] = record_header.pack(k_magic, k_version, kind, body_length)
+    return ''.join(parts)
+
+def _decode_body(kind, record, pos, allow_pickle):
+    """Return the packet from the body starting at pos in record. A body
+    that is cut short or corrupt raises DataError, giving the offset in the
+    record (counting the header) of the attribute or data that failed.
+    """
+    try:
+        packet_class = kind_classes[kind]
+    except KeyError:
+        raise dfb.DataError, 'Unknown packet kind %r' % kind
+    packet = packet_class.__new__(packet_class)
+    attrs = packet.__dict__
+    start = pos
+    try:
+        count = count_format.unpack_from(record, pos)[0]
+        pos += 2
+        for j in xrange(count):
+            name_length = ord(record[pos])
+            name = record[pos + 1:pos + 1 + name_length]
+            attrs[name], pos = _decode_value(record, pos + 1 + name_length,
+                                             allow_pickle)
+        attrs['data'] = _decode_value(record, pos, allow_pickle)[0]
+    except (IndexError, struct.error, ValueError), err:
+        raise dfb.DataError, 'Corrupt packet record at offset %d: %s' % (
+            pos - start + record_header.size, err)
+    attrs['sent_from'] = None
+    attrs['fork_dest'] = None
+    return packet
+
+def _check_header(header):
+    if len(header) < record_header.size:
+        raise dfb.DataError, 'Packet record is cut short'
+    magic, version, kind, body_length = record_header.unpack(header)
+    if magic != k_magic:
+        raise dfb.DataError, 'Not a packet record'
+    if version != k_version:
+        raise dfb.DataError, 'Packet record version %d is not %d' % (
+            version, k_version)
+    return kind, body_length
+
+def decode_packet(record, allow_pickle=False):
+    """Return the packet encoded in the record string. Only set
+    allow_pickle for records from a trusted source.
+    """
+    kind, body_length = _check_header(record[:record_header.size])
+    if len(record) != record_header.size + body_length:
+        raise dfb.DataError, 'Packet record is the wrong length'
+    return _decode_body(kind, record, record_header.size, allow_pickle)
+
+def read_packet(file_obj, allow_pickle=False):
+    """Read the next packet record from the file, returning the packet, or
+    None at the end of the file.
+    """
+    header = file_obj.read(record_header.size)
+    if not header:
+        return None
+    kind, body_length = _check_header(header)
+    body = file_obj.read(body_length)
+    if len(body) != body_length:
+        raise dfb.DataError, 'Packet record is cut short'
+    return _decode_body(kind, body, 0, allow_pickle)
+
+def read_packets(file_obj, allow_pickle=False):
+    """Generate the packets from all the records in the file.
+    """
+    while True:
+        packet = read_packet(file_obj, allow_pickle)
+        if packet is None:
+            break
+        yield packet
+
+def write_packet(file_obj, packet, pickle_other=False):
+    file_obj.write(encode_packet(packet, pickle_other))
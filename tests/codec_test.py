@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import bz2
+import os
+import re
+import mock
+import zlib
+import gzip
+
+import filterpype.filter_utils as fut
+
+import filterpype.codec as codec
+
+data_dir5 = os.path.join(fut.abs_dir_of_file(__file__), 
+                         'test_data', 'tst_data5')
+
+def decompress_streams(data):
+    """Decompress concurrent bzip2 streams, as bunzip2 does."""
+    results = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        results.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return ''.join(results)
+
+
+class TestParallelBZ2Compressor(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join('line %d of the test data\n' % j
+                            for j in xrange(20000))
+
+    def _compress(self, compressor, packet_size=1000):
+        output = []
+        for j in xrange(0, len(self.data), packet_size):
+            output.append(compressor.compress(self.data[j:j + packet_size]))
+        output.append(compressor.flush())
+        return ''.join(output)
+
+    def test_blocks_in_order(self):
+        compressor = codec.ParallelBZ2Compressor(block_size=10000, workers=4,
+                                                 max_in_flight=3)
+        compressed = self._compress(compressor)
+        self.assertEquals(decompress_streams(compressed), self.data)
+        # One stream per block
+        self.assertEquals(compressed.count('BZh9'),
+                          -(-len(self.data) // 10000))
+
+    def test_large_packets(self):
+        compressor = codec.ParallelBZ2Compressor(block_size=5000, workers=2)
+        compressed = self._compress(compressor, packet_size=123456)
+        self.assertEquals(decompress_streams(compressed), self.data)
+
+    def test_in_flight_is_bounded(self):
+        compressor = codec.ParallelBZ2Compressor(block_size=1000, workers=2,
+                                                 max_in_flight=2)
+        for j in xrange(0, len(self.data), 4000):
+            compressor.compress(self.data[j:j + 4000])
+            self.assertTrue(len(compressor._in_flight) <= 2)
+        compressor.flush()
+
+    def test_no_data(self):
+        compressor = codec.ParallelBZ2Compressor(workers=2)
+        self.assertEquals(bz2.decompress(compressor.flush()), '')
+
+    def test_flushed_compressor_cant_be_used(self):
+        compressor = codec.ParallelBZ2Compressor(workers=2)
+        compressor.compress('abc')
+        compressor.flush()
+        self.assertRaises(ValueError, compressor.compress, 'def')
+        self.assertRaises(ValueError, compressor.flush)
+
+    def test_make_bz2_compressor(self):
+        self.assertTrue(isinstance(codec.make_bz2_compressor(),
+                                   type(bz2.BZ2Compressor())))
+        compressor = codec.make_bz2_compressor(workers=3, block_size=100)
+        self.assertTrue(isinstance(compressor, codec.ParallelBZ2Compressor))
+        self.assertEquals(compressor.max_in_flight, 6)
+        compressor.close()
+
+
+class TestBZ2Decompressors(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join('%6d' % j for j in xrange(30000))
+        self.compressed = ''.join(bz2.compress(self.data[j:j + 20000]) 
+                                  for j in xrange(0, len(self.data), 20000))
+
+    def _decompress(self, decompressor, data=None, packet_size=3000):
+        if data is None:
+            data = self.compressed
+        output = []
+        for j in xrange(0, len(data), packet_size):
+            output.append(decompressor.decompress(data[j:j + packet_size]))
+        output.append(decompressor.flush())
+        return ''.join(output)
+
+    def test_serial_multi_stream(self):
+        for packet_size in (1, 777, len(self.compressed)):
+            self.assertEquals(self._decompress(codec.BZ2StreamDecompressor(),
+                                               packet_size=packet_size), 
+                              self.data)
+
+    def test_serial_stream_ends_at_packet_end(self):
+        stream1 = bz2.compress('first')
+        decompressor = codec.BZ2StreamDecompressor()
+        self.assertEquals(decompressor.decompress(stream1), 'first')
+        self.assertTrue(decompressor.at_stream_end())
+        self.assertEquals(decompressor.decompress(bz2.compress('second')),
+                          'second')
+
+    def test_parallel(self):
+        for packet_size in (100, 5000, len(self.compressed)):
+            decompressor = codec.ParallelBZ2Decompressor(workers=3)
+            self.assertEquals(self._decompress(decompressor,
+                                               packet_size=packet_size), 
+                              self.data)
+
+    def test_parallel_single_stream(self):
+        # No stream boundaries, so the data is decompressed serially once
+        # there is more than max_span_size waiting.
+        data = os.urandom(50000)
+        decompressor = codec.ParallelBZ2Decompressor(workers=2,
+                                                     max_span_size=10000)
+        self.assertEquals(self._decompress(decompressor, bz2.compress(data)),
+                          data)
+
+    def test_parallel_false_boundaries(self):
+        # Pretend that lots of places inside streams are stream boundaries
+        false_starts = re.compile(r'BZh[1-9]1AY&SY|[\x00-\x20]')
+        with mock.patch.object(codec, 're_bz2_stream_start', false_starts):
+            decompressor = codec.ParallelBZ2Decompressor(workers=2)
+            self.assertEquals(self._decompress(decompressor), self.data)
+
+    def test_parallel_empty_streams(self):
+        compressed = bz2.compress('') + bz2.compress('abc') + bz2.compress('')
+        decompressor = codec.ParallelBZ2Decompressor(workers=2)
+        self.assertEquals(self._decompress(decompressor, compressed, 7), 'abc')
+
+    def test_parallel_bad_data(self):
+        decompressor = codec.ParallelBZ2Decompressor(workers=2)
+        self.assertRaises(IOError, self._decompress, decompressor,
+                          self.compressed + 'BZh91AY&SY' + 'x' * 100)
+
+    def test_detect_compression(self):
+        self.assertEquals(codec.detect_compression(self.compressed[:10]),
+                          'bzip2')
+        self.assertEquals(codec.detect_compression(bz2.compress('')[:10]),
+                          'bzip2')
+        self.assertEquals(codec.detect_compression('BZh9 not bz2'), None)
+
+
+
+class TestCodecs(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join('%6d' % j for j in xrange(10000))
+
+    def test_round_trip(self):
+        for name, each_codec in codec.codecs.iteritems():
+            for level in (1, None, 9):
+                compressor = each_codec.compressor(level)
+                compressed = ''.join(compressor.compress(self.data[j:j + 999])
+                                     for j in xrange(0, len(self.data), 999))
+                compressed += compressor.flush()
+                # Two streams concatenated
+                compressed *= 2
+                decompressor = each_codec.decompressor()
+                output = ''.join(decompressor.decompress(compressed[j:j + 500])
+                                 for j in xrange(0, len(compressed), 500))
+                output += decompressor.flush()
+                self.assertEquals(output, self.data * 2, name)
+
+    def test_gzip_is_readable_by_gzip_module(self):
+        compressor = codec.get_codec('gzip').compressor(1)
+        file_name = os.path.join(data_dir5, 'codec.tmp.gz')
+        out_file = open(file_name, 'wb')
+        out_file.write(compressor.compress(self.data) + compressor.flush())
+        out_file.close()
+        gz_file = gzip.open(file_name)
+        self.assertEquals(gz_file.read(), self.data)
+        gz_file.close()
+        os.remove(file_name)
+
+    def test_zlib_level(self):
+        for level in (1, 9):
+            compressor = codec.get_codec('zlib').compressor(level)
+            self.assertEquals(compressor.compress(self.data) + 
+                              compressor.flush(), 
+                              zlib.compress(self.data, level))
+        self.assertRaises(ValueError, codec.get_codec('zlib').compressor, 0)
+
+    def test_get_codec(self):
+        self.assertEquals(codec.get_codec('bzip').name, 'bzip2')
+        self.assertEquals(codec.get_codec('BZ2').name, 'bzip2')
+        self.assertEquals(codec.get_codec('gz').name, 'gzip')
+        self.assertRaises(ValueError, codec.get_codec, 'rar')
+
+    def test_codec_for_file_name(self):
+        self.assertEquals(codec.codec_for_file_name('a/b.dat.bz2').name,
+                          'bzip2')
+        self.assertEquals(codec.codec_for_file_name('b.GZ').name, 'gzip')
+        self.assertEquals(codec.codec_for_file_name('b.dat'), None)
+        self.assertEquals(codec.codec_for_file_name('bz2'), None)
+        self.assertEquals(codec.codec_for_file_name(None), None)
+
+    def test_register_codec(self):
+        identity = codec.Codec('identity', '.id', 
+                               lambda level, **options: Identity(),
+                               lambda **options: Identity(), 5)
+        codec.register_codec(identity)
+        try:
+            self.assertEquals(codec.get_codec('identity').compressor(
+                ).compress('abc'), 'abc')
+            self.assertEquals(codec.codec_for_file_name('x.id'), identity)
+        finally:
+            del codec.codecs['identity']
+
+    def test_detect_gzip(self):
+        compressor = codec.get_codec('gzip').compressor()
+        self.assertEquals(codec.detect_compression(
+            compressor.compress(self.data) + compressor.flush()), 'gzip')
+        self.assertEquals(codec.detect_compression(
+            zlib.compress(self.data)), None)
+
+
+class Identity(object):
+    def compress(self, data):
+        return data
+    decompress = compress
+    def flush(self):
+        return ''
+
+
+class TestBackgroundDecompressReader(unittest.TestCase):
+
+    def setUp(self):
+        self.file_name = os.path.join(data_dir5, 'background.tmp.bz2')
+        self.data = ''.join('%6d' % j for j in xrange(30000))
+        out_file = open(self.file_name, 'wb')
+        out_file.write(bz2.compress(self.data[:100000]))
+        out_file.write(bz2.compress(self.data[100000:]))
+        out_file.close()
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_read(self):
+        reader = codec.BackgroundDecompressReader(
+            open(self.file_name, 'rb'), codec.BZ2StreamDecompressor(),
+            read_size=1000, queue_size=2)
+        output = []
+        while True:
+            block = reader.read(4096)
+            if not block:
+                break
+            self.assertTrue(len(block) == 4096 or 
+                            sum(len(x) for x in output) + len(block) == 
+                            len(self.data))
+            output.append(block)
+        self.assertEquals(''.join(output), self.data)
+        self.assertEquals(reader.compressed_bytes_read,
+                          os.path.getsize(self.file_name))
+        reader.close()
+        self.assertTrue(reader.closed)
+
+    def test_close_before_end(self):
+        reader = codec.BackgroundDecompressReader(
+            open(self.file_name, 'rb'), codec.BZ2StreamDecompressor(),
+            read_size=100, queue_size=1)
+        self.assertEquals(reader.read(10), self.data[:10])
+        reader.close()
+        self.assertFalse(reader._thread.is_alive())
+
+    def test_error_is_raised(self):
+        reader = codec.BackgroundDecompressReader(
+            open(self.file_name, 'rb'), mock.Mock(
+                decompress=mock.Mock(side_effect=IOError('bad data'))))
+        self.assertRaises(IOError, reader.read, 10)
+        reader.close()
+
+
+if __name__ == '__main__':  #pragma: nocover
+    unittest.main()
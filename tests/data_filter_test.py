@@ -10,16 +10,24 @@ import os
 import shutil
 import mock
 import bz2
+import gzip
 import random
+import threading
+import time
+import zlib
 
 from copy import copy
 
 import filterpype.data_fltr_base as dfb
 import filterpype.data_filter as df
+import filterpype.data_fltr_demo as dfd
 import filterpype.filter_utils as fut
 import filterpype.filter_factory as ff
 import filterpype.pipeline as ppln
 import filterpype.ppln_demo as ppln_demo
+import filterpype.codec as codec
+
+import codec_test
 
 k_run_long_tests = True
 
@@ -539,6 +547,53 @@ class TestBranchIf(unittest.TestCase):
         self.assertEquals(len(self.sink_main.results), 1)
         self.assertEquals(len(self.sink_branch.results), 2)
         
+    def test_branch_if_comparison(self):
+        branch_if = df.BranchIf(branch_key='speed', comparison='less_than',
+                                compare_value=10)
+        branch_if.next_filter = self.hidden_branch_route
+        for speed in [5, 15, 9, 10]:
+            branch_if.send(dfb.DataPacket(data='x', speed=speed))
+        self.assertEquals([pkt.speed for pkt in self.sink_branch.results],
+                          [5, 9])
+        self.assertEquals([pkt.speed for pkt in self.sink_main.results],
+                          [15, 10])
+        branch_if.reset_params(comparison='greater_than')
+        branch_if.send(dfb.DataPacket(data='x', speed=12))
+        self.assertEquals(self.sink_branch.results[-1].speed, 12)
+
+    def test_branch_if_unknown_comparison(self):
+        self.assertRaises(dfb.FilterAttributeError, df.BranchIf,
+                          branch_key='speed', comparison='about')
+
+    def test_branch_if_needs_key_or_expr(self):
+        self.assertRaises(dfb.FilterAttributeError, df.BranchIf)
+
+    def test_branch_if_expr(self):
+        branch_if = df.BranchIf(
+            expr='p.altitude > 1000 and p.speed < f.compare_value',
+            compare_value=200)
+        branch_if.next_filter = self.hidden_branch_route
+        for altitude, speed in [(2000, 100), (500, 100), (2000, 300)]:
+            branch_if.send(dfb.DataPacket(data='x', altitude=altitude,
+                                          speed=speed))
+        self.assertEquals([(pkt.altitude, pkt.speed) 
+                           for pkt in self.sink_branch.results], 
+                          [(2000, 100)])
+        self.assertEquals(len(self.sink_main.results), 2)
+        branch_if.compare_value = 400
+        branch_if.send(dfb.DataPacket(data='x', altitude=2000, speed=300))
+        self.assertEquals(len(self.sink_branch.results), 2)
+        branch_if.reset_params(expr='p.speed == 1')
+        branch_if.send(dfb.DataPacket(data='x', altitude=2000, speed=300))
+        self.assertEquals(len(self.sink_main.results), 3)
+
+    def test_branch_if_expr_only_keys(self):
+        # Only the filter's keys, not its other attributes
+        for expr in ['p.speed < f.limit', 'f.next_filter is None',
+                     'f.packet_cache is None']:
+            self.assertRaises(dfb.FilterAttributeError, df.BranchIf, 
+                              expr=expr)
+
     def test_branch_if_branch_doesnt_exist(self):  # TO-DO <<< 
         # Martin's route needed a (waste) filter to work
         pass
@@ -659,7 +714,102 @@ class TestBZip2Filter(unittest.TestCase):
         out_file_handle.close()
         os.remove(dest_file_name)
 
+    def test_bzip_decompress_multi_stream(self):
+        input6 = ''.join('%5d' % j for j in xrange(2000))
+        compressed = ''.join(bz2.compress(input6[j:j + 900]) 
+                             for j in xrange(0, len(input6), 900))
+        for workers in (0, 3):
+            sink = df.Sink()
+            bzip_decompressor = df.BZipDecompress(workers=workers)
+            bzip_decompressor.next_filter = sink
+            for j in xrange(0, len(compressed), 333):
+                bzip_decompressor.send(dfb.DataPacket(compressed[j:j + 333]))
+            bzip_decompressor.shut_down()
+            self.assertEquals(''.join(sink.all_data), input6)
+
+    def test_bzip_compress_parallel(self):
+        bzip_compressor = df.BZipCompress(workers=3, block_size=1000)
+        bzip_compressor.next_filter = self.sink
+        input5 = ''.join('%5d' % j for j in xrange(2000))
+        for j in xrange(0, len(input5), 700):
+            bzip_compressor.send(dfb.DataPacket(input5[j:j + 700]))
+        bzip_compressor.shut_down()
+        compressed = ''.join(self.sink.all_data)
+        # Ten independent streams, one for each block
+        self.assertEquals(compressed.count('BZh9'), 10)
+        self.assertEquals(codec_test.decompress_streams(compressed), input5)
+        bzip_decompressor = df.BZipDecompress()
+        sink2 = df.Sink()
+        bzip_decompressor.next_filter = sink2
+        bzip_decompressor.send(dfb.DataPacket(compressed))
+        bzip_decompressor.shut_down()
+        self.assertEquals(''.join(sink2.all_data), input5)
+
+        
+class TestCompress(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join('%5d' % j for j in xrange(3000))
+
+    def _round_trip(self, compress, decompress):
+        sink = df.Sink(max_results=0)
+        compress.next_filter = decompress
+        decompress.next_filter = sink
+        for j in xrange(0, len(self.data), 1000):
+            compress.send(dfb.DataPacket(self.data[j:j + 1000]))
+        compress.shut_down()
+        self.assertEquals(''.join(sink.all_data), self.data)
+
+    def test_zlib(self):
+        self._round_trip(df.Compress(codec='zlib', compress_level=1),
+                         df.Decompress(codec='zlib'))
+
+    def test_gzip(self):
+        self._round_trip(df.Compress(codec='gzip'), df.Decompress(codec='gz'))
+
+    def test_bzip2_default(self):
+        self._round_trip(df.Compress(), df.BZipDecompress())
+
+    def test_reset_stops_workers(self):
+        compress = df.Compress(workers=2)
+        decompress = df.Decompress(workers=2)
+        compress.zero_inputs()
+        decompress.zero_inputs()
+        compressor = compress.compressor
+        decompressor = decompress.decompressor
+        compress.zero_inputs()
+        decompress.zero_inputs()
+        # The old thread pools have been stopped
+        self.assertEquals((compressor._pool, decompressor._pool), 
+                          (None, None))
+        self._round_trip(compress, decompress)
+
+    def test_unknown_codec(self):
+        compress = df.Compress(codec='rar')
+        self.assertRaises(dfb.FilterAttributeError, compress.send,
+                          dfb.DataPacket('abc'))
+
+    def test_compress_in_pipeline(self):
+        config = """
+        [--main--]
+        ftype = demo
+        description = TO-DO: docstring
+        
+        [compress]
+        codec = gzip
+        compress_level = 9
+        
+        [--route--]
+        compress >>>
+        decompress:gzip >>>
+        sink
+        """
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), config=config)
+        pipeline.send(dfb.DataPacket(self.data))
+        pipeline.shut_down()
+        self.assertEquals(''.join(pipeline.getf('sink').all_data), self.data)
         
+
 class TestCalcSlope(unittest.TestCase):
     
     def setUp(self):
@@ -695,6 +845,13 @@ class TestCalcSlope(unittest.TestCase):
         self.slope_calc.send(self.group_pkt_same)
         self.assertEquals(self.group_pkt_same.data[2].height_slope, 0.0)
 
+    def test_reset_suffix(self):
+        self.slope_calc.send(dfb.MessageBottle('calc_slope', 'reset',
+                                               param_name='calc_name_suffix',
+                                               new_value='rate'))
+        self.slope_calc.send(self.group_pkt1)
+        self.assertEquals(self.group_pkt1.data[2].height_rate, 1.0)
+
     
 class TestCalculate(unittest.TestCase):
     
@@ -746,8 +903,60 @@ class TestCalculate(unittest.TestCase):
                             rhs_value=1, param_result='DIVIDED')
         calc.next_filter = self.sink
         self.assertRaises(dfb.FilterAttributeError, calc.send, self.packet)
-        
-        
+
+    def test_packet_attributes(self):
+        calc = df.Calculate(lhs_value='distance', operator='divide',
+                            rhs_value='duration', param_result='speed')
+        calc.next_filter = self.sink
+        calc.send(dfb.DataPacket(data='', distance=10, duration=4))
+        calc.send(dfb.DataPacket(data='', distance=9, duration=3))
+        self.assertEquals([pkt.speed for pkt in self.sink.results],
+                          [2.5, 3.0])
+        self.assertEquals(calc.lhs_value, 'distance')
+
+    def test_result_already_set_raises(self):
+        calc = df.Calculate(lhs_value=1, rhs_value=2, param_result='data')
+        calc.next_filter = self.sink
+        self.assertRaises(dfb.FilterAttributeError, calc.send, self.packet)
+
+    def test_unknown_operator_raises(self):
+        self.assertRaises(dfb.FilterAttributeError, df.Calculate,
+                          lhs_value=1, operator='power', rhs_value=2,
+                          param_result='POWER')
+
+    def test_operands_needed(self):
+        self.assertRaises(dfb.FilterAttributeError, df.Calculate,
+                          lhs_value=1, param_result='total')
+        self.assertRaises(dfb.FilterAttributeError, df.Calculate,
+                          rhs_value='distance', param_result='total')
+
+    def test_expr(self):
+        calc = df.Calculate(expr='p.distance * 2 + max(p.values)',
+                            param_result='total')
+        calc.next_filter = self.sink
+        calc.send(dfb.DataPacket(data='', distance=10, values=[1, 7, 3]))
+        self.assertEquals(self.sink.results[-1].total, 27)
+
+    def test_expr_in_pipeline(self):
+        config = '''
+        [--main--]
+        ftype = test_calculate_expr
+        description = Calculate with an expression containing commas
+
+        [calculate]
+        expr = max(p.lhs, p.rhs) - min(p.lhs, p.rhs)
+        param_result = difference
+
+        [--route--]
+        calculate >>> sink
+        '''
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                 config=config)
+        pipeline.send(dfb.DataPacket(data='', lhs=3, rhs=10))
+        pipeline.shut_down()
+        self.assertEquals(pipeline.getf('sink').results[0].difference, 7)
+
+
 class TestCallbackOnAttribute(unittest.TestCase):
     
     def setUp(self):
@@ -1055,7 +1264,140 @@ class TestCallbackOnAttribute(unittest.TestCase):
         ##self.assertEqual(self.mocked_method.call_args,
                          ##( ("found:percent_read",), {'percent_read':1} ) )
 
-                
+
+    def _watch_values(self, values, **kwargs):
+        callback = mock.Mock()
+        callbacker = df.CallbackOnAttribute(watch_attr='level', 
+                                            callback=callback, 
+                                            environ=dict(job=1), **kwargs)
+        for value in values:
+            callbacker.send(dfb.DataPacket(level=value))
+        callbacker.shut_down()
+        return callback.call_args_list
+
+    def test_async_callback_same_as_sync(self):
+        values = [None, 1, 1, 2, 3, 3, 3, 4, 2]
+        for kwargs in [dict(watch_for_change=True), 
+                       dict(allowed_inconsistencies=1, count_to_confirm=5),
+                       dict(num_watch_pkts=2, count_to_confirm=2),
+                       dict(count_to_confirm=20)]:
+            sync_calls = self._watch_values(values, **kwargs)
+            kwargs.update(async_callback=True, callback_queue_size=2)
+            self.assertEquals(self._watch_values(values, **kwargs), 
+                              sync_calls)
+            self.assertTrue(sync_calls)
+
+    def test_async_callback_gets_environ_at_the_time(self):
+        calls = self._watch_values([5, 6, 7], watch_for_change=True,
+                                   async_callback=True)
+        self.assertEquals([kwargs['level'] for args, kwargs in calls], 
+                          [5, 6, 7])
+
+    def test_async_callback_error(self):
+        callbacker = df.CallbackOnAttribute(
+            watch_attr='level', callback=mock.Mock(side_effect=IOError),
+            async_callback=True)
+        callbacker.send(dfb.DataPacket(level=1))
+        self.assertRaises(IOError, callbacker.close_filter)
+
+    def test_async_callback_bad_policy(self):
+        self.assertRaises(dfb.FilterAttributeError, df.CallbackOnAttribute,
+                          watch_attr='level', callback=mock.Mock(),
+                          async_callback=True, overflow_policy='explode')
+
+    def test_async_close_when_found(self):
+        config = '''
+        [--main--]
+        keys=callback
+        ftype=aaa
+        description=bbb
+        
+        [callback_on_attribute]
+        watch_attr = not_here
+        callback = ${callback}
+        close_when_found = true
+        async_callback = true
+        [--route--]
+        callback_on_attribute >>>
+        pass_through
+        '''
+        calls = []
+        def slow_callback(*args, **kwargs):
+            time.sleep(0.05)
+            calls.append(args)
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                 config=config, callback=slow_callback)
+        sink = df.Sink(max_results=100)
+        pipeline.next_filter = sink
+        for counter in xrange(100):
+            if pipeline.shutting_down:
+                break
+            pipeline.send(dfb.DataPacket(not_here=counter or None))
+        # The callback has been made by the time the pipeline has closed
+        self.assertEquals(calls, [('found:not_here',)])
+        self.assertEquals(len(sink.results), 2)
+
+
+class TestCallbackDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def _callback(self, value):
+        self.release.wait()
+        self.calls.append(value)
+
+    def _dispatch(self, overflow, items):
+        dispatcher = fut.CallbackDispatcher(queue_size=2, overflow=overflow)
+        dispatcher.start()
+        # The first is taken by the thread, which then waits for release
+        dispatcher.dispatch('first', self._callback, 'first')
+        while dispatcher._items:
+            time.sleep(0.001)
+        for key, value in items:
+            dispatcher.dispatch(key, self._callback, value)
+        self.release.set()
+        dispatcher.finish()
+        return dispatcher
+
+    def test_drop_oldest(self):
+        dispatcher = self._dispatch('drop_oldest', 
+                                    [('a', 1), ('a', 2), ('b', 3), ('a', 4)])
+        self.assertEquals(self.calls, ['first', 3, 4])
+        self.assertEquals(dispatcher.dropped, 2)
+
+    def test_coalesce(self):
+        dispatcher = self._dispatch('coalesce', 
+                                    [('a', 1), ('b', 2), ('b', 3), ('b', 4)])
+        self.assertEquals(self.calls, ['first', 1, 4])
+        self.assertEquals(dispatcher.coalesced, 2)
+
+    def test_block(self):
+        dispatcher = fut.CallbackDispatcher(queue_size=1, overflow='block')
+        dispatcher.start()
+        for j in xrange(20):
+            dispatcher.dispatch('a', self.calls.append, j)
+        dispatcher.finish()
+        self.assertEquals(self.calls, range(20))
+
+    def test_stopped_after_error(self):
+        dispatcher = fut.CallbackDispatcher()
+        dispatcher.start()
+        dispatcher.dispatch('a', mock.Mock(side_effect=IOError))
+        while dispatcher.error is None:
+            time.sleep(0.001)
+        self.assertRaises(IOError, dispatcher.dispatch, 'a', 
+                          self.calls.append, 1)
+        dispatcher.dispatch('a', self.calls.append, 2)
+        dispatcher.finish()
+        self.assertEquals(self.calls, [])
+        self.assertTrue(dispatcher.failed)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, fut.CallbackDispatcher, 
+                          overflow='explode')
+
         
 class TestCombine(unittest.TestCase):
     
@@ -1471,6 +1813,112 @@ class TestDistillHeader(unittest.TestCase):
         self.assertEquals(len(self.main_sink.results), 1)
         
 
+class TestProgressMeter(unittest.TestCase):
+
+    def setUp(self):
+        self.callback = mock.Mock()
+        self.sink = df.Sink(max_results=0)
+        self.clock = [1000.0]
+
+    def _send(self, meter, sizes, file_name='a.dat', secs_per_packet=0.01,
+              file_size=None):
+        meter.next_filter = self.sink
+        position = 0
+        with mock.patch.object(df.time, 'time', lambda: self.clock[0]):
+            for size in sizes:
+                position += size
+                self.clock[0] += secs_per_packet
+                meter.send(dfb.DataPacket('x' * size, read_bytes=position,
+                                          source_file_name=file_name))
+
+    def _reports(self):
+        return [kwargs for args, kwargs in self.callback.call_args_list]
+
+    def test_rate_limited(self):
+        meter = df.ProgressMeter(callback=self.callback, file_size=100000,
+                                 interval_ms=100, full_environ=True)
+        # 1000 packets over 10 seconds
+        self._send(meter, [100] * 1000)
+        reports = self._reports()
+        self.assertTrue(90 <= len(reports) <= 102, len(reports))
+        self.assertEquals(reports[0]['bytes_read'], 100)
+        self.assertEquals(reports[0]['bytes_per_sec'], None)
+        self.assertEquals(reports[-1]['read_percent'], 100)
+        self.assertEquals(reports[-1]['eta_secs'], 0)
+        self.assertEquals(len(self.sink.results), 1000)
+        self.assertEquals(self.callback.call_args_list[0][0], ('progress',))
+
+    def test_throughput_and_eta(self):
+        meter = df.ProgressMeter(callback=self.callback, file_size=2000,
+                                 interval_ms=0, percent_step=50, 
+                                 full_environ=True)
+        # 100 bytes every 0.5 secs
+        self._send(meter, [100] * 20, secs_per_packet=0.5)
+        reports = self._reports()
+        self.assertEquals([r['read_percent'] for r in reports], [5, 55, 100])
+        self.assertAlmostEqual(reports[1]['bytes_per_sec'], 200.0, 3)
+        self.assertAlmostEqual(reports[1]['eta_secs'], 4.5, 3)
+
+    def test_file_size_looked_up_per_file(self):
+        file_name1 = os.path.join(data_dir5, 'meter1.tmp')
+        file_name2 = os.path.join(data_dir5, 'meter2.tmp')
+        for file_name, size in [(file_name1, 1000), (file_name2, 300)]:
+            f1 = open(file_name, 'wb')
+            f1.write('x' * size)
+            f1.close()
+        meter = df.ProgressMeter(callback=self.callback, interval_ms=0,
+                                 percent_step=25, full_environ=True)
+        self._send(meter, [100] * 10, file_name1)
+        self._send(meter, [100] * 3, file_name2)
+        reports = self._reports()
+        self.assertEquals([(r['source_file_name'], r['read_percent']) 
+                           for r in reports],
+                          [(file_name1, 10), (file_name1, 40), 
+                           (file_name1, 70), (file_name1, 100),
+                           (file_name2, 33), (file_name2, 66),
+                           (file_name2, 100)])
+        self.assertEquals(reports[-1]['file_size'], 300)
+        os.remove(file_name1)
+        os.remove(file_name2)
+
+    def test_counting_data(self):
+        meter = df.ProgressMeter(callback=self.callback, bytes_attr=None,
+                                 interval_ms=0, percent_step=0, 
+                                 full_environ=True)
+        meter.next_filter = self.sink
+        for data in ('abc', 'de', 'f'):
+            meter.send(dfb.DataPacket(data))
+        self.assertEquals([r['bytes_read'] for r in self._reports()],
+                          [3, 5, 6])
+        self.assertEquals(self._reports()[0]['read_percent'], -1)
+
+    def test_default_environ(self):
+        # Only read_percent, as from callback_on_attribute
+        meter = df.ProgressMeter(callback=self.callback, file_size=200,
+                                 interval_ms=0, environ=dict(job='copy'))
+        self._send(meter, [100] * 2)
+        self.assertEquals(self._reports(), 
+                          [dict(job='copy', read_percent=50),
+                           dict(job='copy', read_percent=100)])
+
+    def test_file_position(self):
+        # As from read_batch decompressing: read_bytes counts the
+        # decompressed data, and file_position is in the 200 byte file
+        meter = df.ProgressMeter(callback=self.callback, file_size=200,
+                                 interval_ms=0)
+        meter.next_filter = self.sink
+        for position in (50, 200):
+            meter.send(dfb.DataPacket('x' * 1000, read_bytes=position * 10,
+                                      file_position=position))
+        self.assertEquals([r['read_percent'] for r in self._reports()],
+                          [25, 100])
+
+    def test_no_callback(self):
+        meter = df.ProgressMeter()
+        self._send(meter, [10] * 5)
+        self.assertEquals(len(self.sink.results), 5)
+
+
 class TestReadBatch(unittest.TestCase):
 
     def setUp(self):
@@ -1495,6 +1943,58 @@ class TestReadBatch(unittest.TestCase):
         self.assertEquals(self.sink.results[1].data, 'ree four f')
         self.assertEquals(self.sink.results[2].data, 'ive six')
         
+    def test_read_batch_progress_per_file(self):
+        file_name2 = os.path.join(data_dir5, 'short2.dat')
+        f2 = open(file_name2, 'wb')
+        f2.write('one two')
+        f2.close()
+        read_batch1 = df.ReadBatch(batch_size=10)
+        read_batch1.next_filter = self.sink
+        read_batch1.send(dfb.DataPacket(self.file_name1))
+        read_batch1.send(dfb.DataPacket(file_name2))
+        read_batch1.shut_down()
+        self.assertEquals([pkt.read_percent for pkt in self.sink.results],
+                          [37, 74, 100, 100])
+        os.remove(file_name2)
+
+    def test_read_batch_decompress(self):
+        file_name2 = os.path.join(data_dir5, 'short.dat.bz2')
+        f2 = open(file_name2, 'wb')
+        try:
+            f2.write(bz2.compress('one two three '))
+            f2.write(bz2.compress('four five six'))
+        finally:
+            f2.close()
+        file_name3 = os.path.join(data_dir5, 'short.dat.gz')
+        f3 = gzip.open(file_name3, 'wb')
+        try:
+            f3.write('one two three four five six')
+        finally:
+            f3.close()
+        read_batch1 = df.ReadBatch(batch_size=10, decompress=True)
+        read_batch1.next_filter = self.sink
+        read_batch1.send(dfb.DataPacket(file_name3))
+        read_batch1.shut_down()
+        self.assertEquals(''.join(self.sink.all_data),
+                          'one two three four five six')
+        os.remove(file_name3)
+        for workers in (0, 2):
+            sink = df.Sink()
+            read_batch1 = df.ReadBatch(batch_size=10, decompress=True,
+                                       decompress_workers=workers)
+            read_batch1.next_filter = sink
+            read_batch1.send(dfb.DataPacket(file_name2))
+            # Uncompressed files are read as usual
+            read_batch1.send(dfb.DataPacket(self.file_name1))
+            read_batch1.shut_down()
+            self.assertEquals([pkt.data for pkt in sink.results],
+                              ['one two th', 'ree four f', 'ive six'] * 2)
+            self.assertEquals(sink.results[2].read_percent, 100)
+            self.assertEquals(sink.results[2].read_bytes, 27)
+            self.assertEquals(sink.results[2].file_position,
+                              os.path.getsize(file_name2))
+        os.remove(file_name2)
+
     def test_read_batch_with_file_obj(self):
         read_batch1 = df.ReadBatch(batch_size=10)
         read_batch1.next_filter = self.sink
@@ -1784,6 +2284,44 @@ class SomePythonFunctions(ppln.Pipeline):
 
 class Dummy(object): pass
     
+class TestFilterWhere(unittest.TestCase):
+
+    def test_filter_where(self):
+        filter_where = df.FilterWhere(expr='p.altitude > 1000 and p.ok')
+        sink = df.Sink()
+        filter_where.next_filter = sink
+        for altitude, ok in [(2000, True), (500, True), (3000, False), 
+                             (1500, True)]:
+            filter_where.send(dfb.DataPacket(data='x', altitude=altitude,
+                                             ok=ok))
+        self.assertEquals([pkt.altitude for pkt in sink.results], 
+                          [2000, 1500])
+        filter_where.reset_params(expr='not p.ok')
+        filter_where.send(dfb.DataPacket(data='x', altitude=0, ok=False))
+        self.assertEquals(sink.results[-1].altitude, 0)
+
+    def test_filter_where_in_pipeline(self):
+        config = '''
+        [--main--]
+        ftype = test_filter_where
+        description = Drop packets with filter_where
+
+        [filter_where]
+        expr = p.data[0] == 'b' or len(p.data) > 4
+
+        [--route--]
+        filter_where >>> sink
+        '''
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                 config=config)
+        for data in ['apple', 'pear', 'banana', 'fig']:
+            pipeline.send(dfb.DataPacket(data=data))
+        pipeline.shut_down()
+        self.assertEquals([pkt.data for pkt in 
+                           pipeline.getf('sink').results], 
+                          ['apple', 'banana'])
+        
+        
 class TestEmbedPython(unittest.TestCase):
     
     def setUp(self):
@@ -2023,6 +2561,73 @@ class TestHashSHA256(unittest.TestCase):
         self.assertEquals('|'.join(self.sink.all_data), input1 + '|' + input2)
         self.assertEquals(hash_sha256.hasher.hexdigest(), hash_obj2.hexdigest())
 
+class TestHashMulti(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = df.Sink()
+        self.data = [''.join(chr(j % 256) for j in xrange(k, k + size))
+                     for k, size in [(0, 10), (5, 70000), (3, 5), (9, 200000),
+                                     (1, 1)]]
+        all_data = ''.join(self.data)
+        self.expected = dict(sha256_digest=hashlib.sha256(all_data).hexdigest(),
+                             md5_digest=hashlib.md5(all_data).hexdigest(),
+                             crc32_digest='%08x' % (zlib.crc32(all_data) & 
+                                                    0xffffffff))
+
+    def _hash(self, hash_multi):
+        hash_multi.next_filter = self.sink
+        for data in self.data:
+            hash_multi.send(dfb.DataPacket(data))
+        hash_multi.shut_down()
+        self.assertEquals(hash_multi.digest_values, self.expected)
+        for attr_name, digest in self.expected.iteritems():
+            self.assertEquals(getattr(hash_multi, attr_name), digest)
+        self.assertEquals(self.sink.all_data[:len(self.data)], self.data)
+
+    def test_hash_multi(self):
+        self._hash(df.HashMulti(digests=['sha256', 'md5', 'crc32']))
+
+    def test_hash_multi_threaded(self):
+        self._hash(df.HashMulti(digests='sha256, MD5, crc32',
+                                thread_threshold=0x10000))
+
+    def test_hash_multi_unknown_digest(self):
+        self.assertRaises(dfb.FilterAttributeError, df.HashMulti,
+                          digests=['sha256', 'no_such_hash'])
+
+    def test_hash_multi_digest_packet(self):
+        hash_multi = df.HashMulti(digests='sha256, md5, crc32',
+                                  digest_packet=True)
+        self._hash(hash_multi)
+        last_packet = self.sink.results[-1]
+        self.assertEquals(last_packet.data, '')
+        self.assertEquals(last_packet.md5_digest, self.expected['md5_digest'])
+
+    def test_hash_multi_in_pipeline(self):
+        config = """
+        [--main--]
+        ftype = demo
+        description = TO-DO: docstring
+        
+        [hash_multi]
+        digests = adler32, sha1
+        thread_threshold = 100
+        
+        [--route--]
+        hash_multi >>>
+        sink
+        """
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), config=config)
+        for data in self.data:
+            pipeline.send(dfb.DataPacket(data))
+        pipeline.shut_down()
+        all_data = ''.join(self.data)
+        self.assertEquals(pipeline.sha1_digest, 
+                          hashlib.sha1(all_data).hexdigest())
+        self.assertEquals(pipeline.adler32_digest,
+                          '%08x' % (zlib.adler32(all_data) & 0xffffffff))
+
+
 class TestHeaderAsAttribute(unittest.TestCase):
     
     def setUp(self):
@@ -2123,6 +2728,148 @@ class TestJoin(unittest.TestCase):
         self.assertEquals(self.sink.results[-1].data, 'four~five~six')
         
 
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.merge = df.Merge()
+        self.sink = df.Sink()
+        self.merge.next_filter = self.sink
+        self.route1 = df.PassThrough()
+        self.route2 = df.PassThrough()
+        self.route1.next_filter = self.merge
+        self.route2.next_filter = self.merge
+
+    def sent_seq_nums(self):
+        return [packet.seq_num for packet in self.sink.results]
+
+    def test_interleave(self):
+        for route, seq_num in [(self.route1, 0), (self.route1, 2),
+                               (self.route2, 1), (self.route2, 3)]:
+            route.send(dfb.DataPacket('x', seq_num=seq_num))
+        self.assertEquals(self.sent_seq_nums(), [0, 1, 2])
+        self.route1.send(dfb.DataPacket('x', seq_num=5))
+        self.route2.send(dfb.DataPacket('x', seq_num=4))
+        self.assertEquals(self.sent_seq_nums(), [0, 1, 2, 3, 4])
+        self.merge.shut_down()
+        self.assertEquals(self.sent_seq_nums(), [0, 1, 2, 3, 4, 5])
+
+    def test_max_buffered(self):
+        self.merge.max_buffered = 2
+        for seq_num in xrange(4):
+            self.route1.send(dfb.DataPacket('x', seq_num=seq_num))
+        self.assertEquals(self.sent_seq_nums(), [0, 1])
+
+    def test_missing_seq_num(self):
+        packet = dfb.DataPacket('x')
+        del packet.seq_num
+        self.assertRaises(dfb.DataError, self.route1.send, packet)
+
+    def test_main_and_branch(self):
+        config = '''
+        [--main--]
+        ftype = merge_test
+        description = Merge the main and branch routes after a fork
+
+        [--route--]
+        seq_packet >>>
+        branch_clone >>>
+            (reverse_string >>> merge)
+        pass_through >>>
+        merge >>>
+        sink
+        '''
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                 config=config)
+        for data in ['ab', 'cd', 'ef']:
+            pipeline.send(dfb.DataPacket(data))
+        pipeline.shut_down()
+        self.assertEquals([(packet.seq_num, packet.data) for packet in 
+                           pipeline.getf('sink').results],
+                          [(0, 'ba'), (0, 'ab'), (1, 'dc'), (1, 'cd'), 
+                           (2, 'fe'), (2, 'ef')])
+
+
+class MergeTestFactory(ff.DemoFilterFactory):
+
+    def __init__(self):
+        ff.DemoFilterFactory.__init__(self)
+        self._apply_class_map(dict(sum_bytes=dfd.SumBytes))
+
+
+class TestMergeState(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = count_everything
+    description = Filters with state that can be merged
+
+    [collect_data]
+    collection_size = 2
+
+    [--route--]
+    count_bytes >>> 
+    count_packets >>> 
+    data_length >>> 
+    collect_data >>> 
+    sum_bytes >>> 
+    sink
+    '''
+    attr_names = [('count_bytes', 'counted_bytes'), 
+                  ('count_bytes', 'counted_packets'), 
+                  ('count_packets', 'counted_packets'),
+                  ('data_length', 'bytes_seen'),
+                  ('data_length', 'data_last_seen'),
+                  ('sum_bytes', 'byte_sum'),
+                  ('sum_bytes', 'byte_dict')]
+
+    def run_pipeline(self, blocks):
+        pipeline = ppln.Pipeline(factory=MergeTestFactory(), 
+                                 config=self.config)
+        for block in blocks:
+            pipeline.send(dfb.DataPacket(block))
+        return pipeline
+
+    def get_values(self, pipeline):
+        return [getattr(pipeline.getf(filter_name), attr_name)
+                for filter_name, attr_name in self.attr_names]
+
+    def test_merged_equals_single(self):
+        blocks = ['abc', 'defgh\x00', '\x00\x00', 'xy', '\x00']
+        single = self.run_pipeline(blocks)
+        for split in xrange(1, len(blocks)):
+            first = self.run_pipeline(blocks[:split])
+            second = self.run_pipeline(blocks[split:])
+            for filter_name in ['count_bytes', 'count_packets', 
+                                'data_length', 'sum_bytes']:
+                first.getf(filter_name).merge_state(
+                    second.getf(filter_name).export_state())
+            self.assertEquals(self.get_values(first), 
+                              self.get_values(single))
+        self.assertEquals(single.getf('data_length').data_last_seen, 13)
+
+    def test_merge_filter(self):
+        first = self.run_pipeline(['abc'])
+        second = self.run_pipeline(['de', 'f'])
+        first.getf('count_bytes').merge_state(second.getf('count_bytes'))
+        self.assertEquals(first.getf('count_bytes').counted_bytes, 6)
+        self.assertEquals(first.getf('count_bytes').counted_packets, 3)
+        self.assertEquals(second.getf('count_bytes').counted_bytes, 3)
+
+    def test_no_state(self):
+        pipeline = self.run_pipeline([])
+        self.assertRaises(dfb.FilterError, pipeline.getf('sink').export_state)
+        # Collecting 2 at a time, 'a' and then 'b', 'c' give ['b', 'c'] 
+        # with 'a' left over, not ['a', 'b'] with 'c' left over
+        self.assertRaises(dfb.FilterError, 
+                          pipeline.getf('collect_data').export_state)
+
+    def test_merge_values(self):
+        self.assertEquals(dfb.merge_values(dict(a=1, b=[2], c=dict(d=3)),
+                                           dict(a=4, b=[5], c=dict(d=6, e=7),
+                                                f='g')),
+                          dict(a=5, b=[2, 5], c=dict(d=9, e=7), f='g'))
+
+
 class TestPassNonZero(unittest.TestCase):
     
     def setUp(self):
@@ -2385,6 +3132,62 @@ class TestSwapTwoBytes(unittest.TestCase):
         ##self.assertRaises(dfb.FilterProcessingException, reverse.send, packet)
 
 
+class TestReorder(unittest.TestCase):
+
+    def setUp(self):
+        self.reorder = df.Reorder()
+        self.sink = df.Sink()
+        self.reorder.next_filter = self.sink
+
+    def send_seq_nums(self, seq_nums):
+        for seq_num in seq_nums:
+            self.reorder.send(dfb.DataPacket(str(seq_num), seq_num=seq_num))
+
+    def sent_seq_nums(self):
+        return [packet.seq_num for packet in self.sink.results]
+
+    def test_reorder(self):
+        self.send_seq_nums([2, 0, 3])
+        self.assertEquals(self.sent_seq_nums(), [0])
+        self.send_seq_nums([1, 5, 4])
+        self.assertEquals(self.sent_seq_nums(), [0, 1, 2, 3, 4, 5])
+        self.assertEquals(self.reorder.next_seq_num, 6)
+        self.assertEquals(len(self.reorder._heap), 0)
+
+    def test_late_and_duplicate(self):
+        self.send_seq_nums([0, 2, 2, 1, 0])
+        self.assertEquals(self.sent_seq_nums(), [0, 1, 2])
+        self.assertEquals(self.reorder.late_count, 2)
+
+    def test_max_buffered(self):
+        self.reorder.max_buffered = 3
+        self.send_seq_nums([1, 3, 4])
+        self.assertEquals(self.sent_seq_nums(), [])
+        self.send_seq_nums([5])
+        self.assertEquals(self.sent_seq_nums(), [1])
+        self.send_seq_nums([0, 2])
+        self.assertEquals(self.sent_seq_nums(), [1, 2, 3, 4, 5])
+        self.assertEquals(self.reorder.skipped_count, 1)
+        self.assertEquals(self.reorder.late_count, 1)
+
+    def test_gap_timeout(self):
+        self.reorder.gap_timeout = 0.05
+        self.send_seq_nums([1, 2])
+        self.assertEquals(self.sent_seq_nums(), [])
+        time.sleep(0.1)
+        self.send_seq_nums([4])
+        self.assertEquals(self.sent_seq_nums(), [1, 2])
+        self.assertEquals(self.reorder.skipped_count, 1)
+
+    def test_close(self):
+        self.reorder.first_seq_num = 10
+        self.reorder.zero_inputs()
+        self.send_seq_nums([13, 11])
+        self.reorder.shut_down()
+        self.assertEquals(self.sent_seq_nums(), [11, 13])
+        self.assertEquals(self.reorder.skipped_count, 2)
+
+
 class TestReverseString(unittest.TestCase):
     
     def setUp(self):
@@ -2409,6 +3212,85 @@ class TestReverseString(unittest.TestCase):
         self.assertEquals(self.sink.results[-1].data, '\xFF\xFF\x00\x00')
 
     
+class TestRouteBy(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = route_by_colour
+    description = Route packets by their colour
+    fuse = %s
+
+    [tag_packet]
+    tag_field_name = tag
+    tag_field_value = old
+
+    [--route--]
+    seq_packet >>>
+    route_by:colour >>>
+        [red: tag_packet >>> reverse_string >>> sink_red]
+        [blue: sink_blue]
+        [7: sink_seven]
+    sink_other
+    '''
+
+    def make_pipeline(self, fuse=False):
+        return ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                             config=self.config % fuse)
+
+    def sent(self, pipeline, sink_name):
+        return [(packet.seq_num, packet.data) 
+                for packet in pipeline.getf(sink_name).results]
+
+    def check_routing(self, pipeline):
+        for data, colour in [('ab', 'red'), ('cd', 'blue'), ('ef', 7), 
+                             ('gh', 'green'), ('ij', '7'), ('kl', [7])]:
+            pipeline.send(dfb.DataPacket(data, colour=colour))
+        pipeline.send(dfb.DataPacket('mn'))  # No colour
+        pipeline.shut_down()
+        self.assertEquals(self.sent(pipeline, 'sink_red'), [(0, 'ba')])
+        self.assertEquals(self.sent(pipeline, 'sink_blue'), [(1, 'cd')])
+        self.assertEquals(self.sent(pipeline, 'sink_seven'), 
+                          [(2, 'ef'), (4, 'ij')])
+        self.assertEquals(self.sent(pipeline, 'sink_other'), 
+                          [(3, 'gh'), (5, 'kl'), (6, 'mn')])
+
+    def test_route_by(self):
+        pipeline = self.make_pipeline()
+        route_by = pipeline.getf('route_by')
+        self.assertEquals(route_by.output_filters, 
+                          dict(red=pipeline.getf('tag_packet'),
+                               blue=pipeline.getf('sink_blue'),
+                               **{'7':pipeline.getf('sink_seven')}))
+        self.assertEquals(route_by.next_filter, pipeline.getf('sink_other'))
+        self.check_routing(pipeline)
+
+    def test_fused_output(self):
+        pipeline = self.make_pipeline(fuse=True)
+        self.assertEquals(pipeline.getf('route_by').output_filters['red'].name,
+                          'tag_packet+reverse_string')
+        self.check_routing(pipeline)
+
+    def test_message_bottle(self):
+        pipeline = self.make_pipeline()
+        pipeline.first_filter.send(dfb.MessageBottle(
+            'tag_packet', 'reset', param_name='tag_field_value', 
+            new_value='new'))
+        pipeline.send(dfb.DataPacket('ab', colour='red'))
+        self.assertEquals(pipeline.getf('sink_red').results[-1].tag, 'new')
+
+    def test_not_route_by(self):
+        config = '''
+        [--main--]
+        ftype = bad_outputs
+        description = Named outputs on a filter that can't have them
+
+        [--route--]
+        pass_through >>> [red: sink_red] sink
+        '''
+        self.assertRaises(dfb.PipelineConfigError, ppln.Pipeline, 
+                          factory=ff.DemoFilterFactory(), config=config)
+
+
 class TestSeqPacket(unittest.TestCase):
     
     def setUp(self):
@@ -2849,6 +3731,75 @@ class TestTankQueue(unittest.TestCase):
                           [packet1, packet2, packet3])
         
         
+class RecordThread(dfb.DataFilter):
+    """Note the thread each packet goes through, for TestThreadBoundary."""
+    ftype = 'record_thread'
+
+    def filter_data(self, packet):
+        packet.thread = threading.current_thread()
+        if packet.data == 'bad':
+            raise dfb.DataError, 'Bad packet'
+        self.send_on(packet)
+
+
+class ThreadTestFactory(ff.DemoFilterFactory):
+
+    def __init__(self):
+        ff.DemoFilterFactory.__init__(self)
+        self._apply_class_map(dict(record_thread=RecordThread))
+
+
+class TestThreadBoundary(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = testing_thread_boundary
+    description = Filters after the boundary run in another thread
+
+    [wrap]
+    data_prefix = <
+    data_suffix = >
+
+    [--route--]
+    seq_packet >>>
+    thread_boundary:2 >>>
+    record_thread >>>
+    wrap >>>
+    sink:0
+    '''
+
+    def setUp(self):
+        self.factory = ThreadTestFactory()
+        self.pipeline = ppln.Pipeline(factory=self.factory, 
+                                      config=self.config)
+        self.sink = self.pipeline.getf('sink')
+
+    def test_packets_in_order(self):
+        for j in xrange(50):
+            self.pipeline.send(dfb.DataPacket(str(j)))
+        self.pipeline.shut_down()
+        self.assertEquals(self.sink.all_data, 
+                          ['<%d>' % j for j in xrange(50)])
+        self.assertEquals([pkt.seq_num for pkt in self.sink.results], 
+                          range(50))
+        threads = set(pkt.thread for pkt in self.sink.results)
+        self.assertEquals(len(threads), 1)
+        self.assertNotEquals(threads.pop(), threading.current_thread())
+        self.assertTrue(self.sink.closing)
+
+    def test_bottles_in_order(self):
+        self.pipeline.send(dfb.DataPacket('a'), dfb.DataPacket('b'))
+        self.pipeline.first_filter.send(dfb.MessageBottle(
+            'wrap', 'reset', param_name='data_prefix', new_value='['))
+        self.pipeline.send(dfb.DataPacket('c'))
+        self.pipeline.shut_down()
+        self.assertEquals(self.sink.all_data, ['<a>', '<b>', '[c>'])
+
+    def test_error_after_boundary(self):
+        self.pipeline.send(dfb.DataPacket('bad'))
+        self.assertRaises(dfb.DataError, self.pipeline.shut_down)
+
+
 class TestWaste(unittest.TestCase):
     def setUp(self):
         self.sink = df.Sink()
@@ -3061,6 +4012,146 @@ class TestWriteFile(unittest.TestCase):
         write_file.send(data_to_write_1)
         write_file.shut_down()
 
+    def test_write_file_bzip2_parallel(self):
+        write_file = df.WriteFile(dest_file_name=self.file_name_out,
+                                  compress='bzip', compress_workers=2,
+                                  compress_block_size=500, buffer_size=300)
+        test_data = ''.join('line %d\n' % j for j in xrange(400))
+        for line in fut.split_strings(test_data, 11):
+            write_file.send(dfb.DataPacket(data=line))
+        write_file.shut_down()
+        compressed = open(self.file_name_out + '.bz2', 'rb').read()
+        self.assertTrue(compressed.count('BZh9') > 1)
+        self.assertEqual(codec_test.decompress_streams(compressed), test_data)
+        os.remove(self.file_name_out + '.bz2')
+
+    def test_write_file_codecs(self):
+        test_data = ''.join('line %d\n' % j for j in xrange(400))
+        for compress, ext in [('gzip', '.gz'), ('zlib', '.zz'),
+                              ('bzip2', '.bz2')]:
+            write_file = df.WriteFile(dest_file_name=self.file_name_out,
+                                      compress=compress, compress_level=1)
+            write_file.send(dfb.DataPacket(data=test_data))
+            write_file.shut_down()
+            file_name = self.file_name_out + ext
+            decompressor = codec.get_codec(compress).decompressor()
+            self.assertEqual(decompressor.decompress(
+                open(file_name, 'rb').read()), test_data)
+            os.remove(file_name)
+
+    def test_write_file_auto_compress(self):
+        for ext in ('.gz', '.bz2', ''):
+            file_name = self.file_name_out + ext
+            write_file = df.WriteFile(dest_file_name=file_name,
+                                      compress='auto')
+            write_file.send(dfb.DataPacket(data='auto data'))
+            write_file.shut_down()
+            # Nothing added to the file name
+            contents = open(file_name, 'rb').read()
+            if ext:
+                self.assertEquals(codec.codec_for_file_name(
+                    file_name).decompressor().decompress(contents), 
+                    'auto data')
+                os.remove(file_name)
+            else:
+                self.assertEquals(contents, 'auto data')
+
+    def test_write_file_bad_codec(self):
+        self.assertRaises(dfb.FilterAttributeError, df.WriteFile,
+                          dest_file_name=self.file_name_out, compress='rar')
+
+    def test_write_file_buffered(self):
+        # Small packets are held back until buffer_size bytes are waiting
+        write_file = df.WriteFile(dest_file_name=self.file_name_out,
+                                  buffer_size=10)
+        for data in ('abc', 'def', 'ghi'):
+            write_file.send(dfb.DataPacket(data=data))
+        self.assertFalse(os.path.exists(self.file_name_out))
+        write_file.send(dfb.DataPacket(data='jkl'))
+        self.assertTrue(os.path.exists(self.file_name_out))
+        write_file.send(dfb.DataPacket(data='mno'))
+        write_file.shut_down()
+        self.assertEquals(open(self.file_name_out, 'rb').read(), 
+                          'abcdefghijklmno')
+
+    def test_write_file_empty_input(self):
+        # As before buffering, a packet with no data still creates the file
+        write_file = df.WriteFile(dest_file_name=self.file_name_out)
+        write_file.send(dfb.DataPacket(data=''))
+        write_file.shut_down()
+        self.assertEquals(open(self.file_name_out, 'rb').read(), '')
+
+    def test_write_file_unbuffered(self):
+        write_file = df.WriteFile(dest_file_name=self.file_name_out,
+                                  buffer_size=0)
+        write_file.send(dfb.DataPacket(data='abc'))
+        self.assertTrue(os.path.exists(self.file_name_out))
+        write_file.send(dfb.DataPacket(data='def'))
+        write_file.shut_down()
+        self.assertEquals(open(self.file_name_out, 'rb').read(), 'abcdef')
+
+    def test_write_file_write_behind(self):
+        write_file = df.WriteFile(dest_file_name=self.file_name_out,
+                                  buffer_size=100, write_behind=True,
+                                  write_behind_queue=2)
+        expected = []
+        for j in xrange(500):
+            data = '%4.4d,' % j
+            expected.append(data)
+            write_file.send(dfb.DataPacket(data=data))
+        write_file.shut_down()
+        self.assertEquals(open(self.file_name_out, 'rb').read(), 
+                          ''.join(expected))
+
+    def test_write_file_write_behind_bzip2(self):
+        write_file = df.WriteFile(dest_file_name=self.file_name_out,
+                                  compress='bzip', buffer_size=50,
+                                  write_behind=True)
+        test_data = ''.join('line %d\n' % j for j in xrange(200))
+        for line in fut.split_strings(test_data, 7):
+            write_file.send(dfb.DataPacket(data=line))
+        write_file.shut_down()
+        self.assertEqual(bz2.decompress(
+            open(self.file_name_out + '.bz2', 'rb').read()), test_data)
+        os.remove(self.file_name_out + '.bz2')
+
+    def test_write_file_write_behind_error(self):
+        write_file = df.WriteFile(dest_file_name=self.file_name_out,
+                                  buffer_size=0, write_behind=True)
+        write_file.send(dfb.DataPacket(data='abc'))
+        # Make the background write fail, and check we see the error
+        write_file._writer.func = mock.Mock(side_effect=IOError('disk full'))
+        write_file.send(dfb.DataPacket(data='def'))
+        self.assertRaises(IOError, write_file.close_output_file)
+        write_file.shut_down()
+
+    def test_write_file_change_name_flushes_buffer(self):
+        file_name_out2 = self.file_name_out + '2'
+        write_file = df.WriteFile(dest_file_name=self.file_name_out)
+        write_file.name = 'writer'
+        write_file.send(dfb.DataPacket(data='first'))
+        write_file.send(dfb.MessageBottle('writer', 'change_dest_file_name',
+                                          dest_file_name=file_name_out2))
+        write_file.send(dfb.DataPacket(data='second'))
+        write_file.shut_down()
+        self.assertEquals(open(self.file_name_out, 'rb').read(), 'first')
+        self.assertEquals(open(file_name_out2, 'rb').read(), 'second')
+        os.remove(file_name_out2)
+
+    def test_write_file_reset_name(self):
+        file_name_out2 = self.file_name_out + '2'
+        write_file = df.WriteFile(dest_file_name=self.file_name_out)
+        write_file.name = 'writer'
+        write_file.send(dfb.DataPacket(data='first'))
+        write_file.send(dfb.MessageBottle('writer', 'reset',
+                                          param_name='dest_file_name',
+                                          new_value=file_name_out2))
+        write_file.send(dfb.DataPacket(data='second'))
+        write_file.shut_down()
+        self.assertEquals(open(self.file_name_out, 'rb').read(), 'first')
+        self.assertEquals(open(file_name_out2, 'rb').read(), 'second')
+        os.remove(file_name_out2)
+
 
 
 if __name__ == '__main__':  #pragma: nocover
@@ -342,6 +342,291 @@ class TestMessageBottle(unittest.TestCase):
 #        bottle1 = dfb.MessageBottle('reset_seq_num:0')  <<<<<<<<<<<<<<
         bottle1 = dfb.MessageBottle(self.destination, 'reset_seq_num')
 
+
+
+class OpenBottle(dfb.DataFilter):
+    """Keep a note of the messages opened, for TestBottleRouting."""
+    ftype = 'open_bottle'
+
+    def init_filter(self):
+        self.opened = []
+
+    def open_message_bottle(self, packet):
+        self.opened.append(packet.message)
+
+
+def make_named(filter_class, name, **kwargs):
+    afilter = filter_class(**kwargs)
+    afilter.name = name
+    return afilter
+
+
+class TestBottleRouting(unittest.TestCase):
+    """Message bottles sent straight to the filters that open them must arrive
+    in the same order, at the same filters, as if passed along the route.
+    """
+
+    def setUp(self):
+        #   sender >>> pass1 >>> opener1 >>> hidden_branch >>> opener3
+        #                                     (opener2 >>> pass2)
+        self.sender = make_named(df.PassThrough, 'sender')
+        self.pass1 = make_named(df.PassThrough, 'pass1')
+        self.pass2 = make_named(df.PassThrough, 'pass2')
+        self.openers = [make_named(OpenBottle, 'opener%d' % j) 
+                        for j in (1, 2, 3)]
+        self.branch = dfb.HiddenBranchRoute()
+        self.sender.next_filter = self.pass1
+        self.pass1.next_filter = self.openers[0]
+        self.openers[0].next_filter = self.branch
+        self.branch.branch_filter = self.openers[1]
+        self.openers[1].next_filter = self.pass2
+        self.branch.next_filter = self.openers[2]
+        self.opened = []
+        for opener in self.openers:
+            opener.opened = self.opened
+
+    def _compare_with_flooding(self, destination, single_use=True):
+        for direct in (True, False):
+            del self.opened[:]
+            self.sender.direct_bottle_delivery = direct
+            self.sender.send_on(dfb.MessageBottle(destination, 'hello',
+                                                  single_use=single_use))
+            if direct:
+                direct_opened = self.opened[:]
+        self.assertEquals(direct_opened, self.opened)
+        return direct_opened
+
+    def test_by_name(self):
+        # Bottles skip the filters that don't open them
+        self.sender.send_on(dfb.MessageBottle('opener3', 'hello'))
+        self.assertFalse(self.pass1._primed)
+        self.assertFalse(self.pass2._primed)
+        self.assertEquals(self._compare_with_flooding('opener2'), ['hello'])
+
+    def test_by_ftype(self):
+        self.assertEquals(self._compare_with_flooding('open_bottle'), 
+                          ['hello'])
+        self.assertEquals(self._compare_with_flooding(
+            'open_bottle', single_use=False), ['hello'] * 3)
+        self.assertEquals(self._compare_with_flooding('nowhere'), [])
+
+    def test_route_changed(self):
+        self.sender.send_on(dfb.MessageBottle('opener3', 'first'))
+        self.pass1.next_filter = None
+        self.sender.send_on(dfb.MessageBottle('opener3', 'second'))
+        self.pass1.next_filter = self.branch
+        self.sender.send_on(dfb.MessageBottle('opener3', 'third'))
+        self.assertEquals(self.opened, ['first', 'third'])
+
+    def test_capturing_sink_on_route(self):
+        # The sink must see the bottle pass, so it can't be bypassed
+        sink = df.Sink(capture_msgs=True)
+        self.pass2.next_filter = sink
+        sink.next_filter = make_named(OpenBottle, 'opener4')
+        sink.next_filter.opened = self.opened
+        self.sender.send_on(dfb.MessageBottle('opener4', 'hello'))
+        self.assertEquals([pkt.message for pkt in sink.results], ['hello'])
+        self.assertEquals(self.opened, ['hello'])
+        self.assertTrue(self.pass1._primed)
+
+    def test_reset_in_pipeline(self):
+        config = '''
+        [--main--]
+        ftype = testing_bottle_routing
+        description = Reset a parameter in a filter at the end of the route
+        
+        [--route--]
+        reset:pass_through3:foo:3 >>>
+        pass_through1 >>>
+            (pass_through2)
+        pass_through3 >>>
+        sink
+        '''
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                 config=config)
+        pipeline.send(dfb.DataPacket('one'))
+        target = pipeline.getf('pass_through3')
+        self.assertEquals(target.foo, 3)
+        self.assertEquals(len(pipeline.getf('sink').results), 1)
+        self.assertEquals(pipeline._bottle_routes.values()[0][1], [target])
+        self.assertFalse(pipeline.getf('pass_through2')._primed)
+
+
+
+class CountUpdates(dfb.DataFilter):
+    """Filter with derived values, for TestResetParams."""
+    ftype = 'count_updates'
+    keys = ['width:2', 'height:3', 'label:none']
+    param_dependencies = dict(width=['_calc_area'], height=['_calc_area'])
+
+    def _calc_area(self):
+        self.area = self.width * self.height
+        self.area_updates += 1
+
+    def init_filter(self):
+        self.area_updates = 0
+        self._calc_area()
+
+
+class UpdateCounter(ppln.Pipeline):
+    """Pipeline passing its key on to a filter, for TestResetParams."""
+    config = '''
+    [--main--]
+    ftype = update_counter
+    description = Pass width on to the filter
+    keys = width:5
+
+    [--route--]
+    pass_through
+    '''
+
+    def update_filters(self):
+        self.getf('pass_through').width = self.width
+
+
+class TestResetParams(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = CountUpdates()
+
+    def test_reset_params(self):
+        self.assertEquals(self.counter.area, 6)
+        self.counter.reset_params(width=4, height=5, label='x')
+        self.assertEquals(self.counter.area, 20)
+        self.assertEquals(self.counter.label, 'x')
+        # Both keys changed, but the area is recalculated only once
+        self.assertEquals(self.counter.area_updates, 2)
+        self.counter.reset_params(label='y')
+        self.assertEquals(self.counter.area_updates, 2)
+
+    def test_reset_bottles(self):
+        self.counter.send(dfb.MessageBottle('count_updates', 'reset',
+                                            param_name='width', new_value=10))
+        self.assertEquals(self.counter.area, 30)
+        self.counter.send(dfb.MessageBottle('count_updates', 'reset_params',
+                                            params=dict(width=1, height=1)))
+        self.assertEquals(self.counter.area, 1)
+        self.assertEquals(self.counter.area_updates, 3)
+
+    def test_reset_pipeline(self):
+        pipeline = UpdateCounter(factory=ff.DemoFilterFactory())
+        self.assertEquals(pipeline.getf('pass_through').width, 5)
+        pipeline.reset_params(width=7)
+        self.assertEquals(pipeline.getf('pass_through').width, 7)
+
+
+
+class Record(dfb.DataFilter):
+    """Note each packet arriving, for TestPacketScheduler."""
+    ftype = 'record'
+
+    def close_filter(self):
+        self.log.append((self.name, 'closed'))
+
+    def filter_data(self, packet):
+        self.log.append((self.name, packet.data))
+        self.send_on(packet)
+
+
+class SplitChars(dfb.DataFilter):
+    """Send each character to the branch, then the whole data to main."""
+    ftype = 'split_chars'
+
+    def filter_data(self, packet):
+        for char in packet.data:
+            self.send_on(packet.clone(data=char), 'branch')
+        self.send_on(packet)
+
+
+class CountDown(dfb.DataFilter):
+    """Send the packet back to loop_to until its count reaches zero."""
+    ftype = 'count_down'
+
+    def filter_data(self, packet):
+        if packet.count:
+            packet.count -= 1
+            self.loop_to.send(packet)
+        else:
+            self.send_on(packet)
+
+
+class TestPacketScheduler(unittest.TestCase):
+
+    def _make_route(self):
+        #   splitter >>> hidden_branch >>> record_main
+        #                 (record_branch1 >>> record_branch2)
+        self.log = []
+        self.splitter = SplitChars()
+        branch = dfb.HiddenBranchRoute()
+        self.splitter.next_filter = branch
+        records = [make_named(Record, name) for name in 
+                   ('record_branch1', 'record_branch2', 'record_main')]
+        for record in records:
+            record.log = self.log
+        branch.branch_filter = records[0]
+        records[0].next_filter = records[1]
+        branch.next_filter = records[2]
+
+    def test_same_order_as_nested(self):
+        logs = []
+        for iterative in (False, True):
+            self._make_route()
+            self.splitter.iterative_scheduling = iterative
+            self.splitter.send(dfb.DataPacket('ab'), dfb.DataPacket('c'))
+            self.splitter.shut_down()
+            logs.append(self.log)
+        self.assertEquals(logs[0], logs[1])
+        self.assertEquals(logs[1][:3], [('record_branch1', 'a'),
+                                        ('record_branch2', 'a'),
+                                        ('record_branch1', 'b')])
+        self.assertEquals(logs[1][-3:], [('record_branch1', 'closed'),
+                                         ('record_branch2', 'closed'),
+                                         ('record_main', 'closed')])
+        self.assertEquals(dfb.PacketScheduler.running_count, 0)
+
+    def test_long_route(self):
+        # Far more filters than the recursion limit would allow
+        self.log = []
+        filters = [make_named(Record, 'record%d' % j) for j in xrange(3000)]
+        for afilter, next_filter in zip(filters, filters[1:]):
+            afilter.log = self.log
+            afilter.next_filter = next_filter
+        filters[-1].log = self.log
+        filters[0].iterative_scheduling = True
+        filters[0].send(dfb.DataPacket('x'))
+        filters[0].shut_down()
+        self.assertEquals(len(self.log), 6000)
+        self.assertEquals(self.log[2999], ('record2999', 'x'))
+        self.assertEquals(self.log[-1], ('record2999', 'closed'))
+
+    def _make_loop(self):
+        self.log = []
+        record = Record()
+        record.log = self.log
+        count_down = CountDown()
+        count_down.loop_to = record
+        record.next_filter = count_down
+        count_down.next_filter = df.Sink()
+        return record
+
+    def test_loop(self):
+        record = self._make_loop()
+        self.assertRaises(ValueError, record.send, 
+                          dfb.DataPacket('x', count=1))
+        record = self._make_loop()
+        record.iterative_scheduling = True
+        record.send(dfb.DataPacket('y', count=3))
+        self.assertEquals(self.log, [('record', 'y')] * 4)
+        self.assertEquals(record.next_filter.next_filter.results[-1].data, 
+                          'y')
+
+    def test_error(self):
+        self._make_route()
+        self.splitter.iterative_scheduling = True
+        self.assertRaises(TypeError, self.splitter.send, 
+                          dfb.DataPacket(None))
+        self.assertEquals(dfb.PacketScheduler.current(), None)
+
                 
 class TestPriorityQueue(unittest.TestCase):
     
@@ -404,6 +689,131 @@ class TestPriorityQueue(unittest.TestCase):
         # 't' will have been pushed fractionally before 's' so has sort prio.
         self.assertEquals([x[2] for x in self.priority_queue.sorted_items()],
                           ['t', 's', 'r'])
+
+
+
+class CountCalls(dfb.DataFilter):
+    """Split off a header of two characters, counting the calls of
+    filter_data(), for TestPacketCache.
+    """
+    ftype = 'count_calls'
+    side_effects = False
+    pure = True
+
+    def init_filter(self):
+        self.calls = 0
+
+    def filter_data(self, packet):
+        self.calls += 1
+        self.send_on(packet.clone(data=packet.data[:2], part='head'),
+                     'branch')
+        packet.data = packet.data[2:]
+        packet.part = 'body'
+        del packet.drop_me
+        self.send_on(packet)
+
+
+class TestPacketCache(unittest.TestCase):
+
+    def setUp(self):
+        self.hidden_branch_route = dfb.HiddenBranchRoute()
+        self.main_sink = df.Sink()
+        self.branch_sink = df.Sink()
+        self.hidden_branch_route.next_filter = self.main_sink
+        self.hidden_branch_route.branch_filter = self.branch_sink
+
+    def send_all(self, afilter, packets):
+        afilter.next_filter = self.hidden_branch_route
+        for data, seq_num in packets:
+            afilter.send(dfb.DataPacket(data, seq_num=seq_num, colour='red',
+                                        drop_me=True))
+        return ([(pkt.data, pkt.seq_num, pkt.part, hasattr(pkt, 'drop_me'))
+                 for pkt in self.branch_sink.results + self.main_sink.results])
+
+    def test_repeated_data(self):
+        counter = CountCalls(cache_size=2)
+        results = self.send_all(counter, [('hh12', 1), ('hh34', 2), 
+                                          ('hh12', 3), ('gg56', 4), 
+                                          ('hh12', 5), ('hh34', 6)])
+        self.assertEquals(results, [
+            ('hh', 1, 'head', True), ('hh', 2, 'head', True),
+            ('hh', 3, 'head', True), ('gg', 4, 'head', True),
+            ('hh', 5, 'head', True), ('hh', 6, 'head', True),
+            ('12', 1, 'body', False), ('34', 2, 'body', False),
+            ('12', 3, 'body', False), ('56', 4, 'body', False),
+            ('12', 5, 'body', False), ('34', 6, 'body', False)])
+        # 'hh34' was dropped from the cache by 'gg56'
+        self.assertEquals(counter.calls, 4)
+        stats = counter.packet_cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['entries']),
+                          (2, 4, 2))
+
+    def test_cache_attrs(self):
+        counter = CountCalls(cache_size=10, cache_attrs='seq_num')
+        results = self.send_all(counter, [('hh12', 1), ('hh12', 2), 
+                                          ('hh12', 1)])
+        self.assertEquals(counter.calls, 2)
+        self.assertEquals(results[-1], ('12', 1, 'body', False))
+
+    def test_removed_attribute_missing(self):
+        # A repeated input without an attribute removed from the first
+        counter = CountCalls(cache_size=10)
+        self.send_all(counter, [('hh12', 1)])
+        counter.send(dfb.DataPacket('hh12', seq_num=2))
+        self.assertEquals(counter.calls, 1)
+        self.assertEquals([(pkt.data, pkt.seq_num, pkt.part) 
+                           for pkt in self.main_sink.results],
+                          [('12', 1, 'body'), ('12', 2, 'body')])
+
+    def test_impure_refused(self):
+        self.assertRaises(dfb.FilterAttributeError, df.DistillHeader,
+                          header_size=2, cache_size=10)
+        self.assertRaises(dfb.FilterAttributeError, CountCalls, 
+                          cache_size=10, pure=False)
+
+    def test_stateful_refused(self):
+        # Batch keeps a partial batch from one packet to the next
+        self.assertRaises(dfb.FilterAttributeError, df.Batch,
+                          size=4, cache_size=10)
+        self.assertRaises(dfb.FilterAttributeError, df.Batch,
+                          size=4, cache_size=10, pure=True)
+        self.assertRaises(dfb.FilterAttributeError, df.CountPackets,
+                          cache_size=10, pure=True)
+
+    def test_in_pipeline(self):
+        config = '''
+        [--main--]
+        ftype = test_packet_cache
+        description = Cache the results of distill_header and reverse_string
+
+        [distill_header]
+        header_size = 2
+        pure = true
+        cache_size = 100
+        cache_bytes = 0x10000
+
+        [reverse_string]
+        cache_size = 100
+
+        [--route--]
+        distill_header >>>
+            (sink_head)
+        reverse_string >>>
+        sink
+        '''
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                                 config=config)
+        for data in ['ab123', 'cd456', 'ab123', 'ab123']:
+            pipeline.send(dfb.DataPacket(data))
+        pipeline.shut_down()
+        self.assertEquals(pipeline.getf('sink_head').all_data, 
+                          ['ab', 'cd', 'ab', 'ab'])
+        self.assertEquals(pipeline.getf('sink').all_data, 
+                          ['321', '654', '321', '321'])
+        for filter_name in ('distill_header', 'reverse_string'):
+            stats = pipeline.getf(filter_name).packet_cache.stats()
+            self.assertEquals((stats['hits'], stats['misses']), (2, 2))
+
     
 if __name__ == '__main__':
     unittest.main()
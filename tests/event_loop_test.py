@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import sys
+import unittest
+
+import filterpype.data_fltr_base as dfb
+import filterpype.event_loop as evl
+import filterpype.filter_factory as ff
+import filterpype.pipeline as ppln
+
+
+def make_pipeline(route):
+    config = '''
+    [--main--]
+    ftype = testing_event_loop
+    description = Pipeline run by an event loop
+
+    [--route--]
+    %s
+    ''' % route
+    return ppln.Pipeline(factory=ff.DemoFilterFactory(), config=config)
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = evl.EventLoop()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def _socket_pair(self):
+        pair = socket.socketpair()
+        self.sockets.extend(pair)
+        return pair
+
+    def test_socket_source(self):
+        pipeline = make_pipeline('batch:4 >>> sink')
+        sock1, sock2 = self._socket_pair()
+        sock1.sendall('hello world')
+        sock1.close()
+        source = self.loop.add_source(evl.StreamSource(sock2, pipeline))
+        self.assertTrue(self.loop.run(timeout=5))
+        self.assertTrue(source.finished)
+        self.assertEquals(source.bytes_read, 11)
+        # Remainder flushed by shutting down at the end of the stream
+        self.assertEquals(pipeline.getf('sink').all_data, 
+                          ['hell', 'o wo', 'rld'])
+        self.assertTrue(pipeline.shutting_down)
+
+    def test_process_source(self):
+        pipeline = make_pipeline('batch:1000 >>> sink')
+        source = self.loop.add_source(evl.ProcessSource(
+            [sys.executable, '-c', 'import sys; sys.stdout.write("abc" * 1000)'],
+            pipeline, read_size=100))
+        self.assertTrue(self.loop.run(timeout=5))
+        self.assertEquals(source.returncode, 0)
+        self.assertEquals(''.join(pipeline.getf('sink').all_data), 
+                          'abc' * 1000)
+
+    def test_many_refineries(self):
+        # Data arriving for one pipeline doesn't wait for the other
+        pipeline1 = make_pipeline('reverse_string >>> sink')
+        pipeline2 = make_pipeline('reverse_string >>> sink')
+        sock1, sock2 = self._socket_pair()
+        sock3, sock4 = self._socket_pair()
+        self.loop.add_source(evl.StreamSource(sock2, pipeline1))
+        self.loop.add_source(evl.StreamSource(sock4, pipeline2))
+        sock3.sendall('second')
+        self.assertFalse(self.loop.run(timeout=0.1))
+        self.assertEquals(pipeline2.getf('sink').all_data, ['dnoces'])
+        self.assertFalse(pipeline2.shutting_down)
+        sock1.sendall('first')
+        sock1.close()
+        sock3.close()
+        self.assertTrue(self.loop.run(timeout=5))
+        self.assertEquals(pipeline1.getf('sink').all_data, ['tsrif'])
+        self.assertTrue(pipeline1.shutting_down)
+        self.assertTrue(pipeline2.shutting_down)
+
+    def test_write_stream(self):
+        # Pipeline 1 writes more than fits in the socket buffer to a socket
+        # read by pipeline 2, in the same loop.
+        make_data = "''.join('%07d\\n' % j for j in xrange(0x20000))"
+        data = eval(make_data)
+        pipeline1 = make_pipeline('pass_through >>> write_stream')
+        pipeline2 = make_pipeline('batch:0x40000 >>> sink')
+        self.loop.add_source(evl.ProcessSource(
+            [sys.executable, '-c', 'import sys; sys.stdout.write(%s)' % 
+             make_data], pipeline1))
+        sock1, sock2 = self._socket_pair()
+        write_stream = pipeline1.getf('write_stream')
+        self.loop.add_output(write_stream, sock1)
+        self.loop.add_source(evl.StreamSource(sock2, pipeline2))
+        self.assertTrue(self.loop.run(timeout=5))
+        self.assertEquals(''.join(pipeline2.getf('sink').all_data), data)
+        self.assertEquals(write_stream.stream, None)
+
+    def test_back_pressure(self):
+        pipeline = make_pipeline('write_stream')
+        sock1, sock2 = self._socket_pair()
+        sock3, sock4 = self._socket_pair()
+        source = self.loop.add_source(evl.StreamSource(sock2, pipeline))
+        write_stream = pipeline.getf('write_stream')
+        write_stream.high_water = 10
+        self.loop.add_output(write_stream, sock3)
+        self.assertEquals(self.loop._readers(), [source])
+        write_stream.pending_bytes = 11
+        self.assertEquals(self.loop._readers(), [])
+
+    def test_write_stream_without_stream(self):
+        pipeline = make_pipeline('write_stream')
+        self.assertRaises(dfb.FilterAttributeError, pipeline.send,
+                          dfb.DataPacket('abc'))
+
+
+if __name__ == '__main__':  #pragma: nocover
+    unittest.main()
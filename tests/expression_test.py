@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import filterpype.data_fltr_base as dfb
+import filterpype.expression as expression
+
+
+class Limits(object):
+    limit = 5
+    _hidden = 1
+
+
+class TestCompileExpression(unittest.TestCase):
+
+    def setUp(self):
+        self.packet = dfb.DataPacket('abcdef', altitude=2000, speed=3,
+                                     values=[4, 5, 6])
+        self.limits = Limits()
+
+    def evaluate(self, text):
+        return expression.compile_expression(text)(self.packet, self.limits)
+
+    def test_packet_and_filter(self):
+        self.assertEquals(self.evaluate(
+            'p.altitude > 1000 and p.speed < f.limit'), True)
+        self.assertEquals(self.evaluate(
+            'p.altitude > 1000 and p.speed > f.limit'), False)
+
+    def test_operators(self):
+        self.assertEquals(self.evaluate('(p.altitude - 500) // 2 % 7'), 1)
+        self.assertEquals(self.evaluate('-p.speed ** 2'), -9)
+        self.assertEquals(self.evaluate('1 < p.speed <= 3'), True)
+        self.assertEquals(self.evaluate('p.speed in (1, 2) or not True'),
+                          False)
+        self.assertEquals(self.evaluate('"cd" in p.data'), True)
+        self.assertEquals(self.evaluate(
+            '"high" if p.altitude > 1000 else "low"'), 'high')
+
+    def test_indexing_and_functions(self):
+        self.assertEquals(self.evaluate('p.values[-1] + len(p.data[2:4])'), 8)
+        self.assertEquals(self.evaluate('max(p.values) - abs(-p.speed)'), 3)
+        self.assertEquals(self.evaluate('p.data is None'), False)
+
+    def test_missing_attribute(self):
+        self.assertRaises(AttributeError, self.evaluate, 'p.colour == 1')
+
+    def test_filter_keys(self):
+        text = 'p.speed < f.limit'
+        function = expression.compile_expression(text, ['limit'])
+        self.assertEquals(function(self.packet, self.limits), True)
+        self.assertRaises(dfb.FilterAttributeError, 
+                          expression.compile_expression, text, ['other'])
+        # Already compiled, but still checked
+        self.assertRaises(dfb.FilterAttributeError, 
+                          expression.compile_expression, text, [])
+
+    def test_compiled_once(self):
+        text = 'p.speed * 2'
+        self.assertTrue(expression.compile_expression(text) is
+                        expression.compile_expression(text))
+
+    def test_rejected(self):
+        for text in ['__import__("os")', 'open("x")', 'p.__class__',
+                     'f._hidden', 'p.data.upper()', '(1).real', 'x + 1',
+                     'lambda: 1', '[v for v in p.values]', 'p.speed = 1',
+                     'p.speed +', '']:
+            self.assertRaises(dfb.FilterAttributeError,
+                              expression.compile_expression, text)
+
+    def test_powers(self):
+        self.assertEquals(self.evaluate('p.speed ** -1 * 3'), 1.0)
+        self.assertEquals(self.evaluate('2 ** 100'), 2 ** 100)
+        # Any of these could take far too long to work out
+        for text in ['9 ** 9 ** 9', '9 ** 101', 'p.speed ** p.speed',
+                     '(9 ** 100) ** 100', '2 ** (1 + 1)']:
+            self.assertRaises(dfb.FilterAttributeError,
+                              expression.compile_expression, text)
+
+    def test_no_builtins(self):
+        # Only the listed functions are reachable, even via the namespace
+        function = expression.compile_expression('len(p.data)')
+        self.assertEquals(function.func_globals['__builtins__'], {})
+
+
+if __name__ == '__main__':  #pragma: nocover
+    unittest.main()
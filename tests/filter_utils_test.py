@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import threading
 import unittest
 import time
 import os
@@ -336,6 +337,48 @@ class TestFilterUtils(unittest.TestCase):
         self.assertEquals(fut.unindent([]), [])
         lines2 = ['a', 'b', 'c']
         self.assertEquals(fut.unindent(lines2), lines2)
+
+    def test_queue_worker(self):
+        results = []
+        worker = fut.QueueWorker(results.append, queue_size=3)
+        worker.start()
+        for j in xrange(100):
+            worker.put(j)
+        worker.finish()
+        self.assertEquals(results, range(100))
+        self.assertFalse(worker.is_alive())
+
+    def test_queue_worker_error(self):
+        def fail_on_three(item):
+            if item == 3:
+                raise ValueError, 'three'
+        worker = fut.QueueWorker(fail_on_three)
+        worker.start()
+        worker.put(3)
+        self.assertRaises(ValueError, worker.finish)
+        # The error is raised again, not cleared
+        self.assertRaises(ValueError, worker.finish)
+        self.assertRaises(ValueError, worker.put, 4)
+
+    def test_queue_worker_nothing_after_error(self):
+        written = []
+        release = threading.Event()
+        def write(item):
+            release.wait()
+            if item == 2:
+                raise IOError, 'disk full'
+            written.append(item)
+        worker = fut.QueueWorker(write)
+        worker.start()
+        for j in xrange(1, 5):
+            worker.put(j)
+        release.set()
+        while not worker.failed:
+            time.sleep(0.001)
+        self.assertRaises(IOError, worker.put, 5)
+        self.assertRaises(IOError, worker.put, 6)
+        self.assertRaises(IOError, worker.finish)
+        self.assertEquals(written, [1])
    
 
 class TestConversions(unittest.TestCase):
@@ -466,6 +509,36 @@ class TestConversions(unittest.TestCase):
         
 
         
+class TestLruCache(unittest.TestCase):
+
+    def test_max_entries(self):
+        cache = fut.LruCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.put('c', 3)  # 'b' is the least recently used
+        self.assertEquals((cache.get('b'), cache.get('c'), len(cache)), 
+                          (None, 3, 2))
+        self.assertEquals(cache.stats(), dict(hits=2, misses=1, 
+                                              hit_rate=2 / 3.0, evictions=1,
+                                              entries=2, total_bytes=0))
+
+    def test_max_bytes(self):
+        cache = fut.LruCache(10, max_bytes=100)
+        cache.put('a', 'x', 40)
+        cache.put('b', 'y', 40)
+        cache.put('a', 'z', 50)  # Replaced, so 'b' can stay
+        self.assertEquals((cache.get('a'), cache.get('b'), cache.total_bytes),
+                          ('z', 'y', 90))
+        cache.put('c', 'w', 30)
+        self.assertEquals((cache.get('a'), cache.total_bytes), (None, 70))
+        # Too large to keep at all
+        cache.put('d', 'v', 101)
+        self.assertEquals((cache.get('d'), len(cache)), (None, 2))
+        cache.clear()
+        self.assertEquals((len(cache), cache.total_bytes), (0, 0))
+
+
 def spike1():
     # Test the speed of byte reverTestMultiPartParameterJoiningsal
     # Result : Calculate takes 5* as long as dictionary lookup
@@ -179,6 +179,49 @@ B
                                         'hidden_branch_route_01 ^^^ B', 
                                         'hidden_branch_route_01 >>> C', 
                                         'B >>> None', 'C >>> None'])
+
+    def test_named_outputs(self):
+        route_in = '''\
+A >>> 
+route_by:colour >>> 
+    [red: B >>> C]
+    # Comments can go between outputs
+    [7: D >>> (E) F]
+G
+'''
+        route_out, connections, fltrs = self.route_parser.parse_route(route_in)
+        self.assertEquals(route_out, 'A route_by:colour [red: B C] ' + \
+                          '[7: D hidden_branch_route_01 (E) F] G')
+        self.assertEquals(connections, ['A >>> route_by:colour', 
+                                        'route_by:colour >>> G', 
+                                        'route_by:colour [7] D', 
+                                        'route_by:colour [red] B', 
+                                        'B >>> C', 
+                                        'C >>> None', 
+                                        'D >>> hidden_branch_route_01', 
+                                        'hidden_branch_route_01 ^^^ E', 
+                                        'hidden_branch_route_01 >>> F', 
+                                        'E >>> None', 
+                                        'F >>> None', 
+                                        'G >>> None'])
+        self.assertEquals(fltrs, ['A', 'route_by:colour', 'B', 'C', 'D', 
+                                  'hidden_branch_route_01', 'E', 'F', 'G'])
+
+    def test_named_outputs_need_main(self):
+        for route_in in ['A >>> [red: B]',  # No main output
+                         'A >>> [red: B] [blue C] D',  # Missing colon
+                         'A >>> [red: ] B']:  # Empty output
+            self.assertRaises(SyntaxError, self.route_parser.parse_route, 
+                              route_in)
+
+    def test_long_route(self):
+        # More than the 999 filters that four-digit labels allowed
+        names = ['F%d' % j for j in xrange(1500)]
+        route_in = ' >>> '.join(names) 
+        route_out, connections, fltrs = self.route_parser.parse_route(route_in)
+        self.assertEquals(fltrs, names)
+        self.assertEquals(connections[-2:], ['F1498 >>> F1499', 
+                                             'F1499 >>> None'])
     
 if __name__ == '__main__':  #pragma: nocover
     TestLexYacc('test_route16').run()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import unittest
+
+import filterpype.data_fltr_base as dfb
+import filterpype.filter_factory as ff
+import filterpype.filter_utils as fut
+import filterpype.parallel as parallel
+import filterpype.pipeline as ppln
+
+data_dir5 = os.path.join(fut.abs_dir_of_file(__file__), 
+                         'test_data', 'tst_data5')
+
+
+class TestEncodePacket(unittest.TestCase):
+
+    def test_data_packet(self):
+        packet = dfb.DataPacket('abc', seq_num=3, colour='red')
+        packet.sent_from = self
+        header, data = parallel.encode_packet(packet)
+        self.assertEquals(data, 'abc')
+        self.assertFalse('abc' in header)
+        packet2 = parallel.decode_packet(header, data)
+        self.assertEquals(packet2.__class__, dfb.DataPacket)
+        self.assertEquals((packet2.data, packet2.seq_num, packet2.colour,
+                           packet2.sent_from), ('abc', 3, 'red', None))
+
+    def test_other_data(self):
+        packet = dfb.DataPacket([1, 2, 3])
+        header, data = parallel.encode_packet(packet)
+        self.assertEquals(data, '')
+        self.assertEquals(parallel.decode_packet(header, data).data, 
+                          [1, 2, 3])
+
+    def test_bottle(self):
+        bottle = dfb.MessageBottle('wrap', 'reset', param_name='data_prefix',
+                                   new_value='[')
+        bottle2 = parallel.decode_packet(*parallel.encode_packet(bottle))
+        self.assertEquals(bottle2.__class__, dfb.MessageBottle)
+        self.assertEquals((bottle2.destination, bottle2.message, 
+                           bottle2.new_value), ('wrap', 'reset', '['))
+
+    def test_unpicklable(self):
+        packet = dfb.DataPacket('abc', callback=lambda x: x)
+        self.assertRaises(dfb.DataError, parallel.encode_packet, packet)
+
+
+def read_ring(ring, count, results):
+    for j in xrange(count):
+        results.put(ring.read_frame()[1].data)
+    
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_wrap_around(self):
+        ring = parallel.RingBuffer(10)
+        for j in xrange(5):
+            ring.write('abcdef%d' % j)
+            self.assertEquals(ring.read(7), 'abcdef%d' % j)
+        ring.close()
+
+    def test_between_processes(self):
+        # Frames much bigger than the buffer are handed over in order
+        ring = parallel.RingBuffer(64)
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=read_ring, 
+                                          args=(ring, 20, results))
+        process.start()
+        for j in xrange(20):
+            ring.write_frame(parallel.k_packet_frame, 
+                             dfb.DataPacket(str(j) * 100))
+        self.assertEquals([results.get(timeout=5) for j in xrange(20)],
+                          [str(j) * 100 for j in xrange(20)])
+        process.join()
+
+    def test_check(self):
+        ring = parallel.RingBuffer(16)
+        def check():
+            raise dfb.FilterProcessingException, 'Reader has gone'
+        self.assertRaises(dfb.FilterProcessingException, ring.write, 
+                          'x' * 20, check)
+
+
+class TestProcessBoundary(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = testing_process_boundary
+    description = Filters after the boundary run in a worker process
+
+    [wrap]
+    data_suffix = ;
+
+    [write_file]
+    dest_file_name = %s
+    
+    [calculate]
+    lhs_value = ${lhs_value}
+    rhs_value = 1
+    param_result = total
+
+    [--route--]
+    seq_packet >>>
+    process_boundary:256 >>>
+    calculate >>>
+    wrap >>>
+    batch:5 >>>
+    write_file
+    '''
+
+    def setUp(self):
+        self.file_name = os.path.join(data_dir5, 'process_boundary.out')
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def _pipeline(self, lhs_value=1):
+        config = self.config % self.file_name
+        return ppln.Pipeline(factory=ff.DemoFilterFactory(), 
+                             config=config.replace('${lhs_value}', 
+                                                   str(lhs_value)))
+
+    def test_process_boundary(self):
+        pipeline = self._pipeline()
+        for j in xrange(100):
+            pipeline.send(dfb.DataPacket('%03d' % j))
+        pipeline.first_filter.send(dfb.MessageBottle(
+            'wrap', 'reset', param_name='data_prefix', new_value='>'))
+        pipeline.send(dfb.DataPacket('end'))
+        pipeline.shut_down()
+        expected = ''.join('%03d;' % j for j in xrange(100)) + '>end;'
+        # The last batch was flushed by closing in the worker
+        self.assertEquals(open(self.file_name, 'rb').read(), expected)
+
+    def test_worker_exception(self):
+        pipeline = self._pipeline('abc')
+        pipeline.send(dfb.DataPacket('123'))
+        self.assertRaises(dfb.FilterProcessingException, pipeline.shut_down)
+
+    def test_worker_exception_on_next_send(self):
+        pipeline = self._pipeline('abc')
+        pipeline.send(dfb.DataPacket('123'))
+        # The worker stops once it has sent back its exception
+        pipeline.getf('process_boundary')._process.join(10)
+        self.assertRaises(dfb.FilterProcessingException, pipeline.send,
+                          dfb.DataPacket('456'))
+
+
+if __name__ == '__main__':  #pragma: nocover
+    unittest.main()
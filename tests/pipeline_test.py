@@ -244,6 +244,309 @@ class TestExtractManyAttributes(unittest.TestCase):
         self.assertEqual(sink.results[1].age, '500000')
         self.assertEqual(sink.results[2].gender, 'mail')
         self.assertEqual(sink.results[3].hair_col0ur, 'balding')
+
+
+class PipelineWithFilterData(ppln.Pipeline):
+    """Flattened pipeline that can't be flattened, for TestFlatten."""
+    config = '''
+    [--main--]
+    ftype = pipeline_with_filter_data
+    description = Overrides filter_data
+    flatten = true
+
+    [--route--]
+    pass_through
+    '''
+
+    def filter_data(self, packet):
+        self.first_filter.send(packet)
+
+
+class FlatExtractManyAttributes(ppln.Pipeline):
+    """ExtractManyAttributes, flattened, for TestFlatten."""
+    config = '''
+    [--main--]
+    ftype = extract_many_attributes
+    keys = attr_delim
+    flatten = true
+
+    [--route--]
+    split_lines >>>
+    attribute_extractor:${attr_delim}
+    '''
+
+
+class PipelineWithCloseFilter(ppln.Pipeline):
+    """Flattened pipeline that can't be flattened, for TestFlatten."""
+    config = '''
+    [--main--]
+    ftype = pipeline_with_close_filter
+    description = Overrides close_filter
+    flatten = true
+
+    [--route--]
+    pass_through
+    '''
+
+    def close_filter(self):
+        self.closed_itself = True
+
+
+class FlattenTestFactory(ff.DemoFilterFactory):
+
+    def __init__(self):
+        ff.DemoFilterFactory.__init__(self)
+        self._apply_class_map(dict(
+            extract_many_attributes=FlatExtractManyAttributes))
+
+
+class TestFlatten(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = testing_flatten
+    description = Nested pipeline flattened into this one
+    
+    [--route--]
+    pass_through >>>
+    extract_many_attributes:equals >>>
+    sink
+    '''
+
+    def setUp(self):
+        self.factory = FlattenTestFactory()
+        self.pipeline = ppln.Pipeline(factory=self.factory, 
+                                      config=self.config)
+
+    def test_connected_past_pipeline(self):
+        nested = self.pipeline.getf('extract_many_attributes')
+        splitter = self.pipeline.getf('extract_many_attributes.split_lines')
+        extractor = nested.getf('attribute_extractor')
+        self.assertEquals(self.pipeline.getf('pass_through').next_filter,
+                          splitter)
+        self.assertEquals(extractor.next_filter, self.pipeline.getf('sink'))
+        self.assertEquals(extractor.pipeline, nested)
+
+    def test_flattened_data(self):
+        self.pipeline.send(dfb.DataPacket('name=Pat\nage=40'))
+        sink = self.pipeline.getf('sink')
+        self.assertEquals(sink.results[0].name, 'Pat')
+        self.assertEquals(sink.results[1].age, '40')
+        # Packets never went through the nested pipeline itself
+        self.assertFalse(self.pipeline.getf('extract_many_attributes')._primed)
+
+    def test_first_filter(self):
+        config = self.config.replace('pass_through >>>', '')
+        pipeline = ppln.Pipeline(factory=self.factory, config=config)
+        self.assertEquals(pipeline.first_filter, 
+                          pipeline.getf('extract_many_attributes.split_lines'))
+
+    def test_getf_dotted(self):
+        self.assertRaises(KeyError, self.pipeline.getf, 
+                          'extract_many_attributes.not_there')
+        self.assertRaises(KeyError, self.pipeline.getf, 'not_there')
+
+    def test_cant_flatten(self):
+        for pipeline_class in (PipelineWithFilterData,
+                               PipelineWithCloseFilter):
+            nested = pipeline_class(factory=self.factory)
+            self.assertRaises(dfb.PipelineConfigError,
+                              self.pipeline._entry_filter, nested)
+
+    def test_not_flattened_by_default(self):
+        pipeline = ppln.Pipeline(factory=ff.DemoFilterFactory(),
+                                 config=self.config)
+        self.assertEquals(pipeline.getf('pass_through').next_filter,
+                          pipeline.getf('extract_many_attributes'))
+
+
+class TestOptimiseRoute(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = testing_optimise_route
+    description = Route with filters that make no difference to the output
+    optimise = true
+    %s
+    [--route--]
+    pass_through1 >>>
+    branch_clone1 >>>
+        (reverse_string >>> waste)
+    seq_packet >>>
+    branch_clone2 >>>
+        (sink1)
+    pass_through2 >>>
+    sink2
+    '''
+
+    def setUp(self):
+        self.factory = ff.DemoFilterFactory()
+
+    def _send(self, pipeline):
+        pipeline.send(dfb.DataPacket('abc'), dfb.DataPacket('de'))
+        return [[pkt.data for pkt in pipeline.getf(sink_name).results]
+                for sink_name in ('sink1', 'sink2')]
+
+    def test_optimised(self):
+        pipeline = ppln.Pipeline(factory=self.factory, 
+                                 config=self.config % '')
+        self.assertEquals(pipeline.first_filter, pipeline.getf('seq_packet'))
+        second_branch = pipeline.getf('branch_clone2').next_filter
+        self.assertEquals(second_branch.branch_filter, pipeline.getf('sink1'))
+        self.assertEquals(second_branch.next_filter, pipeline.getf('sink2'))
+        # Same output as without optimising
+        config = self.config.replace('optimise = true', '')
+        self.assertEquals(self._send(pipeline), 
+                          self._send(ppln.Pipeline(factory=self.factory,
+                                                   config=config % '')))
+        self.assertFalse(pipeline.getf('reverse_string')._primed)
+        # Nothing more to take out
+        self.assertEquals(pipeline.optimise_route(), 0)
+
+    def test_side_effects_key(self):
+        keep = '''
+    [pass_through2]
+    side_effects = true
+    '''
+        pipeline = ppln.Pipeline(factory=self.factory, 
+                                 config=self.config % keep)
+        second_branch = pipeline.getf('branch_clone2').next_filter
+        self.assertEquals(second_branch.next_filter, 
+                          pipeline.getf('pass_through2'))
+
+    def test_count(self):
+        config = self.config.replace('optimise = true', '')
+        pipeline = ppln.Pipeline(factory=self.factory, config=config % '')
+        # pass_through1, branch_clone1, its hidden branch route, pass_through2
+        self.assertEquals(pipeline.optimise_route(), 4)
+
+
+class TestFuseFilters(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = testing_fuse_filters
+    description = Linear runs of filters with transform() methods
+    fuse = true
+
+    [tag_packet]
+    tag_field_name = colour
+    tag_field_value = red
+
+    [wrap]
+    data_prefix = <<
+    data_suffix = >>
+
+    [header_as_attribute]
+    header_size = 5
+
+    [get_bytes]
+    start_byte = 0
+    bytes_to_get = 3
+    param_name = first3
+
+    [calculate]
+    lhs_value = 2
+    rhs_value = 3
+    param_result = total
+
+    [--route--]
+    tag_packet >>>
+    count_loops >>>
+    seq_packet >>>
+    branch_clone >>>
+        (reverse_string >>> sink1)
+    wrap >>>
+    header_as_attribute >>>
+    get_bytes >>>
+    calculate >>>
+    sink2
+    '''
+
+    attr_names = ['colour', 'loop_num', 'seq_num', 'header_data', 'first3',
+                  'total']
+
+    def setUp(self):
+        self.factory = ff.DemoFilterFactory()
+
+    def _results(self, pipeline):
+        pipeline.send(dfb.DataPacket('abcdef'), dfb.DataPacket('y'))
+        # A bottle sent to the pipeline would go straight past its filters
+        pipeline.first_filter.send(dfb.MessageBottle(
+            'wrap', 'reset', param_name='data_prefix', new_value='[['))
+        pipeline.send(dfb.DataPacket('ghijkl'))
+        pipeline.shut_down()
+        results = []
+        for sink_name in ('sink1', 'sink2'):
+            for pkt in pipeline.getf(sink_name).results:
+                results.append([pkt.data] + [getattr(pkt, attr_name, None) 
+                                             for attr_name in self.attr_names])
+        return results
+
+    def test_fused_stages(self):
+        pipeline = ppln.Pipeline(factory=self.factory, config=self.config)
+        first_stage = pipeline.first_filter
+        self.assertTrue(isinstance(first_stage, dfb.FusedFilters))
+        self.assertEquals(first_stage.name, 
+                          'tag_packet+count_loops+seq_packet')
+        self.assertEquals(first_stage.next_filter, 
+                          pipeline.getf('branch_clone'))
+        second_stage = pipeline.getf('branch_clone').next_filter.next_filter
+        self.assertEquals(second_stage.fused_filters, 
+                          [pipeline.getf(name) for name in (
+                              'wrap', 'header_as_attribute', 'get_bytes',
+                              'calculate')])
+        self.assertEquals(second_stage.next_filter, pipeline.getf('sink2'))
+        # reverse_string is alone before sink1, so isn't fused
+        branch = pipeline.getf('branch_clone').next_filter.branch_filter
+        self.assertEquals(branch, pipeline.getf('reverse_string'))
+        self.assertEquals(pipeline.fuse_filters(), 0)
+
+    def test_same_results(self):
+        pipeline = ppln.Pipeline(factory=self.factory, config=self.config)
+        results = self._results(pipeline)
+        unfused = ppln.Pipeline(factory=self.factory, 
+                                config=self.config.replace('fuse = true', ''))
+        self.assertFalse(isinstance(unfused.first_filter, dfb.FusedFilters))
+        self.assertEquals(results, self._results(unfused))
+        self.assertEquals(results[-2:], [
+            ['def>>', 'red', 1, 0, '<<abc', 'def', 5],
+            ['jkl>>', 'red', 1, 2, '[[ghi', 'jkl', 5]])
+        self.assertFalse(pipeline.getf('wrap')._primed)
+
+    def test_count(self):
+        config = self.config.replace('fuse = true', '')
+        pipeline = ppln.Pipeline(factory=self.factory, config=config)
+        self.assertEquals(pipeline.fuse_filters(), 7)
+
+    def test_make_fused_transform(self):
+        class AddOne(dfb.DataFilter):
+            ftype = 'add_one'
+            def transform(self, packet):
+                packet.data += 1
+                return packet
+        class DropOdd(dfb.DataFilter):
+            ftype = 'drop_odd'
+            def transform(self, packet):
+                if packet.data % 2:
+                    return None
+                return packet
+        transform = dfb.make_fused_transform([AddOne(), DropOdd(), AddOne()])
+        self.assertEquals(transform(dfb.DataPacket(1)).data, 3)
+        self.assertEquals(transform(dfb.DataPacket(2)), None)
+
+    def test_error_names_fused_filter(self):
+        config = self.config.replace('lhs_value = 2', 'lhs_value = abc')
+        pipeline = ppln.Pipeline(factory=self.factory, config=config)
+        fused = pipeline.getf('branch_clone').next_filter.next_filter
+        self.assertTrue(pipeline.getf('calculate') in fused.fused_filters)
+        try:
+            pipeline.send(dfb.DataPacket('abcdef'))
+        except Exception, err:
+            self.assertTrue(str(err).startswith(
+                "Exception in 'calculate' (calculate): "), str(err))
+        else:  #pragma: nocover
+            self.fail('No exception from calculate')
     
 class TestEssentialKeys(unittest.TestCase):
 
@@ -297,6 +600,97 @@ class TestEssentialKeys(unittest.TestCase):
         self.assertRaises(dfb.FilterRoutingError, ppln.Pipeline,
                           factory=self.factory, config=config2)
 
+
+
+class TestIterData(unittest.TestCase):
+
+    config = '''
+    [--main--]
+    ftype = testing_iter_data
+    description = Pull packets through the pipeline as they are wanted
+
+    [read_batch]
+    batch_size = 4
+    source_file_name = %s
+
+    [--route--]
+    read_batch >>>
+    reverse_string >>>
+    batch:6
+    '''
+
+    class CountingFile(StringIO.StringIO):
+        name = 'counting_file'
+        file_size = 400
+        reads = 0
+        def read(self, size=-1):
+            self.reads += 1
+            return StringIO.StringIO.read(self, size)
+
+    def setUp(self):
+        self.factory = ff.DemoFilterFactory()
+        self.file_name = os.path.join(data_dir5, 'iter_data.dat')
+        f1 = open(self.file_name, 'wb')
+        try:
+            f1.write('abcdefghij')
+        finally:
+            f1.close()
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def _pipeline(self):
+        return ppln.Pipeline(factory=self.factory, 
+                             config=self.config % self.file_name)
+
+    def test_iter_data(self):
+        # The remainder in batch is flushed when the file has been read
+        pipeline = self._pipeline()
+        self.assertEquals([pkt.data for pkt in pipeline], ['dcbahg', 'feji'])
+        self.assertTrue(pipeline.shutting_down)
+
+    def test_iter_data_file_obj(self):
+        pipeline = self._pipeline()
+        packets = pipeline.iter_data(dfb.DataPacket(open(self.file_name)))
+        self.assertEquals(packets.next().data, 'dcbahg')
+        self.assertEquals(pipeline.getf('read_batch').file1.closed, False)
+        self.assertEquals(packets.next().data, 'feji')
+        self.assertTrue(pipeline.getf('read_batch').file1.closed)
+        self.assertRaises(StopIteration, packets.next)
+
+    def test_stop_early(self):
+        pipeline = ppln.Pipeline(factory=self.factory, 
+                                 config=self.config.replace('batch:6', 
+                                                            'batch:4'))
+        file1 = self.CountingFile('abcd' * 100)
+        packets = pipeline.iter_data(dfb.DataPacket(file1))
+        self.assertEquals(packets.next().data, 'dcba')
+        self.assertEquals(packets.next().data, 'dcba')
+        packets.close()
+        self.assertEquals(file1.reads, 2)
+        self.assertTrue(file1.closed)
+        self.assertTrue(pipeline.shutting_down)
+        self.assertTrue(pipeline.getf('batch').closing)
+        
+    def test_without_source(self):
+        config = self.config.replace('read_batch >>>', '')
+        pipeline = ppln.Pipeline(factory=self.factory, 
+                                 config=config % self.file_name)
+        packets = pipeline.iter_data(dfb.DataPacket('abcdefg'), 
+                                     dfb.DataPacket('hij'))
+        self.assertEquals([pkt.data for pkt in packets], 
+                          ['gfedcb', 'ajih'])
+
+    def test_next_filter_restored(self):
+        pipeline = self._pipeline()
+        sink = df.Sink()
+        pipeline.last_filter.next_filter = sink
+        packets = pipeline.iter_data()
+        self.assertEquals(packets.next().data, 'dcbahg')
+        packets.close()
+        self.assertEquals(pipeline.last_filter.next_filter, sink)
+        self.assertEquals(sink.results, [])
+
         
 class TestCopyFile(unittest.TestCase):
     # Read binary file in and write it out. Source is either the file name or
@@ -381,6 +775,19 @@ class TestCopyFileCompression(unittest.TestCase):
         self.assertEquals(len(new_file_data), os.path.getsize(self.file_name))
         self.assertEquals(new_file_data, self.file_contents)
         print "**1835** sizes are equal"
+
+    def test_copy_file_progress_callback(self):
+        callback = mock.Mock()
+        copy_file_comp_ppln = ppln.CopyFileCompression(
+            factory=self.factory, dest_file_name=self.file_name,
+            callback=callback, environ=dict(job='copy'))
+        copy_file_comp_ppln.send(dfb.DataPacket(self.file_name))
+        copy_file_comp_ppln.shut_down()
+        # The same callback as from callback_on_attribute before
+        args, kwargs = callback.call_args
+        self.assertEquals(args, ('found:read_percent',))
+        self.assertEquals(kwargs, dict(read_percent=100, job='copy'))
+        os.remove(self.file_name_out)
     
     def test_pipeline_for_memory_leaks(self):
         self.assertEquals(self.function_for_tst_pipeline_for_memory_leaks(), 3)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import unittest
+
+import filterpype.codec as codec
+import filterpype.data_fltr_base as dfb
+import filterpype.filter_factory as ff
+import filterpype.filter_utils as fut
+import filterpype.pipeline as ppln
+import filterpype.range_split as range_split
+
+k_frame_size = 64
+
+config = '''
+[--main--]
+ftype = reverse_frames
+description = Reverse each frame of a file
+
+[read_batch]
+batch_size = %d
+
+[write_file]
+dest_file_name = %s
+
+[sink]
+max_results = 0
+
+[--route--]
+read_batch >>>
+count_bytes >>>
+reverse_string >>>
+write_file >>>
+sink
+'''
+
+nested_config = '''
+[--main--]
+ftype = reverse_frames_nested
+description = Reverse each frame of a file, counting in a nested pipeline
+
+[read_batch]
+batch_size = %d
+
+[--route--]
+read_batch >>>
+count_bytes >>>
+reverse_string >>>
+count_and_sink
+'''
+
+
+class CountAndSink(ppln.Pipeline):
+    config = '''
+    [--main--]
+    ftype = count_and_sink
+    description = Count the bytes and keep all the results
+
+    [sink]
+    max_results = 0
+
+    [--route--]
+    count_bytes >>>
+    sink
+    '''
+
+
+class NestedFactory(ff.DemoFilterFactory):
+
+    def __init__(self):
+        ff.DemoFilterFactory.__init__(self)
+        self._apply_class_map(dict(count_and_sink=CountAndSink))
+
+
+def make_frames(count):
+    return ''.join('SYNC%060d' % j for j in xrange(count))
+
+def reverse_frames(data):
+    return ''.join(data[j:j + k_frame_size][::-1]
+                   for j in xrange(0, len(data), k_frame_size))
+
+
+class TestSyncFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.file_name = fut.random_file_name()
+        source = open(self.file_name, 'wb')
+        source.write('head' + make_frames(10))
+        source.close()
+        self.file_obj = open(self.file_name, 'rb')
+
+    def tearDown(self):
+        self.file_obj.close()
+        os.remove(self.file_name)
+
+    def test_frame_size(self):
+        sync = range_split.align_to_frame_size(k_frame_size, header_size=4)
+        self.assertEquals([sync(self.file_obj, offset) 
+                           for offset in (0, 4, 5, 68, 69)],
+                          [4, 4, 68, 68, 132])
+
+    def test_sync_word(self):
+        sync = range_split.align_to_sync_word('SYNC')
+        self.assertEquals([sync(self.file_obj, offset) 
+                           for offset in (0, 4, 5, 600, 644)],
+                          [4, 4, 68, 644, 644])
+
+    def test_sync_word_across_reads(self):
+        sync = range_split.align_to_sync_word('SYNC')
+        original = range_split.k_sync_read_size
+        range_split.k_sync_read_size = 3
+        try:
+            self.assertEquals(sync(self.file_obj, 5), 68)
+        finally:
+            range_split.k_sync_read_size = original
+
+    def test_split_ranges(self):
+        sync = range_split.align_to_sync_word('SYNC')
+        ranges = range_split.split_ranges(self.file_name, 3, sync)
+        self.assertEquals(ranges, [(0, 260), (260, 452), (452, 644)])
+        self.assertEquals(range_split.split_ranges(self.file_name, 30, sync),
+                          [(0, 68)] + [(j, j + 64) for j in xrange(68, 644, 64)])
+
+
+class TestRangeFile(unittest.TestCase):
+
+    def test_read(self):
+        file_name = fut.random_file_name()
+        source = open(file_name, 'wb')
+        source.write('0123456789')
+        source.close()
+        try:
+            range_file = range_split.RangeFile(file_name, 2, 7)
+            self.assertEquals(range_file.file_size, 5)
+            self.assertEquals(range_file.read(3), '234')
+            self.assertEquals(range_file.tell(), 3)
+            self.assertEquals(range_file.read(), '56')
+            self.assertEquals(range_file.read(), '')
+            range_file.seek(1)
+            self.assertEquals(range_file.read(1), '3')
+            range_file.close()
+            self.assertTrue(range_file.closed)
+        finally:
+            os.remove(file_name)
+
+
+class TestRangeSplitter(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_frames(500)
+        self.file_name = fut.random_file_name()
+        self.dest_name = fut.random_file_name()
+        source = open(self.file_name, 'wb')
+        source.write(self.data)
+        source.close()
+
+    def tearDown(self):
+        for file_name in (self.file_name, self.dest_name):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def check_run(self, workers):
+        splitter = range_split.RangeSplitter(
+            config % (k_frame_size, self.dest_name), ff.DemoFilterFactory(),
+            self.file_name, sync=range_split.align_to_sync_word('SYNC'), 
+            num_ranges=4, workers=workers)
+        ranges = splitter.run()
+        self.assertEquals(len(ranges), 4)
+        expected = reverse_frames(self.data)
+        dest = open(self.dest_name, 'rb')
+        try:
+            self.assertEquals(dest.read(), expected)
+        finally:
+            dest.close()
+        count_bytes = splitter.pipeline.getf('count_bytes')
+        self.assertEquals((count_bytes.counted_bytes, 
+                           count_bytes.counted_packets), (len(self.data), 500))
+        results = splitter.sink_results['sink']
+        self.assertEquals(len(results), 500)
+        self.assertEquals(''.join(packet.data for packet in results), 
+                          expected)
+        self.assertEquals(glob.glob(self.dest_name + '.part*'), [])
+
+    def test_in_process(self):
+        self.check_run(0)
+
+    def test_worker_processes(self):
+        self.check_run(2)
+
+    def test_compress_auto(self):
+        # The parts are compressed, as the file name's extension is kept
+        dest_name = self.dest_name + '.bz2'
+        splitter = range_split.RangeSplitter(
+            config.replace('[sink]', 'compress = auto\n\n[sink]') % (
+                k_frame_size, dest_name), 
+            ff.DemoFilterFactory(), self.file_name, 
+            sync=range_split.align_to_sync_word('SYNC'), num_ranges=3, 
+            workers=0)
+        try:
+            splitter.run()
+            dest = open(dest_name, 'rb')
+            try:
+                compressed = dest.read()
+            finally:
+                dest.close()
+        finally:
+            os.remove(dest_name)
+        self.assertEquals(codec.detect_compression(compressed), 'bzip2')
+        decompressor = codec.get_codec('bzip2').decompressor()
+        self.assertEquals(decompressor.decompress(compressed), 
+                          reverse_frames(self.data))
+
+    def test_nested_pipeline(self):
+        # Filters inside the nested pipeline are found by their path names
+        splitter = range_split.RangeSplitter(
+            nested_config % k_frame_size, NestedFactory(), self.file_name,
+            sync=range_split.align_to_sync_word('SYNC'), num_ranges=3, 
+            workers=0)
+        splitter.run()
+        for path in ('count_bytes', 'count_and_sink.count_bytes'):
+            self.assertEquals(
+                splitter.pipeline.getf(path).counted_bytes, len(self.data))
+        self.assertEquals(splitter.sink_results.keys(), 
+                          ['count_and_sink.sink'])
+        results = splitter.sink_results['count_and_sink.sink']
+        self.assertEquals(''.join(packet.data for packet in results),
+                          reverse_frames(self.data))
+
+    def test_max_results(self):
+        splitter = range_split.RangeSplitter(
+            config.replace('max_results = 0', 'max_results = 10') % (
+                k_frame_size, self.dest_name), 
+            ff.DemoFilterFactory(), self.file_name, 
+            sync=range_split.align_to_sync_word('SYNC'), num_ranges=4, 
+            workers=0)
+        splitter.run()
+        results = splitter.sink_results['sink']
+        self.assertEquals(''.join(packet.data for packet in results),
+                          reverse_frames(self.data)[-10 * k_frame_size:])
+
+
+if __name__ == '__main__':  #pragma: nocover
+    unittest.main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import filterpype.filter_factory as ff
+import filterpype.filter_utils as fut
+import filterpype.result_cache as result_cache
+
+config = '''
+[--main--]
+ftype = reverse_batches
+description = Reverse each batch of a file
+keys = dest_file_name, callback, batch_size:8
+
+[read_batch]
+batch_size = ${batch_size}
+
+[callback_on_attribute]
+watch_attr = read_percent
+callback = ${callback}
+
+[write_file]
+dest_file_name = ${dest_file_name}
+
+[sink]
+max_results = 0
+
+[--route--]
+read_batch >>>
+callback_on_attribute >>>
+reverse_string >>>
+write_file >>>
+sink
+'''
+
+append_config = config.replace(
+    'keys = dest_file_name, callback, batch_size:8',
+    'keys = dest_file_name, callback, batch_size:8, write:true').replace(
+    'dest_file_name = ${dest_file_name}',
+    'dest_file_name = ${dest_file_name}\n'
+    'append = true\n'
+    'do_write_file = ${write}')
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.file_name = fut.random_file_name()
+        self.dest_name = fut.random_file_name()
+        self.write_source('abcdefgh12345678')
+        self.calls = []
+        self.factory = ff.DemoFilterFactory()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        for file_name in (self.file_name, self.dest_name):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def write_source(self, data):
+        source = open(self.file_name, 'wb')
+        source.write(data)
+        source.close()
+
+    def callback(self, message, **kwargs):
+        self.calls.append((message, kwargs))
+
+    def run_cached(self, cache, **key_values):
+        del self.calls[:]
+        if os.path.exists(self.dest_name):
+            os.remove(self.dest_name)
+        pipeline = cache.run(config, self.factory, self.file_name,
+                             dest_file_name=self.dest_name,
+                             callback=self.callback, **key_values)
+        dest = open(self.dest_name, 'rb')
+        try:
+            dest_data = dest.read()
+        finally:
+            dest.close()
+        return (dest_data, pipeline.getf('sink').all_data, self.calls[:])
+
+    def run_appending(self, cache, old_data, **key_values):
+        """Run append_config with old_data already in the destination, and
+        return what the destination then holds.
+        """
+        dest = open(self.dest_name, 'wb')
+        try:
+            dest.write(old_data)
+        finally:
+            dest.close()
+        cache.run(append_config, self.factory, self.file_name,
+                  dest_file_name=self.dest_name, callback=self.callback,
+                  **key_values)
+        dest = open(self.dest_name, 'rb')
+        try:
+            return dest.read()
+        finally:
+            dest.close()
+
+    def test_hit_replays_outputs(self):
+        cache = result_cache.ResultCache(self.cache_dir)
+        first = self.run_cached(cache)
+        self.assertEquals(first, ('hgfedcba87654321',
+                                  ['hgfedcba', '87654321'],
+                                  [('found:read_percent',
+                                    {'pipeline': 'reverse_batches',
+                                     'read_percent': 50})]))
+        self.assertEquals((cache.hits, cache.misses), (0, 1))
+        self.assertEquals(self.run_cached(cache), first)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        stats = cache.stats()
+        self.assertEquals((stats['entries'], stats['hit_rate']), (1, 0.5))
+        self.assertTrue(stats['total_size'] > 16)
+
+    def test_changes_miss(self):
+        cache = result_cache.ResultCache(self.cache_dir)
+        self.run_cached(cache)
+        self.assertEquals(self.run_cached(cache, batch_size=4)[1],
+                          ['dcba', 'hgfe', '4321', '8765'])
+        self.write_source('ABCDEFGH')
+        self.assertEquals(self.run_cached(cache)[0], 'HGFEDCBA')
+        self.assertEquals((cache.hits, cache.misses), (0, 3))
+        # Only the contents are checked, not the mtime
+        self.write_source('abcdefgh12345678')
+        self.assertEquals(self.run_cached(cache, batch_size=4)[0],
+                          'dcbahgfe43218765')
+        self.assertEquals((cache.hits, cache.misses), (1, 3))
+
+    def test_size_and_mtime(self):
+        cache = result_cache.ResultCache(self.cache_dir,
+                                         check_contents=False)
+        self.run_cached(cache)
+        self.run_cached(cache)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        os.utime(self.file_name, (0, 0))
+        self.run_cached(cache)
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+
+    def test_append(self):
+        cache = result_cache.ResultCache(self.cache_dir)
+        self.assertEquals(self.run_appending(cache, 'XYZ'),
+                          'XYZhgfedcba87654321')
+        # Only what was appended is recorded, and appended again
+        self.assertEquals(self.run_appending(cache, 'abc'),
+                          'abchgfedcba87654321')
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def test_unchanged_file_not_recorded(self):
+        cache = result_cache.ResultCache(self.cache_dir)
+        self.assertEquals(self.run_appending(cache, 'XYZ', write=False),
+                          'XYZ')
+        self.assertEquals(self.run_appending(cache, 'abc', write=False),
+                          'abc')
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def test_eviction(self):
+        cache = result_cache.ResultCache(self.cache_dir)
+        self.run_cached(cache)
+        # Entries for sources of the same length are the same size
+        cache.max_size = cache.stats()['total_size'] * 2
+        self.write_source('abcdefgh12345679')
+        self.run_cached(cache)
+        self.write_source('abcdefgh12345678')
+        self.run_cached(cache)  # Now the most recently used
+        self.write_source('abcdefgh1234567a')
+        self.run_cached(cache)
+        self.assertEquals((cache.evictions, cache.stats()['entries']), (1, 2))
+        self.assertEquals((cache.hits, cache.misses), (1, 3))
+        self.write_source('abcdefgh12345678')
+        self.run_cached(cache)
+        self.write_source('abcdefgh12345679')
+        self.run_cached(cache)
+        self.assertEquals((cache.hits, cache.misses), (2, 4))
+        cache.clear()
+        self.assertEquals(cache.stats()['entries'], 0)
+
+if __name__ == '__main__':  #pragma: nocover
+    unittest.main()
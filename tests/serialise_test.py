@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import StringIO
+import unittest
+
+import filterpype.data_fltr_base as dfb
+import filterpype.serialise as serialise
+
+
+class TestEncodePacket(unittest.TestCase):
+
+    def round_trip(self, packet, **kwargs):
+        return serialise.decode_packet(serialise.encode_packet(packet,
+                                                               **kwargs))
+
+    def test_data_packet(self):
+        packet = dfb.DataPacket('abc\x00\xff', seq_num=3, colour='red')
+        packet.sent_from = self
+        packet.fork_dest = 'branch'
+        record = serialise.encode_packet(packet)
+        self.assertTrue(record.startswith('FP\x01D'))
+        self.assertTrue(record.endswith('abc\x00\xff'))
+        packet2 = serialise.decode_packet(record)
+        self.assertEquals(packet2.__class__, dfb.DataPacket)
+        self.assertEquals((packet2.data, packet2.seq_num, packet2.colour,
+                           packet2.message, packet2.sent_from, 
+                           packet2.fork_dest), 
+                          ('abc\x00\xff', 3, 'red', None, None, None))
+
+    def test_value_types(self):
+        values = dict(none=None, yes=True, no=False, small=-7, 
+                      big=2 ** 70, neg_big=-2 ** 64, ratio=0.25, 
+                      text=u'caf\xe9', raw='\x00\x01', 
+                      items=[1, 'two', (3.0, None)], 
+                      table={'a':1, 2:[False]})
+        packet2 = self.round_trip(dfb.DataPacket('', **values))
+        for name, value in values.iteritems():
+            self.assertEquals(getattr(packet2, name), value)
+            self.assertEquals(type(getattr(packet2, name)), type(value))
+
+    def test_other_data(self):
+        packet = dfb.DataPacket([1, 2, 3])
+        self.assertEquals(self.round_trip(packet).data, [1, 2, 3])
+
+    def test_bottle(self):
+        bottle = dfb.MessageBottle('wrap', 'reset', param_name='data_prefix',
+                                   new_value='[')
+        bottle2 = self.round_trip(bottle)
+        self.assertEquals(bottle2.__class__, dfb.MessageBottle)
+        self.assertEquals((bottle2.destination, bottle2.message, 
+                           bottle2.param_name, bottle2.new_value, 
+                           bottle2.data), 
+                          ('wrap', 'reset', 'data_prefix', '[', ''))
+
+    def test_unencodable(self):
+        packet = dfb.DataPacket('abc', when=set([1]))
+        self.assertRaises(dfb.DataError, serialise.encode_packet, packet)
+        record = serialise.encode_packet(packet, pickle_other=True)
+        self.assertEquals(serialise.decode_packet(record, 
+                                                  allow_pickle=True).when,
+                          set([1]))
+
+    def test_pickle_refused(self):
+        # Unpickling can run any code, so isn't done unless allowed
+        record = serialise.encode_packet(dfb.DataPacket('abc', 
+                                                        when=set([1])),
+                                         pickle_other=True)
+        self.assertRaises(dfb.DataError, serialise.decode_packet, record)
+        stream = StringIO.StringIO(record)
+        self.assertRaises(dfb.DataError, serialise.read_packet, stream)
+
+    def test_bad_records(self):
+        record = serialise.encode_packet(dfb.DataPacket('abc'))
+        self.assertRaises(dfb.DataError, serialise.decode_packet, 
+                          'XX' + record[2:])
+        self.assertRaises(dfb.DataError, serialise.decode_packet, 
+                          record[:2] + '\x02' + record[3:])
+        self.assertRaises(dfb.DataError, serialise.decode_packet, 
+                          record[:-1])
+
+    def test_long_name(self):
+        packet = dfb.DataPacket('abc')
+        setattr(packet, 'x' * 256, 1)
+        self.assertRaises(dfb.DataError, serialise.encode_packet, packet)
+        delattr(packet, 'x' * 256)
+        setattr(packet, 'x' * 255, 1)
+        self.assertEquals(getattr(self.round_trip(packet), 'x' * 255), 1)
+
+    def test_corrupt_body(self):
+        record = serialise.encode_packet(dfb.DataPacket('abc', seq_num=3))
+        header_size = serialise.record_header.size
+        tag_pos = record.index('seq_num') + len('seq_num')
+        # Attribute count too big for the body, and an int tagged as a long
+        for corrupt in (record[:header_size] + '\xff\xff' +
+                        record[header_size + 2:],
+                        record[:tag_pos] + 'L' + record[tag_pos + 1:]):
+            try:
+                serialise.decode_packet(corrupt)
+            except dfb.DataError, err:
+                self.assertTrue('offset' in str(err), str(err))
+            else:  #pragma: nocover
+                self.fail('Corrupt record decoded')
+        # Data length pointing past the end of the body
+        self.assertRaises(dfb.DataError, serialise.decode_packet,
+                          record[:-7] + serialise.length_format.pack(10) +
+                          record[-3:])
+
+
+class TestReadWritePackets(unittest.TestCase):
+
+    def test_stream(self):
+        stream = StringIO.StringIO()
+        for j in xrange(3):
+            serialise.write_packet(stream, dfb.DataPacket('x' * j, seq_num=j))
+        serialise.write_packet(stream, dfb.MessageBottle('sink', 'reset'))
+        stream.seek(0)
+        packets = list(serialise.read_packets(stream))
+        self.assertEquals([(packet.data, packet.seq_num) 
+                           for packet in packets[:3]], 
+                          [('', 0), ('x', 1), ('xx', 2)])
+        self.assertEquals(packets[3].message, 'reset')
+        self.assertEquals(serialise.read_packet(stream), None)
+
+    def test_cut_short(self):
+        record = serialise.encode_packet(dfb.DataPacket('abc'))
+        for length in (3, len(record) - 1):
+            stream = StringIO.StringIO(record[:length])
+            self.assertRaises(dfb.DataError, serialise.read_packet, stream)
+
+
+if __name__ == '__main__':  #pragma: nocover
+    unittest.main()